@@ -0,0 +1,343 @@
+"""An in-process implementation of the rules in `view.sql`, which
+decide whether a study is an ACT or pACT and whether its results are
+due.
+
+Studies are the dicts produced by `xmltodict` with the `load_data`
+postprocessor, i.e. exactly what is uploaded to BigQuery as JSON.
+Each column is derived the same way as in the SQL, down to quirks
+like `TRIM(..., '"')` leaving JSON escapes in place, so that the CSV
+written here is interchangeable with the one exported from BigQuery
+and can be fed straight to `process_data`.
+
+The logic is documented here:
+ * https://github.com/ebmdatalab/clinicaltrials-act-tracker/issues/2#issuecomment-358318279
+ * https://github.com/ebmdatalab/clinicaltrials-act-tracker/pull/116#issue-173998549
+
+"""
+import csv
+import datetime
+import json
+import re
+from functools import lru_cache
+
+from dateutil.relativedelta import relativedelta
+
+from frontend.trial_computer import is_results_due
+
+
+# The columns of the CSV consumed by `process_data`, in the order
+# they are selected by `view.sql`
+COLUMNS = [
+    'nct_id', 'act_flag', 'included_pact_flag', 'has_results',
+    'pending_results', 'pending_data', 'has_certificate', 'results_due',
+    'start_date', 'available_completion_date',
+    'used_primary_completion_date', 'defaulted_pcd_flag',
+    'defaulted_cd_flag', 'results_submitted_date', 'last_updated_date',
+    'certificate_date', 'phase', 'enrollment', 'location', 'study_status',
+    'study_type', 'primary_purpose', 'sponsor', 'sponsor_type',
+    'collaborators', 'exported', 'fda_reg_drug', 'fda_reg_device',
+    'is_fda_regulated', 'url', 'title', 'official_title', 'brief_title',
+    'discrep_date_status', 'late_cert', 'defaulted_date', 'condition',
+    'condition_mesh', 'intervention', 'intervention_mesh', 'keywords'
+]
+
+# The date the Final Rule came into effect
+EFFECTIVE_DATE = datetime.date(2017, 1, 18)
+
+PHASES = {
+    'Phase 1/Phase 2', 'Phase 2', 'Phase 2/Phase 3', 'Phase 3', 'Phase 4',
+    'N/A'
+}
+
+ONGOING_STATUSES = {
+    'Not yet recruiting', 'Active, not recruiting', 'Recruiting',
+    'Enrolling by invitation', 'Unknown status', 'Available', 'Suspended'
+}
+
+# Matched against the JSON of the `intervention` field
+INTERVENTION_TYPES = re.compile(
+    r'"Biological"|"Drug"|"Device"|"Genetic"|"Radiation"|'
+    r'"Combination Product"|"Diagnostic Test"')
+
+# As in the SQL, the brackets in the last pattern are a group, not
+# literals, so that pattern never matches the registry's country name
+US_LOCATIONS = re.compile(
+    r"\bUnited States\b|\bAmerican Samoa\b|\bGuam\b|"
+    r"\bNorthern Mariana Islands\b|\bPuerto Rico\b|"
+    r"\bVirgin Islands (U.S.)\b")
+
+HAS_DAY = re.compile(r"\d,")
+
+
+def _get(study, *path):
+    """The value at `clinical_study.<path>`, or None if any part of
+    the path is missing; the equivalent of a JSONPath lookup.
+
+    """
+    value = study.get('clinical_study')
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def _json(value):
+    """The equivalent of `JSON_EXTRACT`: the value serialised as JSON
+    """
+    if value is None:
+        return None
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+
+
+def _scalar(value):
+    """The equivalent of `JSON_EXTRACT_SCALAR`: strings only
+    """
+    if isinstance(value, str):
+        return value
+    return None
+
+
+def _trimmed(value):
+    """The equivalent of `TRIM(JSON_EXTRACT(...), '"')`
+    """
+    extracted = _json(value)
+    if extracted is None:
+        return None
+    return extracted.strip('"')
+
+
+def _has_day(text):
+    return text is not None and HAS_DAY.search(text) is not None
+
+
+@lru_cache(maxsize=4096)
+def parse_date(text):
+    """Parse a registry date like "January 18, 2017", or "January 2017",
+    which is taken to mean the last day of the month.
+
+    """
+    if text is None:
+        return None
+    if _has_day(text):
+        return datetime.datetime.strptime(text, "%B %d, %Y").date()
+    first = datetime.datetime.strptime(text, "%B %Y").date()
+    next_month = (first.replace(day=28) + datetime.timedelta(days=4))
+    return next_month.replace(day=1) - datetime.timedelta(days=1)
+
+
+def _full_date(text):
+    if text is None:
+        return None
+    return datetime.datetime.strptime(text, "%B %d, %Y").date()
+
+
+def _typed_date(value):
+    """A date which may carry a `type` attribute (`Actual` or
+    `Anticipated`), in which case its text is under `text`
+
+    """
+    if isinstance(value, dict) and value.get('text') is not None:
+        return parse_date(_scalar(value['text']))
+    return parse_date(_scalar(value))
+
+
+def extract(study):
+    """The fields of a study used to classify it; the equivalent of the
+    `full_data_extract` expression in the SQL
+
+    """
+    pcd_text = _get(study, 'primary_completion_date', 'text')
+    cd_text = _get(study, 'completion_date', 'text')
+    cd = _get(study, 'completion_date')
+    phase = _trimmed(_get(study, 'phase'))
+    enrollment = _get(study, 'enrollment', 'text')
+    if enrollment is None:
+        enrollment = _get(study, 'enrollment')
+    official_title = _trimmed(_get(study, 'official_title'))
+    brief_title = _trimmed(_get(study, 'brief_title'))
+    primary_completion_date = parse_date(_scalar(pcd_text))
+    completion_date = _typed_date(cd)
+    fields = {
+        'nct_id': _trimmed(_get(study, 'id_info', 'nct_id')),
+        'study_type': _trimmed(_get(study, 'study_type')),
+        'study_status': _trimmed(_get(study, 'overall_status')),
+        'phase': phase.strip() if phase is not None else None,
+        'start_date': _typed_date(_get(study, 'start_date')),
+        'available_completion_date': (
+            completion_date if pcd_text is None else primary_completion_date),
+        'used_primary_completion_date': int(pcd_text is not None),
+        'primary_completion_date': primary_completion_date,
+        'defaulted_pcd_flag': int(not (
+            _has_day(_scalar(pcd_text)) or pcd_text is None)),
+        'completion_date': completion_date,
+        'defaulted_cd_flag': int(not (
+            _has_day(_scalar(cd_text)) or _has_day(_scalar(cd)) or
+            (_scalar(cd_text) is None and _scalar(cd) is None))),
+        'primary_purpose': _trimmed(
+            _get(study, 'study_design_info', 'primary_purpose')),
+        'fda_reg_drug': _trimmed(
+            _get(study, 'oversight_info', 'is_fda_regulated_drug')),
+        'fda_reg_device': _trimmed(
+            _get(study, 'oversight_info', 'is_fda_regulated_device')),
+        'exported': _trimmed(_get(study, 'oversight_info', 'is_us_export')),
+        'results_submitted_date': _full_date(
+            _scalar(_get(study, 'results_first_submitted'))),
+        'last_updated_date': _full_date(
+            _scalar(_get(study, 'last_update_submitted'))),
+        'pending_results': int(_get(study, 'pending_results') is not None),
+        'pending_data': _trimmed(_get(study, 'pending_results')),
+        'has_results': int(
+            _scalar(_get(study, 'results_first_submitted')) is not None),
+        'certificate_date': _full_date(
+            _scalar(_get(study, 'disposition_first_submitted'))),
+        'location': _trimmed(_get(study, 'location_countries')),
+        'sponsor': _trimmed(_get(study, 'sponsors', 'lead_sponsor', 'agency')),
+        'sponsor_type': _trimmed(
+            _get(study, 'sponsors', 'lead_sponsor', 'agency_class')),
+        'collaborators': _trimmed(_get(study, 'sponsors', 'collaborator')),
+        'enrollment': _trimmed(enrollment),
+        'title': official_title if official_title is not None else brief_title,
+        'official_title': official_title,
+        'brief_title': brief_title,
+        'url': _trimmed(_get(study, 'required_header', 'url')),
+        'condition': _json(_get(study, 'condition')),
+        'condition_mesh': _json(_get(study, 'condition_browse')),
+        'intervention': _json(_get(study, 'intervention')),
+        'intervention_mesh': _json(_get(study, 'intervention_browse')),
+        'keywords': _json(_get(study, 'keyword')),
+    }
+    return fields
+
+
+def _before(value, limit):
+    """`value < limit`, where a NULL value is never less than anything
+    """
+    return value is not None and value < limit
+
+
+def _on_or_after(value, limit):
+    return value is not None and value >= limit
+
+
+def _is_applicable(fields):
+    """The conditions shared by ACTs and all kinds of pACTs
+    """
+    return (
+        fields['study_type'] == 'Interventional'
+        and fields['phase'] in PHASES
+        and fields['primary_purpose'] != 'Device Feasibility'
+        and fields['study_status'] not in (None, 'Withdrawn'))
+
+
+def _is_fda_regulated(fields):
+    return 'Yes' in (fields['fda_reg_drug'], fields['fda_reg_device'])
+
+
+def is_act(fields):
+    return (
+        _is_applicable(fields)
+        and _is_fda_regulated(fields)
+        and _on_or_after(fields['start_date'], EFFECTIVE_DATE))
+
+
+def is_pact(fields):
+    if not _is_applicable(fields):
+        return False
+    if not (_before(fields['start_date'], EFFECTIVE_DATE) and
+            _on_or_after(fields['available_completion_date'], EFFECTIVE_DATE)):
+        return False
+    if _is_fda_regulated(fields):
+        return True
+    # Trials registered before the FDA regulation fields existed, which
+    # haven't been updated since (see #92)
+    return (
+        fields['is_fda_regulated'] is not False
+        and fields['fda_reg_drug'] is None
+        and fields['fda_reg_device'] is None
+        and fields['intervention'] is not None
+        and INTERVENTION_TYPES.search(fields['intervention']) is not None
+        and fields['location'] is not None
+        and US_LOCATIONS.search(fields['location']) is not None)
+
+
+def classify(fields, today):
+    """Add the ACT/pACT flags, whether results are due, and the "bad
+    data" checks to the `fields` of a study, as at `today`
+
+    """
+    act = is_act(fields)
+    pact = is_pact(fields)
+    completion_date = fields['available_completion_date']
+    certificate_date = fields['certificate_date']
+    primary_completion_date = fields['primary_completion_date']
+    fields['act_flag'] = int(act)
+    fields['included_pact_flag'] = int(pact)
+    fields['has_certificate'] = int(certificate_date is not None)
+    fields['results_due'] = int(
+        (act or pact) and is_results_due(
+            completion_date, certificate_date is not None, today))
+    fields['discrep_date_status'] = int(
+        (primary_completion_date is None or primary_completion_date < today)
+        and _before(fields['completion_date'], today)
+        and fields['study_status'] in ONGOING_STATUSES)
+    fields['late_cert'] = int(
+        certificate_date is not None and completion_date is not None
+        and certificate_date > completion_date + relativedelta(years=1))
+    fields['defaulted_date'] = int(
+        fields['defaulted_pcd_flag']
+        if fields['used_primary_completion_date']
+        else fields['defaulted_cd_flag'])
+    return fields
+
+
+def _format(value):
+    """Format a value as BigQuery does when exporting CSV
+    """
+    if value is None:
+        return ''
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return str(value)
+
+
+def classify_batch(studies, today, fda_regulated):
+    """Classify a batch of studies, returning CSV rows (in `COLUMNS`
+    order) for those which are ACTs or pACTs.
+
+    Args:
+        studies: parsed study dicts
+        today: the date as at which results are due
+        fda_regulated: dict of `is_fda_regulated` values from the
+            January 2017 snapshot, keyed by registry id
+
+    """
+    rows = []
+    for study in studies:
+        fields = extract(study)
+        fields['is_fda_regulated'] = fda_regulated.get(fields['nct_id'])
+        classify(fields, today)
+        if fields['act_flag'] or fields['included_pact_flag']:
+            rows.append([_format(fields[column]) for column in COLUMNS])
+    return rows
+
+
+@lru_cache(maxsize=1)
+def load_fda_regulation_snapshot(path):
+    """Load a CSV export of the `jan17_fda_regulation_snapshot` table,
+    with `nct_id` and `is_fda_regulated` columns.  This records which
+    studies were marked as FDA regulated before the registry
+    introduced separate drug and device fields.
+
+    """
+    snapshot = {}
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            value = row['is_fda_regulated'].lower()
+            snapshot[row['nct_id']] = {
+                'true': True, 'false': False}.get(value)
+    return snapshot
@@ -6,15 +6,14 @@ from django.utils.dateparse import parse_date
 
 from common import utils
 
-from frontend.models import Ranking
+from frontend.data_cache import current_data_date
 
 
 logger = logging.getLogger(__name__)
 
 
 def latest_date(request):
-    date = Ranking.objects.latest('date').date
-    return {'LATEST_DATE': date}
+    return {'LATEST_DATE': current_data_date()}
 
 
 def next_planned_update(request):
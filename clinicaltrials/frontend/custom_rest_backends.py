@@ -5,13 +5,22 @@ See also `custom_rest_views.py`
 
 """
 from collections import OrderedDict
+import base64
+import json
 import re
 
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connection
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import LimitOffsetPagination
 from rest_framework.filters import OrderingFilter
 from rest_framework.filters import SearchFilter
 from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param
+from rest_framework.utils.urls import replace_query_param
 
+from frontend.data_cache import cached
 from frontend.models import Ranking
 from frontend.models import Trial
 
@@ -31,19 +40,212 @@ class DataTablesPagination(LimitOffsetPagination):
     offset_query_param = 'start'
 
     def paginate_queryset(self, queryset, request, view=None):
-        self.total = queryset.count()
+        self.request = request
+        self.view = view
         return super().paginate_queryset(queryset, request, view=view)
 
+    def get_count(self, queryset):
+        """Count the (filtered) queryset once per data version for each
+        view and set of filters (see `filter_key`)
+        """
+        return cached(queryset.count, 'count', type(self.view).__name__,
+                      filter_key(self.request.query_params))
+
     def get_paginated_response(self, data):
+        # `recordsTotal` has always been the same as `recordsFiltered`
         return Response(OrderedDict([
             ('recordsFiltered', self.count),
-            ('recordsTotal', self.total),
+            ('recordsTotal', self.count),
             ('next', self.get_next_link()),
             ('previous', self.get_previous_link()),
             ('results', data)
         ]))
 
 
+class KeysetDataTablesPagination(DataTablesPagination):
+    """`DataTablesPagination`, plus a keyset ("seek") mode used when the
+    `cursor` parameter is given (empty for the first page).
+
+    Rather than skipping `start` rows, which gets slower the deeper the
+    page, each page starts after the last row of the previous one.  That
+    row is identified by its values of the ordering fields (with the
+    primary key added, in the same direction as the last of them, to
+    break ties), which are encoded in the cursor of the `next` link.
+    Only paging forwards is supported.
+
+    """
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = self.cursor_query_param in request.query_params
+        if not self.keyset:
+            return super().paginate_queryset(queryset, request, view=view)
+        self.request = request
+        self.view = view
+        self.count = self.get_count(queryset)
+        self.limit = self.get_limit(request)
+        self.ordering = keyset_ordering(queryset)
+        cursor = request.query_params[self.cursor_query_param]
+        if cursor:
+            queryset = rows_after(
+                queryset, self.ordering, self.decode_cursor(cursor))
+        page = list(queryset.order_by(*self.ordering)[:self.limit + 1])
+        self.next_position = None
+        if len(page) > self.limit:
+            page = page[:self.limit]
+            self.next_position = [
+                lookup_value(page[-1], field) for field in self.ordering]
+        return page
+
+    def encode_cursor(self, position):
+        data = json.dumps([self.ordering, position], default=str)
+        return base64.urlsafe_b64encode(data.encode('utf8')).decode('ascii')
+
+    def decode_cursor(self, cursor):
+        try:
+            ordering, position = json.loads(
+                base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf8'))
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        # The cursor must be used with the ordering it was made for
+        if ordering != self.ordering or len(position) != len(ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return position
+
+    def get_next_link(self):
+        if not self.keyset:
+            return super().get_next_link()
+        if self.next_position is None:
+            return None
+        url = remove_query_param(
+            self.request.build_absolute_uri(), self.offset_query_param)
+        return replace_query_param(
+            url, self.cursor_query_param,
+            self.encode_cursor(self.next_position))
+
+    def get_previous_link(self):
+        if not self.keyset:
+            return super().get_previous_link()
+        return None
+
+
+def keyset_ordering(queryset):
+    """The ordering of `queryset`, as field names, ending with its
+    primary key (sorted in the same direction as the field before it,
+    so an index on both can be scanned either way) so that every row
+    has a distinct position
+    """
+    ordering = list(queryset.query.order_by or queryset.model._meta.ordering)
+    if not any(field.lstrip('-') in ('pk', 'id') for field in ordering):
+        descending = bool(ordering) and ordering[-1].startswith('-')
+        ordering.append('-pk' if descending else 'pk')
+    return ordering
+
+
+def lookup_value(obj, field):
+    for name in field.lstrip('-').split('__'):
+        obj = getattr(obj, name)
+    return obj
+
+
+def rows_after(queryset, ordering, position):
+    """The rows of `queryset` which come after `position` (values for
+    each field in `ordering`).
+
+    Where possible this is a row comparison such as `(status, id) >
+    (%s, %s)`, which can be answered with a range scan of an index on
+    those columns; otherwise it's the equivalent chain of conditions
+    built by `rows_after_condition`.
+
+    """
+    comparison = row_comparison(queryset.model, ordering, position)
+    if comparison is None:
+        return queryset.filter(rows_after_condition(ordering, position))
+    sql, params = comparison
+    return queryset.extra(where=[sql], params=params)
+
+
+def row_comparison(model, ordering, position):
+    """SQL, and its parameters, comparing the row of ordering columns
+    with `position`, or None if that wouldn't give the same order as
+    `ordering`.
+
+    Fields must all be sorted in the same direction, and all be columns
+    of `model`'s own table.  As comparisons with null are never true,
+    only the first field may be nullable (its nulls sort after every
+    value in ascending order, so are added back, and before every value
+    in descending order, so are rightly excluded), and `position` must
+    not contain any nulls.
+
+    """
+    if len({field.startswith('-') for field in ordering}) != 1 or \
+       None in position:
+        return None
+    fields = []
+    for i, name in enumerate(field.lstrip('-') for field in ordering):
+        try:
+            field = model._meta.pk if name == 'pk' \
+                else model._meta.get_field(name)
+        except FieldDoesNotExist:
+            return None
+        if not field.concrete or field.is_relation or (i and field.null):
+            return None
+        fields.append(field)
+    descending = ordering[0].startswith('-')
+    columns = ["{}.{}".format(connection.ops.quote_name(model._meta.db_table),
+                              connection.ops.quote_name(field.column))
+               for field in fields]
+    sql = "({}) {} ({})".format(
+        ", ".join(columns), '<' if descending else '>',
+        ", ".join(['%s'] * len(columns)))
+    if fields[0].null and not descending:
+        sql = "({} OR {} IS NULL)".format(sql, columns[0])
+    params = [field.get_db_prep_value(field.to_python(value), connection)
+              for field, value in zip(fields, position)]
+    return sql, params
+
+
+def rows_after_condition(ordering, position):
+    """A condition matching the rows which come after `position` (values
+    for each field in `ordering`), given that PostgreSQL sorts nulls
+    last in ascending order and first in descending order
+    """
+    after = Q(pk__in=[])
+    equal = Q()
+    for field, value in zip(ordering, position):
+        name = field.lstrip('-')
+        descending = field.startswith('-')
+        if value is None:
+            later = Q(**{name + '__isnull': False}) if descending \
+                else Q(pk__in=[])
+            same = Q(**{name + '__isnull': True})
+        else:
+            later = Q(**{name + ('__lt' if descending else '__gt'): value})
+            if not descending:
+                later |= Q(**{name + '__isnull': True})
+            same = Q(**{name: value})
+        after |= equal & later
+        equal &= same
+    return after
+
+
+# Query parameters which only change which of the matching rows are
+# returned, or their order
+NON_FILTER_PARAMS = re.compile(
+    r"^(start|length|cursor|draw|_|format|order\[.*"
+    r"|columns\[\d+\]\[(data|name|orderable|searchable)\])$")
+
+
+def filter_key(params):
+    """A normalised form of the query parameters which decide which rows
+    a request matches
+    """
+    return sorted(
+        (k, sorted(params.getlist(k))) for k in params
+        if not NON_FILTER_PARAMS.match(k))
+
+
 def get_columns(params):
     cols = {}
     for k, v in params.items():
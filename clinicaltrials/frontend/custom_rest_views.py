@@ -8,8 +8,14 @@ expected to be used by the DataTables javascript library (see
 See also custom_rest_backends.py
 
 """
+import csv
+
+from django.conf import settings
 from django.db.models import Count
 from django.db.models import Q
+from django.http import HttpResponseRedirect
+from django.http import StreamingHttpResponse
+from django.utils.decorators import method_decorator
 
 from rest_framework import serializers
 from rest_framework import viewsets
@@ -18,6 +24,10 @@ from rest_framework.urlpatterns import format_suffix_patterns
 from .custom_filters import RankingFilter
 from .custom_filters import TrialStatusFilter
 from .custom_filters import SponsorFilter
+from .custom_rest_backends import KeysetDataTablesPagination
+from .data_cache import cache_anonymous_response
+from .data_cache import current_data_date
+from .exports import export_url
 
 from frontend.models import Ranking
 from frontend.models import Sponsor
@@ -64,41 +74,76 @@ class SponsorSerializer(serializers.HyperlinkedModelSerializer):
 
 
 
+class _Echo(object):
+    """A file-like object which returns what is written to it, so a
+    `csv.writer` can produce one line at a time
+    """
+    def write(self, value):
+        return value
+
+
+def _csv_lines(header, rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(header)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+@method_decorator(cache_anonymous_response, name='dispatch')
 class CSVNonPagingViewSet(viewsets.ModelViewSet):
     """A viewset that allows downloading a CSV in its entirety, rather
-    than in pages.
+    than in pages.  Responses to anonymous users are cached until the
+    next import.
 
-    """
-    @property
-    def paginator(self):
-        """Overrides paginator lookup in base class
-        """
-        if getattr(self, '_skip_paginator', False):
-            p = None
-        else:
-            p = super(CSVNonPagingViewSet, self).paginator
-        return p
+    The CSV is streamed straight from the database, rather than built
+    in memory through the serializer.  Its columns are the serializer's
+    fields, in the order `rest_framework_csv` would put them, and
+    `csv_lookups` gives the lookups for any which aren't simply model
+    fields.  Requests for the whole endpoint are redirected to its
+    nightly export, if there is one.
 
+    """
+    csv_lookups = {}
+    # The name of the nightly export of this endpoint (see `exports`)
+    export_name = None
 
     def list(self, request, format=None):
         """Overrides method in base class
         """
         if request.accepted_renderer.media_type == 'text/csv':
-            self._skip_paginator = True
-            result = super(CSVNonPagingViewSet, self).list(request, format=format)
-            self._skip_paginator = False
-        else:
-            result = super(CSVNonPagingViewSet, self).list(request, format=format)
-        return result
+            unfiltered = not set(request.query_params) - {'format'}
+            if unfiltered and self.export_name:
+                url = export_url(self.export_name)
+                if url is not None:
+                    return HttpResponseRedirect(url)
+            return StreamingHttpResponse(
+                self.csv_lines(), content_type='text/csv; charset=utf-8')
+        return super(CSVNonPagingViewSet, self).list(request, format=format)
+
+    def csv_lines(self):
+        """The lines of the CSV for this request
+        """
+        header = sorted(self.get_serializer_class().Meta.fields)
+        rows = self.filter_queryset(self.get_queryset()).prefetch_related(
+            None).values_list(
+                *[self.csv_lookups.get(field, field) for field in header])
+        return _csv_lines(header, rows.iterator(
+            chunk_size=settings.CSV_STREAM_CHUNK_SIZE))
 
 
 class RankingViewSet(CSVNonPagingViewSet):
     def get_queryset(self):
         # Only show the current date
-        date = Ranking.objects.latest('date').date
-        return Ranking.objects.filter(date=date).select_related('sponsor')
+        return Ranking.objects.filter(date=current_data_date()).select_related('sponsor')
 
     serializer_class = RankingSerializer
+    pagination_class = KeysetDataTablesPagination
+    export_name = 'rankings'
+    csv_lookups = {
+        'sponsor_name': 'sponsor__name',
+        'sponsor_slug': 'sponsor__slug',
+        'is_industry_sponsor': 'sponsor__is_industry_sponsor',
+    }
     ordering_fields = ['sponsor__name', 'due', 'reported', 'percentage']
     filter_class = RankingFilter
     search_fields = ('sponsor__name',)
@@ -106,6 +151,12 @@ class RankingViewSet(CSVNonPagingViewSet):
 
 class TrialViewSet(CSVNonPagingViewSet):
     serializer_class = TrialSerializer
+    pagination_class = KeysetDataTablesPagination
+    export_name = 'trials'
+    csv_lookups = {
+        'sponsor_name': 'sponsor__name',
+        'sponsor_slug': 'sponsor__slug',
+    }
     ordering_fields = ['status', 'sponsor__name', 'registry_id',
                        'title', 'completion_date', 'days_late']
     filter_class = TrialStatusFilter
@@ -129,5 +180,6 @@ class SponsorViewSet(CSVNonPagingViewSet):
             'trial',
             filter=~Q(trial__status=Trial.STATUS_NO_LONGER_ACT)))
     serializer_class = SponsorSerializer
+    export_name = 'sponsors'
     filter_class = SponsorFilter
     search_fields = ('name',)
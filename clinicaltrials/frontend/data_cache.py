@@ -0,0 +1,143 @@
+"""Caching of data, and whole pages, until the next import.
+
+The data only changes when `process_data` runs (or when staging is
+copied to live), so anything derived from it can be cached under a
+key which includes a *data version*: the date of the latest rankings,
+plus the id of the latest `ImportGeneration`.  Each import adds a
+generation in the same transaction as its final changes, so the
+version changes exactly when the data does, and old entries are
+simply never read again.
+
+The date of the latest rankings (shown on every page, and used to
+pick the current rankings) is kept by each process along with the
+generation it was read at, so it is only queried again after an
+import.
+
+Until the first generation is recorded, the version is unknown and
+nothing is cached.  Any Django cache backend will do (local memory
+within each web process is enough, as the keys don't need
+invalidating).
+
+"""
+import functools
+import hashlib
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+
+
+# The latest `ImportGeneration` seen by this process, and the date of
+# the latest rankings when it was recorded
+_current = {'generation': None, 'date': None}
+_current_lock = threading.Lock()
+
+
+def _latest_ranking_date():
+    with connection.cursor() as c:
+        c.execute("SELECT MAX(date) FROM frontend_ranking")
+        return c.fetchone()[0]
+
+
+def _latest_generation():
+    with connection.cursor() as c:
+        c.execute("SELECT MAX(id) FROM frontend_importgeneration")
+        return c.fetchone()[0]
+
+
+def _date_at(generation):
+    """The date of the latest rankings, read only if `generation` is
+    not the one it was last read at
+    """
+    with _current_lock:
+        if _current['generation'] == generation:
+            return _current['date']
+    latest_date = _latest_ranking_date()
+    with _current_lock:
+        _current.update(generation=generation, date=latest_date)
+    return latest_date
+
+
+def current_data_date():
+    """The date of the latest rankings, i.e. of the last import, or
+    None if there are none
+    """
+    generation = _latest_generation()
+    if generation is None:
+        return _latest_ranking_date()
+    return _date_at(generation)
+
+
+def data_version():
+    """A string identifying the current state of the data, or None if
+    no import has been recorded
+    """
+    generation = _latest_generation()
+    if generation is None:
+        return None
+    return "{}.{}".format(_date_at(generation), generation)
+
+
+def bump_data_version():
+    """Record that an import has finished changing the data; call this
+    in the same transaction as the last of the changes
+    """
+    from frontend.models import ImportGeneration
+    ImportGeneration.objects.create()
+
+
+def _key(version, *parts):
+    digest = hashlib.md5(
+        "\n".join(str(part) for part in parts).encode('utf8')).hexdigest()
+    return "data:{}:{}".format(version, digest)
+
+
+def cached(compute, *key_parts):
+    """The result of `compute()`, cached for the current data version
+    under a key made from `key_parts`
+    """
+    version = data_version()
+    if version is None:
+        return compute()
+    return cache.get_or_set(
+        _key(version, *key_parts), compute, settings.DATA_CACHE_TIMEOUT)
+
+
+def cache_anonymous_response(view):
+    """Decorate `view` so that successful responses to anonymous GET
+    and HEAD requests (with no logged-in user or `Authorization`
+    header) are cached for the current data version, keyed on the full
+    path and the formats accepted.
+
+    Responses which use a CSRF token are not cached, as the token
+    belongs to one visitor.
+
+    """
+    @functools.wraps(view)
+    def wrapped(request, *args, **kwargs):
+        if (request.method not in ('GET', 'HEAD') or
+                request.user.is_authenticated or
+                'HTTP_AUTHORIZATION' in request.META):
+            return view(request, *args, **kwargs)
+        version = data_version()
+        if version is None:
+            return view(request, *args, **kwargs)
+        key = _key(version, 'response', request.get_full_path(),
+                   request.META.get('HTTP_ACCEPT', ''))
+        response = cache.get(key)
+        if response is not None:
+            return response
+        response = view(request, *args, **kwargs)
+
+        def store(response):
+            if (response.status_code == 200 and
+                    not response.streaming and
+                    not request.META.get('CSRF_COOKIE_USED')):
+                cache.set(key, response, settings.DATA_CACHE_TIMEOUT)
+        if getattr(response, 'is_rendered', True):
+            store(response)
+        else:
+            response.add_post_render_callback(store)
+        return response
+    return wrapped
@@ -0,0 +1,337 @@
+"""A resumable HTTP downloader for very large files (specifically, the
+multi-GB registry zip fetched by `load_data`).
+
+Where the server supports it, the file is split into byte ranges which
+are fetched in parallel over several connections, each written at its
+own offset in a `.partial` file next to the target.  That file is
+allocated at its full size up front, so a download never needs more
+disk than the file itself.  A small `.parts.json` sidecar records the
+validators (size, ETag, Last-Modified) of the remote file and how many
+bytes of each range have been written, so if a download fails
+part-way (or the process is killed), the next attempt only fetches the
+bytes that are still missing.  If the validators have changed, the
+partial file is discarded and the download starts afresh.
+
+"""
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+# Statuses which mean "try again later"
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Bytes downloaded between saves of the progress of a partial download
+SAVE_INTERVAL = 8 * 2**20
+
+
+class DownloadError(Exception):
+    pass
+
+
+class Progress(object):
+    """Thread-safe count of bytes downloaded, logged at most every
+    `interval` seconds.
+
+    """
+    def __init__(self, total, already=0, interval=30):
+        self.total = total
+        self.done = already
+        self.already = already
+        self.interval = interval
+        self.start = time.time()
+        self.last_logged = self.start
+        self.lock = threading.Lock()
+
+    def add(self, n):
+        with self.lock:
+            self.done += n
+            now = time.time()
+            if now - self.last_logged >= self.interval:
+                self.last_logged = now
+                self.log()
+
+    @property
+    def rate(self):
+        """Bytes per second fetched during this attempt
+        """
+        elapsed = time.time() - self.start
+        if not elapsed:
+            return 0
+        return (self.done - self.already) / elapsed
+
+    def log(self):
+        if self.total:
+            logger.info(
+                "Downloaded %s of %s MB (%s%%) at %.1f MB/s",
+                self.done // 2**20, self.total // 2**20,
+                int(self.done * 100 / self.total), self.rate / 2**20)
+        else:
+            logger.info(
+                "Downloaded %s MB at %.1f MB/s",
+                self.done // 2**20, self.rate / 2**20)
+
+
+def _partial_path(target):
+    return "{}.partial".format(target)
+
+
+def _sidecar_path(target):
+    return "{}.parts.json".format(target)
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _split(size, connections):
+    """Split `size` bytes into at most `connections` inclusive
+    `(start, end)` ranges
+
+    """
+    connections = max(1, min(connections, size))
+    step = -(-size // connections)  # ceiling division
+    return [(start, min(start + step, size) - 1)
+            for start in range(0, size, step)]
+
+
+def _allocate(path, size):
+    """Create `path` as a file of `size` bytes, reserving the disk space
+    where the filesystem supports it
+    """
+    with open(path, 'wb') as f:
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except (AttributeError, OSError):
+            f.truncate(size)
+
+
+class _PartialFile(object):
+    """The file being downloaded, and the number of bytes written so far
+    for each of its ranges.
+
+    Progress is saved to the sidecar every `SAVE_INTERVAL` bytes (after
+    syncing the data it describes to disk) and on `close()`.  Any
+    progress from an earlier attempt with the same `validators` is
+    kept; otherwise a new file is allocated.
+
+    """
+    def __init__(self, target, validators):
+        self.path = _partial_path(target)
+        self.sidecar = _sidecar_path(target)
+        self.validators = validators
+        self.lock = threading.Lock()
+        self.unsaved = 0
+        previous = None
+        if os.path.exists(self.sidecar):
+            with open(self.sidecar) as f:
+                try:
+                    previous = json.load(f)
+                except ValueError:
+                    previous = None
+        if (isinstance(previous, dict) and
+                previous.get('validators') == validators and
+                _file_size(self.path) == validators['size']):
+            self.done = previous['done']
+        else:
+            if previous is not None:
+                logger.info(
+                    "Remote file has changed; discarding partial download")
+            self.done = [0] * len(validators['ranges'])
+            _allocate(self.path, validators['size'])
+        self.fd = os.open(self.path, os.O_WRONLY)
+        with self.lock:
+            self._save()
+
+    def write(self, index, offset, data):
+        """Write `data` at `offset`, as the next bytes of range `index`
+        """
+        os.pwrite(self.fd, data, offset)
+        with self.lock:
+            self.done[index] += len(data)
+            self.unsaved += len(data)
+            if self.unsaved >= SAVE_INTERVAL:
+                self._save()
+
+    def _save(self):
+        os.fsync(self.fd)
+        tmp = self.sidecar + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump({'validators': self.validators, 'done': self.done}, f)
+        os.replace(tmp, self.sidecar)
+        self.unsaved = 0
+
+    def close(self):
+        with self.lock:
+            self._save()
+        os.close(self.fd)
+
+
+def _fetch_range(session, url, partial, index, start, end, progress,
+                 retries, timeout):
+    """Fetch bytes `start` to `end` (inclusive) as range `index` of
+    `partial`, resuming from however much of it is already written.
+
+    A response which ends before the whole range has been received,
+    or one with a status in `RETRY_STATUSES`, counts as a failed
+    attempt, just like a connection error.  Any other response but
+    partial content means the server can't be trusted with ranges, so
+    fails at once.
+
+    """
+    length = end - start + 1
+    attempt = 0
+    while True:
+        position = start + partial.done[index]
+        if position > end:
+            return
+        headers = {'Range': 'bytes={}-{}'.format(position, end)}
+        try:
+            with session.get(url, headers=headers, stream=True,
+                             timeout=timeout) as response:
+                if response.status_code in RETRY_STATUSES:
+                    error = "HTTP {}".format(response.status_code)
+                elif response.status_code != 206:
+                    raise DownloadError(
+                        "Expected partial content for {} but got HTTP {}".format(
+                            headers['Range'], response.status_code))
+                else:
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        # Ignore anything beyond the range asked for
+                        chunk = chunk[:end + 1 - position]
+                        partial.write(index, position, chunk)
+                        position += len(chunk)
+                        progress.add(len(chunk))
+                    missing = length - partial.done[index]
+                    if not missing:
+                        return
+                    error = "response ended {} bytes short".format(missing)
+            if attempt >= retries:
+                raise DownloadError("Error fetching {} ({})".format(
+                    headers['Range'], error))
+        except requests.RequestException as e:
+            if attempt >= retries:
+                raise
+            error = e
+        attempt += 1
+        logger.warn(
+            "Error fetching %s (%s); retrying (%s/%s)",
+            headers['Range'], error, attempt, retries)
+        time.sleep(min(2 ** attempt, 60))
+
+
+def _fetch_whole(session, url, target, progress, retries, timeout):
+    """Fetch the file in a single request, for servers which don't
+    support ranges.  This can't be resumed, so a failure restarts the
+    download from scratch.
+
+    """
+    tmp = target + ".tmp"
+    attempt = 0
+    while True:
+        try:
+            with session.get(url, stream=True, timeout=timeout) as response:
+                if response.status_code >= 400 and \
+                   response.status_code not in RETRY_STATUSES:
+                    raise DownloadError("{} returned HTTP {}".format(
+                        url, response.status_code))
+                response.raise_for_status()
+                with open(tmp, 'wb') as f:
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        f.write(chunk)
+                        progress.add(len(chunk))
+            break
+        except requests.RequestException as e:
+            attempt += 1
+            if attempt > retries:
+                raise
+            logger.warn("Error fetching %s (%s); retrying (%s/%s)",
+                        url, e, attempt, retries)
+            progress.done = 0
+            time.sleep(min(2 ** attempt, 60))
+    os.replace(tmp, target)
+
+
+def download(url, target, connections=4, retries=5, timeout=60,
+             session=None):
+    """Download `url` to `target`, resuming any earlier partial attempt.
+
+    The registry publishes no checksum for its zip, so the only
+    validation is that the file has the size the server reported.
+
+    Args:
+        url: the URL to fetch
+        target: path to write to; partial downloads are kept alongside
+        connections: number of byte ranges to fetch in parallel
+        retries: number of times to retry each range after an error
+        timeout: seconds to wait for the server to respond or send data
+        session: a `requests.Session` to use (one is created by default)
+
+    Returns:
+        the `Progress` of the download, which records bytes and rate
+
+    Raises:
+        DownloadError: if the server misbehaves or validation fails
+
+    """
+    session = session or requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=connections)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    head = session.head(url, allow_redirects=True, timeout=timeout)
+    head.raise_for_status()
+    size = int(head.headers.get('Content-Length') or 0) or None
+    url = head.url  # don't follow the same redirects on every request
+
+    if size and head.headers.get('Accept-Ranges') == 'bytes':
+        ranges = _split(size, connections)
+        validators = {
+            'url': url,
+            'size': size,
+            'etag': head.headers.get('ETag'),
+            'last_modified': head.headers.get('Last-Modified'),
+            'ranges': [list(r) for r in ranges],
+        }
+        partial = _PartialFile(target, validators)
+        already = sum(partial.done)
+        progress = Progress(size, already=already)
+        if already:
+            logger.info("Resuming download of %s from %s MB",
+                        url, already // 2**20)
+        try:
+            with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                futures = [
+                    executor.submit(
+                        _fetch_range, session, url, partial, i,
+                        start, end, progress, retries, timeout)
+                    for i, (start, end) in enumerate(ranges)]
+                for future in futures:
+                    future.result()
+        finally:
+            partial.close()
+        os.replace(partial.path, target)
+        os.remove(partial.sidecar)
+    else:
+        progress = Progress(size)
+        _fetch_whole(session, url, target, progress, retries, timeout)
+
+    actual_size = _file_size(target)
+    if size and actual_size != size:
+        raise DownloadError("Downloaded {} bytes from {}, expected {}".format(
+            actual_size, url, size))
+    progress.log()
+    return progress
@@ -0,0 +1,94 @@
+"""Nightly exports of the trials, rankings and sponsors API endpoints
+as CSV files, written after each import and served by nginx.
+
+Each export is written twice, as CSV and gzipped CSV (which nginx's
+`gzip_static` serves to clients that accept it), under a name which
+includes the data version (see `data_cache`), so a file is never
+changed once written.  Requests for the whole of an endpoint as CSV
+are redirected to the export for the current version, if it exists.
+
+"""
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.http import HttpRequest
+from rest_framework.request import Request
+
+from frontend.data_cache import data_version
+
+
+logger = logging.getLogger(__name__)
+
+
+def export_filename(name, version):
+    return "{}-{}.csv".format(name, version)
+
+
+def export_url(name):
+    """The URL of the current export called `name`, or None if it
+    hasn't been written
+    """
+    version = data_version()
+    if version is None:
+        return None
+    filename = export_filename(name, version)
+    if not os.path.exists(os.path.join(settings.EXPORT_ROOT, filename)):
+        return None
+    return settings.EXPORT_URL + filename
+
+
+def _write_atomically(path, write):
+    """Create the file at `path` by calling `write` with a temporary
+    binary file, which is then renamed, so the file is never seen half
+    written
+    """
+    fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.chmod(temporary, 0o644)
+        os.rename(temporary, path)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+
+def write_exports():
+    """Write the exports for the current data version, and remove those
+    for any other
+    """
+    from frontend.custom_rest_views import RankingViewSet
+    from frontend.custom_rest_views import SponsorViewSet
+    from frontend.custom_rest_views import TrialViewSet
+
+    version = data_version()
+    if version is None:
+        logger.warn("No import has been recorded; not writing exports")
+        return
+    os.makedirs(settings.EXPORT_ROOT, exist_ok=True)
+    for viewset in [TrialViewSet, RankingViewSet, SponsorViewSet]:
+        # The queryset, and ordering, of an unfiltered request
+        view = viewset(request=Request(HttpRequest()), format_kwarg=None)
+        filename = export_filename(viewset.export_name, version)
+        path = os.path.join(settings.EXPORT_ROOT, filename)
+        logger.info("Writing %s", path)
+
+        def write_csv(f):
+            f.writelines(line.encode('utf8') for line in view.csv_lines())
+
+        def write_gzip(f):
+            with open(path, 'rb') as source:
+                with gzip.GzipFile(
+                        filename=filename, fileobj=f, mode='wb',
+                        mtime=0) as target:
+                    shutil.copyfileobj(source, target)
+        _write_atomically(path, write_csv)
+        _write_atomically(path + '.gz', write_gzip)
+        for old in os.listdir(settings.EXPORT_ROOT):
+            if (old.startswith(viewset.export_name + '-') and
+                    old not in (filename, filename + '.gz')):
+                os.remove(os.path.join(settings.EXPORT_ROOT, old))
@@ -9,22 +9,30 @@ from bigquery import TableExporter
 from bigquery import wait_for_job
 from bigquery import gen_job_name
 import xmltodict
+import collections
+import csv
+import io
 import os
 import subprocess
 import json
-import glob
+import multiprocessing
 import datetime
-import tempfile
+import hashlib
 import shutil
 import requests
 import contextlib
 import re
+import zipfile
 from google.cloud.exceptions import NotFound
 from xml.parsers.expat import ExpatError
 
 from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
 from django.conf import settings
 
+from frontend import act_classifier
+from frontend import downloader
+
 
 logger = logging.getLogger(__name__)
 
@@ -45,29 +53,40 @@ def postprocessor(path, key, value):
     return key, value
 
 
-def wget_file(target, url):
-    subprocess.check_call(["wget", "-q", "-O", target, url])
+def download_file(target, url):
+    downloader.download(
+        url, target, connections=settings.DOWNLOAD_CONNECTIONS)
+
+
+def zip_path():
+    return os.path.join(settings.WORKING_DIR, "AllPublicXML.zip")
 
 
-def download_and_extract():
-    """Clean up from past runs, then download into a temp location and move the
-    result into place.
+def download():
+    """Download into a location on the working volume, then move the
+    result into place, cleaning up from past runs.
+
+    If the download fails, the partial download is left in place and
+    resumed on the next run.
+
+    The zip is not extracted: studies are read directly from it by
+    `convert_to_json`.  Returns the path of the zip.
     """
     logger.info("Downloading. This takes at least 30 mins on a fast connection!")
     url = 'https://clinicaltrials.gov/AllPublicXML.zip'
 
-    # download and extract
-    container = tempfile.mkdtemp(
-        prefix=settings.STORAGE_PREFIX.rstrip(os.sep), dir=settings.WORKING_VOLUME)
-    try:
-        data_file = os.path.join(container, "data.zip")
-        wget_file(data_file, url)
-        # Can't "wget|unzip" in a pipe because zipfiles have index at end of file.
-        with contextlib.suppress(OSError):
-            shutil.rmtree(settings.WORKING_DIR)
-        subprocess.check_call(["unzip", "-q", "-o", "-d", settings.WORKING_DIR, data_file])
-    finally:
-        shutil.rmtree(container)
+    data_file = os.path.join(
+        settings.WORKING_VOLUME,
+        "{}_data.zip".format(settings.STORAGE_PREFIX.rstrip(os.sep)))
+    download_file(data_file, url)
+    if not zipfile.is_zipfile(data_file):
+        os.remove(data_file)
+        raise RuntimeError("Downloaded file is not a valid zip")
+    with contextlib.suppress(OSError):
+        shutil.rmtree(settings.WORKING_DIR)
+    os.makedirs(settings.WORKING_DIR)
+    os.replace(data_file, zip_path())
+    return zip_path()
 
 
 def upload_to_cloud():
@@ -100,34 +119,305 @@ def notify_slack(message):
         )
 
 
-def convert_to_json():
-    logger.info("Converting to JSON...")
-    dpath = os.path.join(settings.WORKING_DIR, 'NCT*/')
-    files = [x for x in sorted(glob.glob(dpath + '*.xml'))]
-    start = datetime.datetime.now()
-    completed = 0
-    with open(os.path.join(settings.WORKING_DIR, raw_json_name()), 'w') as f2:
-        for source in files:
-            logger.info("Converting %s", source)
-            with open(source, 'rb') as f:
-                try:
-                    f2.write(
-                        json.dumps(
-                            xmltodict.parse(
-                                f,
-                                item_depth=0,
-                                postprocessor=postprocessor)
-                        ) + "\n")
-                except ExpatError:
-                    logger.warn("Unable to parse %s", source)
-
-        completed += 1
-        if completed % 100 == 0:
+# Open zipfiles, keyed by process and path; see `open_zip`
+_open_zips = {}
+
+
+def open_zip(path):
+    """Return a ZipFile for `path`, opened once per process.
+
+    Opening reads the whole central directory, which is slow for a zip
+    of hundreds of thousands of studies, so we only want to do it once
+    per worker.  Each process needs its own handle, as forked
+    processes would otherwise share (and race on) a file offset.
+
+    """
+    key = (os.getpid(), path)
+    if key not in _open_zips:
+        _open_zips[key] = zipfile.ZipFile(path)
+    return _open_zips[key]
+
+
+def study_names(path):
+    """The names of every study XML file in the zip, in sorted order.
+
+    These are read from the zip's central directory, without
+    touching the compressed data.
+
+    """
+    with zipfile.ZipFile(path) as z:
+        return sorted(
+            name for name in z.namelist()
+            if re.match(r"^NCT[^/]*/[^/]+\.xml$", name))
+
+
+def iter_studies(path, names):
+    """Yield `(name, xml_bytes)` for each of the named members of the zip
+    """
+    z = open_zip(path)
+    for name in names:
+        yield name, z.read(name)
+
+
+def parse_study(name, content):
+    """Parse a single study's XML, or return None if it can't be parsed
+    """
+    logger.info("Converting %s", name)
+    try:
+        return xmltodict.parse(
+            content,
+            item_depth=0,
+            postprocessor=postprocessor)
+    except ExpatError:
+        logger.warn("Unable to parse %s", name)
+        return None
+
+
+def convert_study(name, content):
+    """Convert a single study's XML to a line of JSON, or return None if
+    it can't be parsed.
+
+    """
+    study = parse_study(name, content)
+    if study is None:
+        return None
+    return json.dumps(study) + "\n"
+
+
+def classify_study(name, content, today, fda_regulated):
+    """Convert a single study's XML to a line of the CSV consumed by
+    `process_data`, or return None if it is not an ACT or pACT.
+
+    """
+    study = parse_study(name, content)
+    if study is None:
+        return None
+    rows = act_classifier.classify_batch([study], today, fda_regulated)
+    if not rows:
+        return None
+    f = io.StringIO()
+    csv.writer(f, lineterminator="\n").writerows(rows)
+    return f.getvalue()
+
+
+def nct_id(name):
+    """The registry id of a study, from its path within the zip
+    """
+    return os.path.splitext(os.path.basename(name))[0]
+
+
+def study_digest(content):
+    """A hash of a study's XML, ignoring the `download_date` that
+    changes in every file in every download.
+
+    """
+    return hashlib.sha1(
+        re.sub(rb"<download_date>.*?</download_date>", b"", content)
+    ).hexdigest()
+
+
+def convert_shard(args):
+    """Convert a list of studies in a zip, returning their JSON lines in
+    the same order, along with a digest of every study and the ids
+    of those whose digest differs from `known`.
+
+    If `known` (a dict of digests keyed by registry id) is None, every
+    study is converted; otherwise studies with an unchanged digest
+    are skipped.
+
+    If `classify` is a `(snapshot_path, today)` tuple, studies are
+    classified in-process (see `act_classifier`) and lines of CSV
+    are returned instead of JSON, for ACTs and pACTs only.
+
+    Called in worker processes, so must be a module-level function
+    taking a single `(zip_path, names, known, classify)` argument.
+
+    """
+    path, names, known, classify = args
+    if classify is not None:
+        snapshot_path, today = classify
+        fda_regulated = act_classifier.load_fda_regulation_snapshot(
+            snapshot_path)
+    lines = []
+    digests = {}
+    changed = []
+    for name, content in iter_studies(path, names):
+        registry_id = nct_id(name)
+        digest = study_digest(content)
+        digests[registry_id] = digest
+        if known is not None:
+            if known.get(registry_id) == digest:
+                continue
+            changed.append(registry_id)
+        if classify is None:
+            line = convert_study(name, content)
+        else:
+            line = classify_study(name, content, today, fda_regulated)
+        if line is not None:
+            lines.append(line)
+    return lines, digests, changed
+
+
+def shard(items, size):
+    """Split a list into consecutive lists of at most `size` items
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class StudyStream(object):
+    """The studies in the zip at `path`, converted shard by shard, as an
+    iterable of lines in their original order.
+
+    Shards of `CONVERSION_SHARD_SIZE` files are farmed out to
+    `workers` processes (default `CONVERSION_WORKERS`), with only a
+    few shards in flight at a time, so a slow consumer holds back
+    conversion rather than letting lines pile up in memory.
+
+    Lines are JSON, or CSV if `classify` is given (see
+    `convert_shard`).  If a `manifest` of study digests from a previous
+    run is supplied, only studies which are new or have changed since
+    are converted.  Once the stream is exhausted, `digests` is a
+    manifest for this run and `delta` a dict of the registry ids of
+    `changed` and `removed` studies (None if no `manifest` was
+    supplied).
+
+    """
+    def __init__(self, path, classify=None, workers=None, manifest=None):
+        self.path = path
+        self.classify = classify
+        self.workers = workers or settings.CONVERSION_WORKERS
+        self.manifest = manifest
+        self.digests = {}
+        self.delta = None
+
+    def _tasks(self, shards):
+        for names in shards:
+            known = None
+            if self.manifest is not None:
+                known = {nct_id(n): self.manifest.get(nct_id(n)) for n in names}
+            yield (self.path, names, known, self.classify)
+
+    def __iter__(self):
+        names = study_names(self.path)
+        shards = shard(names, settings.CONVERSION_SHARD_SIZE)
+        changed = []
+        start = datetime.datetime.now()
+        completed = 0
+        results = imap_bounded(
+            convert_shard, self._tasks(shards), self.workers)
+        for sources, (lines, shard_digests, shard_changed) in zip(shards, results):
+            yield from lines
+            self.digests.update(shard_digests)
+            changed.extend(shard_changed)
+            completed += len(sources)
             elapsed = datetime.datetime.now() - start
-            per_file = elapsed.seconds / completed
-            remaining = int(per_file * (len(files) - completed) / 60.0)
+            per_file = elapsed.total_seconds() / completed
+            remaining = int(per_file * (len(names) - completed) / 60.0)
             logger.info("%s minutes remaining", remaining)
+        if self.manifest is not None:
+            self.delta = {
+                'changed': changed,
+                'removed': sorted(set(self.manifest) - set(self.digests))
+            }
+            logger.info(
+                "%s studies changed and %s removed since the last run",
+                len(self.delta['changed']), len(self.delta['removed']))
+
+
+def imap_bounded(func, tasks, workers):
+    """Like `Pool.imap`, yielding results in the order tasks were
+    submitted, but with at most two tasks per worker in flight.
+
+    """
+    if workers <= 1:
+        yield from map(func, tasks)
+        return
+    with multiprocessing.Pool(workers) as pool:
+        pending = collections.deque()
+        for task in tasks:
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(func, (task,)))
+        while pending:
+            yield pending.popleft().get()
+
+
+def local_classification(today=None):
+    """The `classify` argument for classifying studies in-process, as
+    at `today` (default today)
+
+    """
+    return (settings.FDA_REGULATION_SNAPSHOT_PATH,
+            today or datetime.date.today())
+
+
+def convert_to_json(path, workers=None, manifest=None):
+    """Convert every study XML file in the zip at `path` to a single file
+    of JSON lines.
+
+    Shards are written in their original order, so the output is the
+    same however many workers are used.
+
+    Returns:
+        (digests, delta) tuple, as described in `StudyStream`
+
+    """
+    logger.info("Converting to JSON...")
+    stream = StudyStream(path, workers=workers, manifest=manifest)
+    with open(os.path.join(settings.WORKING_DIR, raw_json_name()), 'w') as f:
+        f.writelines(stream)
+    return stream.digests, stream.delta
+
+
+def convert_to_csv(path, workers=None, manifest=None, today=None):
+    """Classify every study in the zip at `path` without BigQuery,
+    writing the ACTs and pACTs to `INTERMEDIATE_CSV_PATH` in the
+    format produced by `convert_and_download`.
 
+    Arguments and return value are as for `convert_to_json`; `today`
+    is the date as at which results are due (default today).
+
+    """
+    logger.info("Classifying studies locally...")
+    stream = StudyStream(
+        path, classify=local_classification(today), workers=workers,
+        manifest=manifest)
+    with open(settings.INTERMEDIATE_CSV_PATH, 'w') as f:
+        csv.writer(f, lineterminator="\n").writerow(act_classifier.COLUMNS)
+        f.writelines(stream)
+    return stream.digests, stream.delta
+
+
+def load_manifest():
+    """Return the study digests recorded by the last successful run, or
+    None if there are none.
+
+    """
+    try:
+        with open(settings.CONVERSION_MANIFEST_PATH) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_manifest(digests):
+    """Record the study digests for this run, to be committed by
+    `commit_manifest` once the import has succeeded.
+
+    """
+    with open(settings.CONVERSION_MANIFEST_PATH + ".pending", 'w') as f:
+        json.dump(digests, f)
+
+
+def commit_manifest():
+    os.replace(
+        settings.CONVERSION_MANIFEST_PATH + ".pending",
+        settings.CONVERSION_MANIFEST_PATH)
+
+
+def save_delta(delta):
+    with open(settings.INTERMEDIATE_DELTA_PATH, 'w') as f:
+        json.dump(delta, f)
 
 
 def convert_and_download():
@@ -179,17 +469,17 @@ def get_env(path):
     return env
 
 
-def process_data():
+def process_data(arguments):
     # TODO no need to call via shell any more (now we are also a command)
+    command = [
+        "{}python".format(settings.PROCESSING_VENV_BIN),
+        "{}/manage.py".format(settings.BASE_DIR),
+        "process_data"] + arguments + [
+        "--settings=frontend.settings"
+    ]
     try:
         subprocess.check_output(
-            [
-                "{}python".format(settings.PROCESSING_VENV_BIN),
-                "{}/manage.py".format(settings.BASE_DIR),
-                "process_data",
-                "--input-csv={}".format(settings.INTERMEDIATE_CSV_PATH),
-                "--settings=frontend.settings"
-            ],
+            command,
             stderr=subprocess.STDOUT,
             env=get_env(settings.PROCESSING_ENV_PATH))
         notify_slack("Today's data uploaded to FDAAA staging: "
@@ -204,19 +494,116 @@ def process_data():
         sys.exit(1)
 
 
+def convert_and_process(data_file, workers, incremental, local, bulk, copy):
+    """Write the ACTs and pACTs in `data_file` to `INTERMEDIATE_CSV_PATH`
+    (using BigQuery, unless `local`), then import the CSV.
+
+    """
+    manifest = None
+    if incremental:
+        manifest = load_manifest()
+        if manifest is None:
+            logger.info("No manifest from a previous run; "
+                        "importing everything")
+    if local:
+        digests, delta = convert_to_csv(
+            data_file, workers=workers, manifest=manifest)
+    else:
+        digests, delta = convert_to_json(
+            data_file, workers=workers, manifest=manifest)
+    save_manifest(digests)
+    if delta is not None:
+        save_delta(delta)
+    if not local:
+        upload_to_cloud()
+        convert_and_download()
+    arguments = ["--input-csv={}".format(settings.INTERMEDIATE_CSV_PATH)]
+    if delta is not None:
+        arguments.append("--delta={}".format(settings.INTERMEDIATE_DELTA_PATH))
+    if bulk:
+        arguments.append("--bulk")
+    if copy:
+        arguments.append("--copy")
+    if incremental:
+        arguments.append("--qa-cache={}".format(settings.QA_CACHE_PATH))
+        arguments.append("--incremental-rankings")
+    arguments.append("--write-exports")
+    process_data(arguments)
+
+
 class Command(BaseCommand):
     help = '''Generate a CSV that can be consumed by the `process_data` command, and run that command
     '''
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            help='Number of processes used to convert XML to JSON '
+                 '(default: settings.CONVERSION_WORKERS)')
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            help='Only convert and import studies which have changed '
+                 'since the last successful run, and only update the QA '
+                 'metadata of trials whose QA history has changed '
+                 '(using settings.QA_CACHE_PATH) and the rankings of '
+                 'sponsors whose trials have changed')
+        parser.add_argument(
+            '--local',
+            action='store_true',
+            help='Classify studies in this process, rather than '
+                 'running view.sql in BigQuery')
+        parser.add_argument(
+            '--stream',
+            action='store_true',
+            help='Classify and import studies straight from the zip in '
+                 'a single pass, without intermediate files (implies '
+                 '--local)')
+        parser.add_argument(
+            '--no-csv',
+            action='store_true',
+            help='With --stream, don\'t write a copy of the imported '
+                 'rows to the intermediate CSV')
+        parser.add_argument(
+            '--bulk',
+            action='store_true',
+            help='Import trials in batches (see `process_data --bulk`)')
+        parser.add_argument(
+            '--copy',
+            action='store_true',
+            help='Import the CSV via a staging table '
+                 '(see `process_data --copy`); not possible with --stream, '
+                 'as there is no CSV')
+
     def handle(self, *args, **options):
+        if options['stream'] and options['copy']:
+            raise CommandError("--copy can't be used with --stream")
         with contextlib.suppress(OSError):
             os.remove(settings.INTERMEDIATE_CSV_PATH)
         try:
-            download_and_extract()
-            convert_to_json()
-            upload_to_cloud()
-            convert_and_download()
-            process_data()
+            data_file = download()
+            if options['stream']:
+                arguments = ["--input-zip={}".format(data_file)]
+                if options['workers']:
+                    arguments.append("--workers={}".format(options['workers']))
+                if options['incremental']:
+                    arguments.append("--incremental")
+                    arguments.append(
+                        "--qa-cache={}".format(settings.QA_CACHE_PATH))
+                    arguments.append("--incremental-rankings")
+                if not options['no_csv']:
+                    arguments.append(
+                        "--tee-csv={}".format(settings.INTERMEDIATE_CSV_PATH))
+                if options['bulk']:
+                    arguments.append("--bulk")
+                arguments.append("--write-exports")
+                process_data(arguments)
+            else:
+                convert_and_process(
+                    data_file, options['workers'], options['incremental'],
+                    options['local'], options['bulk'], options['copy'])
+            commit_manifest()
         except:
             notify_slack("Error in FDAAA import: {}".format(traceback.format_exc()))
             raise
@@ -5,21 +5,40 @@ import datetime
 import logging
 import re
 import json
+import contextlib
+import collections
 
+from django.conf import settings
 from django.db import transaction
+from django.db.models import Count
+from django.db.models import F
+from django.db.models import Q
 from django.db.models import Sum
+from django.db.models.expressions import RawSQL
 from django.db import connection
 from django.core.management.base import BaseCommand
 from django.utils.text import slugify
 
+from frontend.data_cache import bump_data_version
 from frontend.models import Trial
 from frontend.models import TrialQA
 from frontend.models import Sponsor
 from frontend.models import Ranking
+from frontend.models import DailySummary
 from frontend.models import date
-import requests
+from frontend.qa_cache import QACache
+from frontend.qa_cache import qa_digest
+from frontend.qa_dates import parse_qa_date
+from frontend.trial_computer import compute_batch
+from frontend.trial_computer import compute_metadata
+from frontend.trial_computer import qa_start_dates
+from frontend.trial_computer import refresh_lateness
+from frontend import act_classifier
+from frontend import exports
+from frontend import registry_api
+from frontend.management.commands import load_data
+from psycopg2.extras import execute_values
 from lxml import html
-import dateparser
 
 
 logger = logging.getLogger(__name__)
@@ -27,12 +46,15 @@ logger = logging.getLogger(__name__)
 # The date cc.gov first started recording cancellations
 EARLIEST_CANCELLATION_DATE = date(2018, 7, 5)
 
-def set_qa_metadata(trial):
-    
+def set_qa_metadata(trial, content=None):
+    """Record the QA history of a trial from its study record in the
+    clinicaltrials.gov API, which is fetched unless supplied as
+    `content`.
+
+    """
     #Calling the API for a given trial and json-ing the output
-    registry_id = trial.registry_id
-    url = "https://clinicaltrials.gov/api/v2/studies/{}".format(registry_id)
-    content = json.loads(requests.get(url).text)
+    if content is None:
+        content = registry_api.StudyFetcher(workers=1).fetch(trial.registry_id)
 
     #Accessing the data we need if it exists
     try:
@@ -48,11 +70,11 @@ def set_qa_metadata(trial):
             #'unreselaseDate' is the key for when there is a cancellation
             #So we handle that
             if 'unreleaseDate' in list(row.keys()):
-                cancelled_date = dateparser.parse(row['unreleaseDate'])
-                submitted_date = dateparser.parse(row['releaseDate'])
+                cancelled_date = parse_qa_date(row['unreleaseDate'])
+                submitted_date = parse_qa_date(row['releaseDate'])
                 #Some old trials could have an "unknown" status in the cancellation date field.
                 #So we are accounting for that here though that should be very rare.
-                if "unknown" in cancelled_date.lower():
+                if cancelled_date is None:
                     cancelled_date = EARLIEST_CANCELLATION_DATE
                     cancellation_date_inferred = True
                 else:
@@ -73,9 +95,9 @@ def set_qa_metadata(trial):
             #So we can just do an else because that will just be any bit of JSON without 'unreselaseDate' 
             else:
                 #Just getting the submission date and the return date if it exists
-                submitted = dateparser.parse(row['releaseDate'])
+                submitted = parse_qa_date(row['releaseDate'])
                 if 'resetDate' in row.keys():
-                    returned = dateparser.parse(row['resetDate'])
+                    returned = parse_qa_date(row['resetDate'])
                 else:
                     returned = None
                 #This bit was ported in from the old function
@@ -117,47 +139,261 @@ def _compute_ranks():
             c.execute(sql, [on_date])
 
 
-def set_current_rankings():
+RANKING_COLUMNS = [
+    'due', 'reported', 'total', 'days_late', 'overdue', 'reported_late',
+    'reported_on_time', 'finable_days_late'
+]
+
+
+def _ranking_statistics(sponsors=None):
+    """The statistics stored in each sponsor's `Ranking`, computed for
+    all sponsors (or just those whose slugs are in `sponsors`) in one
+    grouped query.  Counts use the same statuses as the corresponding
+    `TrialQuerySet` methods.
+
+    """
+    visible = ~Q(trial__status=Trial.STATUS_NO_LONGER_ACT)
+
+    def count(*statuses):
+        return Count('trial', filter=Q(trial__status__in=statuses))
+    queryset = Sponsor.objects.all()
+    if sponsors is not None:
+        queryset = queryset.filter(pk__in=sponsors)
+    return queryset.values('pk', 'updated_date').annotate(
+        due=count(Trial.STATUS_OVERDUE, Trial.STATUS_REPORTED,
+                  Trial.STATUS_REPORTED_LATE, Trial.STATUS_OVERDUE_CANCELLED),
+        reported=count(Trial.STATUS_REPORTED, Trial.STATUS_REPORTED_LATE),
+        reported_late=count(Trial.STATUS_REPORTED_LATE),
+        reported_on_time=count(Trial.STATUS_REPORTED),
+        overdue=count(Trial.STATUS_OVERDUE, Trial.STATUS_OVERDUE_CANCELLED),
+        total=Count('trial', filter=visible),
+        days_late=Sum('trial__days_late', filter=visible),
+        finable_days_late=Sum('trial__finable_days_late', filter=visible))
+
+
+def set_current_rankings(in_sql=False, changed_sponsors=None):
     """Compute a ranking for each sponsor, which aggregates statistics
     about their trials and then puts them in ranked order.
 
+    The statistics are aggregated in a single query, and written with a
+    single upsert, before ranks are computed.  If `in_sql`, all of this
+    is done in one statement by `_set_rankings_in_sql`.
+
+    If `changed_sponsors` is given (the slugs of sponsors any of whose
+    trials were added, changed or retired by the import; see
+    `Command.handle`), the rankings of other sponsors are carried
+    forward from their previous ranking, and only changed sponsors, or
+    those without a previous ranking, are aggregated.
+
     """
     with transaction.atomic():
-        for sponsor in Sponsor.objects.all():
-            due = Trial.objects.due().filter(
-                sponsor=sponsor).count()
-            reported = Trial.objects.reported().filter(
-                sponsor=sponsor).count()
-            reported_late = Trial.objects.reported_late().filter(
-                sponsor=sponsor).count()
-            reported_on_time = Trial.objects.reported_on_time().filter(
-                sponsor=sponsor).count()
-            overdue = Trial.objects.overdue().filter(
-                sponsor=sponsor).count()
-            total = sponsor.trial_set.visible().count()
-            days_late = sponsor.trial_set.visible().aggregate(
-                total_days_late=Sum('days_late'))['total_days_late']
-            finable_days_late = sponsor.trial_set.visible().aggregate(
-                total_finable_days_late=Sum('finable_days_late'))['total_finable_days_late']
-            d = {
-                'due': due,
-                'reported': reported,
-                'total': total,
-                'date': sponsor.updated_date,
-                'days_late': days_late,
-                'overdue': overdue,
-                'reported_late': reported_late,
-                'reported_on_time': reported_on_time,
-                'finable_days_late': finable_days_late
-            }
-            ranking = sponsor.rankings.filter(
-                date=sponsor.updated_date)
-            if len(ranking) == 0:
-                ranking = sponsor.rankings.create(**d)
-            else:
-                assert len(ranking) == 1
-                ranking.update(**d)
-        _compute_ranks()
+        sponsors = None
+        if changed_sponsors is not None:
+            sponsors = carry_forward_rankings(list(changed_sponsors))
+        if in_sql:
+            _set_rankings_in_sql(sponsors)
+            if sponsors is not None:
+                _compute_ranks()
+        else:
+            _upsert_rankings(_ranking_statistics(sponsors))
+            _compute_ranks()
+
+
+def _upsert_rankings(statistics):
+    rows = []
+    for sponsor in statistics:
+        rows.append(
+            [sponsor['pk'], sponsor['updated_date'],
+             Ranking.compute_percentage(sponsor['reported'], sponsor['due'])] +
+            [sponsor[column] for column in RANKING_COLUMNS])
+    if not rows:
+        return
+    with connection.cursor() as c:
+        execute_values(
+            c.cursor,
+            "INSERT INTO frontend_ranking "
+            "(sponsor_id, date, percentage, {}) VALUES %s "
+            "ON CONFLICT (sponsor_id, date) DO UPDATE SET "
+            "percentage = EXCLUDED.percentage, {}".format(
+                ", ".join(RANKING_COLUMNS),
+                ", ".join("{0} = EXCLUDED.{0}".format(column)
+                          for column in RANKING_COLUMNS)),
+            rows,
+            page_size=len(rows))
+
+
+def carry_forward_rankings(changed):
+    """Copy the latest earlier ranking of each sponsor not in `changed`
+    to the sponsor's current date, unless it already has a ranking on
+    that date.  Returns the slugs of sponsors which still need ranking:
+    those in `changed`, and any with neither an earlier nor a current
+    ranking.
+
+    """
+    columns = ", ".join(RANKING_COLUMNS)
+    with connection.cursor() as c:
+        c.execute(
+            "INSERT INTO frontend_ranking "
+            "(sponsor_id, date, rank, percentage, {0}) "
+            "SELECT DISTINCT ON (ranking.sponsor_id) ranking.sponsor_id, "
+            "sponsor.updated_date, rank, percentage, {0} "
+            "FROM frontend_ranking ranking "
+            "JOIN frontend_sponsor sponsor ON sponsor.slug = ranking.sponsor_id "
+            "WHERE ranking.date < sponsor.updated_date "
+            "AND NOT (sponsor.slug = ANY(%(changed)s::text[])) "
+            "AND NOT EXISTS (SELECT 1 FROM frontend_ranking current "
+            "  WHERE current.sponsor_id = sponsor.slug "
+            "  AND current.date = sponsor.updated_date) "
+            "ORDER BY ranking.sponsor_id, ranking.date DESC".format(columns),
+            {'changed': changed})
+        carried = c.rowcount
+        c.execute(
+            "SELECT slug FROM frontend_sponsor sponsor "
+            "WHERE slug = ANY(%(changed)s::text[]) "
+            "OR NOT EXISTS (SELECT 1 FROM frontend_ranking current "
+            "  WHERE current.sponsor_id = sponsor.slug "
+            "  AND current.date = sponsor.updated_date)",
+            {'changed': changed})
+        stale = [row[0] for row in c.fetchall()]
+    logger.info("Carried forward %s rankings; %s sponsors to rank",
+                carried, len(stale))
+    return stale
+
+
+def _set_rankings_in_sql(sponsors=None):
+    """The equivalent of `set_current_rankings`, as one statement: the
+    statistics, percentage (as `Ranking.compute_percentage`) and rank
+    (as `_compute_ranks`) of each sponsor are computed by a grouped
+    query and upserted.
+
+    Only rankings on the latest date with a percentage are ranked;
+    others keep any rank they already had.  If `sponsors` is given,
+    only sponsors with those slugs are ranked (and only among
+    themselves).
+
+    """
+    due = (Trial.STATUS_OVERDUE, Trial.STATUS_REPORTED,
+           Trial.STATUS_REPORTED_LATE, Trial.STATUS_OVERDUE_CANCELLED)
+    params = {
+        'due': due,
+        'reported': (Trial.STATUS_REPORTED, Trial.STATUS_REPORTED_LATE),
+        'reported_late': (Trial.STATUS_REPORTED_LATE,),
+        'reported_on_time': (Trial.STATUS_REPORTED,),
+        'overdue': (Trial.STATUS_OVERDUE, Trial.STATUS_OVERDUE_CANCELLED),
+        'no_longer_act': Trial.STATUS_NO_LONGER_ACT,
+        'sponsors': sponsors,
+    }
+    counts = ", ".join(
+        "COUNT(trial.id) FILTER (WHERE trial.status IN %({0})s) AS {0}".format(
+            column)
+        for column in ['due', 'reported', 'reported_late', 'reported_on_time',
+                       'overdue'])
+    with connection.cursor() as c:
+        c.execute(
+            "WITH statistics AS ("
+            "  SELECT sponsor.slug AS sponsor_id, sponsor.updated_date AS date, "
+            "  " + counts + ", "
+            "  COUNT(trial.id) FILTER (WHERE trial.status <> %(no_longer_act)s) "
+            "    AS total, "
+            "  SUM(trial.days_late) FILTER ("
+            "    WHERE trial.status <> %(no_longer_act)s) AS days_late, "
+            "  SUM(trial.finable_days_late) FILTER ("
+            "    WHERE trial.status <> %(no_longer_act)s) AS finable_days_late "
+            "  FROM frontend_sponsor sponsor "
+            "  LEFT JOIN frontend_trial trial ON trial.sponsor_id = sponsor.slug "
+            "  WHERE %(sponsors)s::text[] IS NULL "
+            "  OR sponsor.slug = ANY(%(sponsors)s::text[]) "
+            "  GROUP BY sponsor.slug"
+            "), percentages AS ("
+            "  SELECT *, CASE WHEN due > 0 THEN reported * 100 / due END "
+            "  AS percentage, "
+            "  date = (SELECT MAX(updated_date) FROM frontend_sponsor) "
+            "  AS current "
+            "  FROM statistics"
+            ") "
+            "INSERT INTO frontend_ranking "
+            "(sponsor_id, date, {0}, percentage, rank) "
+            "SELECT sponsor_id, date, {0}, percentage, "
+            "CASE WHEN current AND percentage IS NOT NULL THEN RANK() OVER ("
+            "  PARTITION BY current AND percentage IS NOT NULL "
+            "  ORDER BY percentage DESC"
+            ") END "
+            "FROM percentages "
+            "ON CONFLICT (sponsor_id, date) DO UPDATE SET {1}, "
+            "percentage = EXCLUDED.percentage, "
+            "rank = COALESCE(EXCLUDED.rank, frontend_ranking.rank)".format(
+                ", ".join(RANKING_COLUMNS),
+                ", ".join("{0} = EXCLUDED.{0}".format(column)
+                          for column in RANKING_COLUMNS)),
+            params)
+        logger.info("Ranked %s sponsors", c.rowcount)
+
+
+def set_daily_summaries(today):
+    """Replace the `DailySummary` of all trials, and of each sponsor's,
+    with their current performance metrics.  Per-sponsor metrics are
+    computed in a single grouped query, and summed for the total.
+
+    """
+    overdue = [Trial.STATUS_OVERDUE, Trial.STATUS_OVERDUE_CANCELLED]
+    statistics = Trial.objects.exclude(
+        status=Trial.STATUS_NO_LONGER_ACT).values('sponsor_id').annotate(
+        due=Count('pk', filter=Q(status__in=[
+            Trial.STATUS_OVERDUE, Trial.STATUS_REPORTED,
+            Trial.STATUS_REPORTED_LATE, Trial.STATUS_OVERDUE_CANCELLED])),
+        reported=Count('pk', filter=Q(status__in=[
+            Trial.STATUS_REPORTED, Trial.STATUS_REPORTED_LATE])),
+        days_late=Sum('finable_days_late'),
+        overdue_today=Count('pk', filter=Q(status__in=overdue) & ~Q(
+            previous_status__in=overdue)),
+        late_today=Count('pk', filter=Q(
+            status=Trial.STATUS_REPORTED_LATE) & ~Q(
+            previous_status=Trial.STATUS_REPORTED_LATE)),
+        on_time_today=Count('pk', filter=Q(
+            status=Trial.STATUS_REPORTED) & ~Q(
+            previous_status=Trial.STATUS_REPORTED))).order_by()
+    summaries = {row.pop('sponsor_id'): row for row in statistics}
+    total = {
+        metric: sum(summary[metric] or 0 for summary in summaries.values())
+        for metric in DailySummary.METRICS}
+    if all(summary['days_late'] is None for summary in summaries.values()):
+        total['days_late'] = None
+    empty = dict.fromkeys(DailySummary.METRICS, 0)
+    empty['days_late'] = None
+    rows = [DailySummary(sponsor_id=None, date=today, **total)]
+    for slug in Sponsor.objects.values_list('pk', flat=True):
+        rows.append(DailySummary(
+            sponsor_id=slug, date=today, **summaries.get(slug, empty)))
+    with transaction.atomic():
+        DailySummary.objects.all().delete()
+        DailySummary.objects.bulk_create(rows)
+
+
+def refresh_untouched_trials(today, delta, changed_sponsors=None):
+    """Bring trials whose studies haven't changed since the last import
+    up to date, as if they had been imported again today.
+
+    Used when importing a `delta` (a dict listing the registry ids of
+    studies which have `changed` or been `removed`), where the input CSV
+    only contains changed studies.  Most untouched trials just need
+    their dates and `previous_status` bumping; those whose status may
+    change with the passing of time are then recomputed by
+    `refresh_lateness`, which records the sponsors of those that do
+    change in `changed_sponsors`.  Both are done in bulk.
+
+    """
+    untouched = Trial.objects.filter(updated_date__lt=today) \
+                             .exclude(status=Trial.STATUS_NO_LONGER_ACT) \
+                             .exclude(registry_id__in=delta['changed']) \
+                             .exclude(registry_id__in=delta['removed'])
+    ids = list(untouched.values_list('pk', flat=True))
+    logger.info("Refreshing %s untouched trials", len(ids))
+    Sponsor.objects.filter(trial__pk__in=ids).update(updated_date=today)
+    Trial.objects.filter(pk__in=ids).update(
+        previous_status=F('status'), updated_date=today)
+    # Trials can become due without their study changing, and days
+    # late for unreported trials depends on today's date
+    refresh_lateness(today, ids, changed_sponsors)
 
 
 def truthy(val):
@@ -166,6 +402,460 @@ def truthy(val):
     return bool(int(val))
 
 
+def trial_fields(row, sponsor_slug, today):
+    """The Trial fields given by a row of the CSV generated by
+    `load_data`
+
+    """
+    d = {
+        'registry_id': row['nct_id'],
+        'publication_url': row['url'],
+        'title': row['title'],
+        'has_exemption': truthy(row['has_certificate']),
+        'has_results': truthy(row['has_results']),
+        'results_due': truthy(row['results_due']),
+        'is_pact': truthy(row['included_pact_flag']),
+        'sponsor_id': sponsor_slug,
+        'start_date': row['start_date'],
+        'first_seen_date': today,
+        'updated_date': today,
+        'reported_date': row['results_submitted_date'] or None,
+    }
+    if row['available_completion_date']:
+        d['completion_date'] = row['available_completion_date']
+    return d
+
+
+def _ranked_fields(trial):
+    """The fields of `trial` which its sponsor's ranking depends on
+    """
+    return (trial.sponsor_id, trial.status, trial.days_late,
+            trial.finable_days_late)
+
+
+def _record_change(changed_sponsors, before, trial):
+    """Add to `changed_sponsors`, if given, the sponsors `trial` was
+    ranked with (per `before`, its `_ranked_fields` before changing,
+    or None if it is new) and is now, if they differ
+    """
+    if changed_sponsors is None:
+        return
+    after = _ranked_fields(trial)
+    if before != after:
+        changed_sponsors.add(after[0])
+        if before is not None:
+            changed_sponsors.add(before[0])
+
+
+def import_trials(rows, today, changed_sponsors=None):
+    """Create or update a Sponsor and a Trial for each row of the CSV
+    generated by `load_data`.  The slugs of sponsors whose rankings
+    may have changed are added to the set `changed_sponsors`, if given.
+
+    """
+    for row in rows:
+        # Create / update sponsor
+        d = {
+            'name': row['sponsor'],
+            'is_industry_sponsor': row['sponsor_type'] == 'Industry',
+            'updated_date': today
+        }
+        sponsor, created = Sponsor.objects.get_or_create(
+            pk=slugify(row['sponsor']), defaults=d)
+        if not created:
+            sponsor.updated_date = today
+            sponsor.is_industry_sponsor = d['is_industry_sponsor']
+            sponsor.save()
+
+        # Create / update Trial
+        d = trial_fields(row, sponsor.pk, today)
+        instance, created = Trial.objects.get_or_create(
+            registry_id=row['nct_id'], defaults=d)
+        before = None
+        if not created:
+            before = _ranked_fields(instance)
+            for attr, value in d.items():
+                if attr != 'first_seen_date':
+                    setattr(instance, attr, value)
+            instance.updated_date = today
+            instance.save()
+        _record_change(changed_sponsors, before, instance)
+
+
+# Columns written by `bulk_import_trials`, all of which are
+# overwritten for existing trials except `registry_id` and
+# `first_seen_date`
+TRIAL_COLUMNS = [
+    'registry_id', 'sponsor_id', 'publication_url', 'title',
+    'has_exemption', 'is_pact', 'start_date', 'results_due', 'has_results',
+    'days_late', 'finable_days_late', 'status', 'previous_status',
+    'completion_date', 'first_seen_date', 'updated_date', 'reported_date'
+]
+
+
+def bulk_import_trials(rows, today, batch_size=None, changed_sponsors=None):
+    """Equivalent to `import_trials`, but much faster for large imports.
+
+    Existing trials (and their QA events) are loaded up front,
+    metadata is computed in memory, and Sponsors and Trials are written in batches of
+    `batch_size` rows (default `IMPORT_BATCH_SIZE`), with one
+    `INSERT ... ON CONFLICT` statement for each table.
+
+    """
+    batch_size = batch_size or settings.IMPORT_BATCH_SIZE
+    trials = {trial.registry_id: trial for trial in
+              Trial.objects.prefetch_related('trialqa_set')}
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            _import_batch(batch, trials, today, changed_sponsors)
+            batch = []
+    if batch:
+        _import_batch(batch, trials, today, changed_sponsors)
+
+
+def _import_batch(rows, trials, today, changed_sponsors=None):
+    # Keyed by slug and registry id respectively, so that repeats in
+    # a batch are written once, with the same end result as saving
+    # each row in turn
+    sponsors = collections.OrderedDict()
+    changed = collections.OrderedDict()
+    for row in rows:
+        slug = slugify(row['sponsor'])
+        name = sponsors[slug][0] if slug in sponsors else row['sponsor']
+        sponsors[slug] = (name, row['sponsor_type'] == 'Industry')
+
+        d = trial_fields(row, slug, today)
+        trial = trials.get(row['nct_id'])
+        before = None
+        if trial is None:
+            trial = Trial(**d)
+            trials[trial.registry_id] = trial
+        else:
+            before = _ranked_fields(trial)
+            for attr, value in d.items():
+                if attr != 'first_seen_date':
+                    setattr(trial, attr, value)
+        compute_metadata(trial)
+        _record_change(changed_sponsors, before, trial)
+        changed[trial.registry_id] = trial
+
+    with connection.cursor() as c:
+        execute_values(
+            c.cursor,
+            "INSERT INTO frontend_sponsor "
+            "(slug, name, is_industry_sponsor, updated_date) VALUES %s "
+            "ON CONFLICT (slug) DO UPDATE SET "
+            "is_industry_sponsor = EXCLUDED.is_industry_sponsor, "
+            "updated_date = EXCLUDED.updated_date",
+            [(slug, name, is_industry_sponsor, today)
+             for slug, (name, is_industry_sponsor) in sponsors.items()],
+            page_size=len(sponsors))
+        updates = ", ".join(
+            "{0} = EXCLUDED.{0}".format(column) for column in TRIAL_COLUMNS
+            if column not in ('registry_id', 'first_seen_date'))
+        execute_values(
+            c.cursor,
+            "INSERT INTO frontend_trial ({}) VALUES %s "
+            "ON CONFLICT (registry_id) DO UPDATE SET {}".format(
+                ", ".join(TRIAL_COLUMNS), updates),
+            [[getattr(trial, column) for column in TRIAL_COLUMNS]
+             for trial in changed.values()],
+            page_size=len(changed))
+    logger.info("Imported %s trials", len(changed))
+
+
+# An unlogged table that `process_data --copy` loads the CSV into
+STAGING_TABLE = 'frontend_import_staging'
+
+
+def copy_to_staging(f):
+    """Load the CSV file `f` into `STAGING_TABLE`, which has a text column
+    for each column in the CSV, plus `line` (the order of rows in the
+    file) and `sponsor_slug`.
+
+    """
+    columns = next(csv.reader([f.readline()]))
+    f.seek(0)
+    with connection.cursor() as c:
+        c.execute("DROP TABLE IF EXISTS {}".format(STAGING_TABLE))
+        c.execute(
+            "CREATE UNLOGGED TABLE {} "
+            "(line serial, sponsor_slug text, {})".format(
+                STAGING_TABLE,
+                ", ".join('"{}" text'.format(column) for column in columns)))
+        c.cursor.copy_expert(
+            "COPY {} ({}) FROM STDIN WITH (FORMAT csv, HEADER true)".format(
+                STAGING_TABLE,
+                ", ".join('"{}"'.format(column) for column in columns)),
+            f)
+        c.execute("CREATE INDEX ON {} (nct_id)".format(STAGING_TABLE))
+        c.execute("ANALYZE {}".format(STAGING_TABLE))
+        # Slugs must match Django's `slugify`, so are computed here,
+        # once per sponsor
+        c.execute("SELECT DISTINCT sponsor FROM {}".format(STAGING_TABLE))
+        names = [name for name, in c.fetchall()]
+        execute_values(
+            c.cursor,
+            "UPDATE {} SET sponsor_slug = v.slug "
+            "FROM (VALUES %s) AS v (name, slug) "
+            "WHERE sponsor = v.name".format(STAGING_TABLE),
+            [(name, slugify(name)) for name in names],
+            page_size=max(len(names), 1))
+        c.execute("SELECT count(*) FROM {}".format(STAGING_TABLE))
+        logger.info("Staged %s rows", c.fetchone()[0])
+
+
+def merge_staging(today, changed_sponsors=None):
+    """Create or update Sponsors and Trials from `STAGING_TABLE`, with the
+    same results as `import_trials`.
+
+    A sponsor keeps the name it was first created with, and takes
+    its industry status from the last row naming it; a trial's
+    current status is carried over to `previous_status`.  Days late
+    and status are computed afterwards, by `compute_staged_metadata`,
+    which records changes to them in `changed_sponsors`; the sponsors
+    of new trials, and both sponsors of trials which change sponsor,
+    are recorded here.
+
+    """
+    with connection.cursor() as c:
+        if changed_sponsors is not None:
+            c.execute(
+                "SELECT DISTINCT trial.sponsor_id, staged.sponsor_slug "
+                "FROM {} staged LEFT JOIN frontend_trial trial "
+                "ON trial.registry_id = staged.nct_id "
+                "WHERE trial.sponsor_id IS DISTINCT FROM "
+                "staged.sponsor_slug".format(STAGING_TABLE))
+            for before, after in c.fetchall():
+                changed_sponsors.update(
+                    slug for slug in (before, after) if slug is not None)
+        c.execute(
+            "WITH staged AS ("
+            "  SELECT sponsor_slug, sponsor, sponsor_type, line FROM {0}), "
+            "first AS (SELECT DISTINCT ON (sponsor_slug) sponsor_slug, sponsor "
+            "  FROM staged ORDER BY sponsor_slug, line), "
+            "last AS (SELECT DISTINCT ON (sponsor_slug) sponsor_slug, sponsor_type "
+            "  FROM staged ORDER BY sponsor_slug, line DESC) "
+            "INSERT INTO frontend_sponsor "
+            "(slug, name, is_industry_sponsor, updated_date) "
+            "SELECT sponsor_slug, sponsor, sponsor_type = 'Industry', %s "
+            "FROM first JOIN last USING (sponsor_slug) "
+            "ON CONFLICT (slug) DO UPDATE SET "
+            "is_industry_sponsor = EXCLUDED.is_industry_sponsor, "
+            "updated_date = EXCLUDED.updated_date".format(STAGING_TABLE),
+            [today])
+        c.execute(
+            "INSERT INTO frontend_trial "
+            "(registry_id, sponsor_id, publication_url, title, "
+            "has_exemption, has_results, results_due, is_pact, start_date, "
+            "completion_date, reported_date, first_seen_date, updated_date, "
+            "status, previous_status) "
+            "SELECT DISTINCT ON (nct_id) nct_id, sponsor_slug, url, title, "
+            "has_certificate::integer::boolean, "
+            "has_results::integer::boolean, "
+            "results_due::integer::boolean, "
+            "included_pact_flag::integer::boolean, "
+            "start_date::date, "
+            "NULLIF(available_completion_date, '')::date, "
+            "NULLIF(results_submitted_date, '')::date, "
+            "%s, %s, %s, %s "
+            "FROM {} ORDER BY nct_id, line DESC "
+            "ON CONFLICT (registry_id) DO UPDATE SET "
+            "sponsor_id = EXCLUDED.sponsor_id, "
+            "publication_url = EXCLUDED.publication_url, "
+            "title = EXCLUDED.title, "
+            "has_exemption = EXCLUDED.has_exemption, "
+            "has_results = EXCLUDED.has_results, "
+            "results_due = EXCLUDED.results_due, "
+            "is_pact = EXCLUDED.is_pact, "
+            "start_date = EXCLUDED.start_date, "
+            "completion_date = COALESCE("
+            "  EXCLUDED.completion_date, frontend_trial.completion_date), "
+            "reported_date = EXCLUDED.reported_date, "
+            "updated_date = EXCLUDED.updated_date, "
+            "previous_status = frontend_trial.status".format(STAGING_TABLE),
+            [today, today, Trial.STATUS_ONGOING, Trial.STATUS_ONGOING])
+        logger.info("Merged %s trials", c.rowcount)
+
+
+def compute_staged_metadata(changed_sponsors=None):
+    """Compute days late and status for every trial in `STAGING_TABLE`,
+    writing them back in a single statement.  The slugs of sponsors of
+    trials whose days late or status change are added to the set
+    `changed_sponsors`, if given.
+
+    """
+    staged = Trial.objects.filter(registry_id__in=RawSQL(
+        "SELECT nct_id FROM {}".format(STAGING_TABLE), []))
+    trials = list(staged.values_list(
+        'pk', 'completion_date', 'has_exemption', 'results_due',
+        'has_results', 'reported_date', 'status', 'days_late',
+        'finable_days_late', 'sponsor_id'))
+    if not trials:
+        return
+    events = collections.defaultdict(list)
+    for event in TrialQA.objects.filter(trial__in=staged).only(
+            'trial_id', 'submitted_to_regulator', 'cancelled_by_sponsor'):
+        events[event.trial_id].append(event)
+    (pks, completion, exemption, due, reported, reported_on, statuses,
+     old_days_late, old_finable_days_late, sponsors) = zip(*trials)
+    started, cancelled, restarted = zip(*[
+        qa_start_dates(None, events[pk]) for pk in pks])
+    days_late, finable_days_late, new_statuses = compute_batch(
+        completion, exemption, due, reported, reported_on, started,
+        cancelled, restarted)
+    if changed_sponsors is not None:
+        changed_sponsors.update(
+            sponsor for sponsor, before, after in zip(
+                sponsors,
+                zip(statuses, old_days_late, old_finable_days_late),
+                zip(new_statuses, days_late, finable_days_late))
+            if before != after)
+    values = list(zip(
+        pks, days_late, finable_days_late, new_statuses, statuses))
+    with connection.cursor() as c:
+        execute_values(
+            c.cursor,
+            "UPDATE frontend_trial SET "
+            "days_late = v.days_late, "
+            "finable_days_late = v.finable_days_late, "
+            "status = v.status, "
+            "previous_status = v.previous_status "
+            "FROM (VALUES %s) "
+            "AS v (id, days_late, finable_days_late, status, previous_status) "
+            "WHERE frontend_trial.id = v.id",
+            values,
+            template="(%s, %s::integer, %s::integer, %s, %s)",
+            page_size=max(len(values), 1))
+
+
+def mark_unstaged_zombies(today, changed_sponsors=None):
+    """Mark trials which are not in `STAGING_TABLE` as no longer ACTs,
+    adding their sponsors' slugs to the set `changed_sponsors`, if
+    given.
+
+    Trials brought up to date by `refresh_untouched_trials` are
+    excluded by their `updated_date`.
+
+    """
+    with connection.cursor() as c:
+        c.execute(
+            "UPDATE frontend_trial SET status = %s, updated_date = %s "
+            "WHERE status <> %s AND updated_date < %s "
+            "AND NOT EXISTS "
+            "(SELECT 1 FROM {} WHERE nct_id = frontend_trial.registry_id) "
+            "RETURNING sponsor_id".format(STAGING_TABLE),
+            [Trial.STATUS_NO_LONGER_ACT, today, Trial.STATUS_NO_LONGER_ACT,
+             today])
+        logger.info("Marked %s zombie trials", c.rowcount)
+        if changed_sponsors is not None:
+            changed_sponsors.update(row[0] for row in c.fetchall())
+
+
+def drop_staging():
+    with connection.cursor() as c:
+        c.execute("DROP TABLE IF EXISTS {}".format(STAGING_TABLE))
+
+
+def stream_rows(stream, tee=None):
+    """Parse the CSV lines of a `StudyStream` of classified studies into
+    rows in the same form as the CSV generated by `load_data`, as they
+    become available.  Lines are also written to the file `tee`, if
+    given.
+
+    """
+    lines = stream
+    if tee is not None:
+        tee.write(','.join(act_classifier.COLUMNS) + "\n")
+        lines = _tee(stream, tee)
+    return csv.DictReader(lines, fieldnames=act_classifier.COLUMNS)
+
+
+def _tee(lines, f):
+    for line in lines:
+        f.write(line)
+        yield line
+
+
+def finish_import(today, staged=False, qa_workers=None, qa_batch_size=None,
+                  qa_cache=None, sql_rankings=False, changed_sponsors=None):
+    """The stages of an import after trials have been created or
+    updated: checking QA status, retiring trials which have
+    disappeared, ranking sponsors, and summarising performance.  The
+    rankings and summaries change, along with the data version of
+    cached pages, in a single transaction.
+
+    If `staged`, the import was loaded into `STAGING_TABLE`, which is
+    used to find trials which have disappeared.  `qa_workers` is the
+    number of concurrent requests made for QA metadata,
+    `qa_batch_size` the number of trials to ask for in each, and
+    `qa_cache` the path of a `QACache` used to skip trials whose QA
+    history hasn't changed since the last import.  If `sql_rankings`,
+    rankings are computed in a single SQL statement.  If
+    `changed_sponsors` is given, it is the set of slugs of sponsors
+    whose trials the import has changed (see `Command.handle`); the
+    sponsors of trials changed here are added to it, and only these
+    sponsors are re-ranked.
+
+    """
+    # Now scrape trials that might be in QA (these would be
+    # flagged as having no results, but if in QA we consider
+    # them submitted until QA finishes)
+    possible_results = {
+        trial.registry_id: trial for trial in
+        Trial.objects.filter(results_due=True, has_results=False).annotate(
+            qa_count=Count('trialqa'))}
+    logger.info("Scraping %s trials for QA metadata", len(possible_results))
+    cache = QACache(qa_cache) if qa_cache else None
+    # Studies are fetched concurrently, but written one at a time
+    fetcher = registry_api.StudyFetcher(workers=qa_workers, cache=cache)
+    if qa_batch_size is None:
+        qa_batch_size = settings.QA_API_BATCH_SIZE
+    try:
+        for registry_id, content in fetcher.fetch_many(
+                possible_results, batch_size=qa_batch_size):
+            trial = possible_results[registry_id]
+            if cache is not None:
+                digest = qa_digest(content)
+                if cache.is_unchanged(registry_id, digest, trial.qa_count):
+                    continue
+            set_qa_metadata(trial, content)
+            if changed_sponsors is not None:
+                changed_sponsors.add(trial.sponsor_id)
+            if cache is not None:
+                cache.record(registry_id, digest, trial.trialqa_set.count())
+    finally:
+        if cache is not None:
+            cache.close()
+
+    # Update the status of trials that no longer appear in the
+    # dataset. When importing a delta, untouched trials have
+    # already been marked as updated today, so this only catches
+    # changed or removed studies that are no longer ACTs
+    if staged:
+        mark_unstaged_zombies(today, changed_sponsors)
+    else:
+        zombies = Trial.objects.filter(
+            updated_date__lt=today).exclude(status=Trial.STATUS_NO_LONGER_ACT)
+        logger.info("Marking %s zombie trials", zombies.count())
+        if changed_sponsors is not None:
+            changed_sponsors.update(
+                zombies.values_list('sponsor_id', flat=True))
+        zombies.update(
+            status=Trial.STATUS_NO_LONGER_ACT, updated_date=today)
+
+    # This should only happen after Trial statuses have been set
+    logger.info("Setting current rankings")
+    with transaction.atomic():
+        set_current_rankings(
+            in_sql=sql_rankings, changed_sponsors=changed_sponsors)
+        logger.info("Setting daily summaries")
+        set_daily_summaries(today)
+        bump_data_version()
+
+
 class Command(BaseCommand):
     help = '''Import a CSV that has been generated by the `load_data.py` script.
 
@@ -175,70 +865,155 @@ class Command(BaseCommand):
         parser.add_argument(
             '--input-csv',
             type=str)
+        parser.add_argument(
+            '--delta',
+            type=str,
+            help='JSON file listing the `changed` and `removed` studies '
+                 'since the last import, when the CSV only contains '
+                 'changed studies. Other trials are left untouched.')
+        parser.add_argument(
+            '--input-zip',
+            type=str,
+            help='Classify and import studies directly from a registry '
+                 'zip, instead of a CSV. Digests of the studies are saved '
+                 'as the pending manifest (see `load_data`).')
+        parser.add_argument(
+            '--workers',
+            type=int,
+            help='With --input-zip, number of processes used to '
+                 'classify studies (default: settings.CONVERSION_WORKERS)')
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            help='With --input-zip, only import studies which have '
+                 'changed since the last successful run')
+        parser.add_argument(
+            '--tee-csv',
+            type=str,
+            help='With --input-zip, also write the imported rows to this '
+                 'CSV file')
+        parser.add_argument(
+            '--bulk',
+            action='store_true',
+            help='Write trials and sponsors in batches, rather than '
+                 'saving them one at a time')
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            help='With --bulk, number of rows written at a time '
+                 '(default: settings.IMPORT_BATCH_SIZE)')
+        parser.add_argument(
+            '--copy',
+            action='store_true',
+            help='Load the CSV into a staging table with COPY, and merge '
+                 'it with set-based SQL')
+        parser.add_argument(
+            '--qa-workers',
+            type=int,
+            help='Number of concurrent requests for QA metadata '
+                 '(default: settings.QA_FETCH_WORKERS)')
+        parser.add_argument(
+            '--qa-batch-size',
+            type=int,
+            help='Number of trials to ask for in each request for QA '
+                 'metadata; 0 fetches each separately '
+                 '(default: settings.QA_API_BATCH_SIZE)')
+        parser.add_argument(
+            '--qa-cache',
+            type=str,
+            help='SQLite file caching QA metadata between imports, so '
+                 'requests can be conditional and trials whose QA '
+                 'history is unchanged are skipped')
+        parser.add_argument(
+            '--sql-rankings',
+            action='store_true',
+            help='Compute sponsor rankings in a single SQL statement')
+        parser.add_argument(
+            '--incremental-rankings',
+            action='store_true',
+            help='Only re-rank sponsors whose trials are added, changed '
+                 'or retired by the import, carrying forward the rankings '
+                 'of the rest')
+        parser.add_argument(
+            '--write-exports',
+            action='store_true',
+            help='Write CSV exports of the API to settings.EXPORT_ROOT '
+                 'once the import has finished')
+
+    def import_trials(self, rows, today, options):
+        if options['bulk']:
+            bulk_import_trials(
+                rows, today, options['batch_size'], self.changed_sponsors)
+        else:
+            import_trials(rows, today, self.changed_sponsors)
+
+    def finish_import(self, today, options, staged=False):
+        finish_import(
+            today, staged=staged, qa_workers=options['qa_workers'],
+            qa_batch_size=options['qa_batch_size'],
+            qa_cache=options['qa_cache'],
+            sql_rankings=options['sql_rankings'],
+            changed_sponsors=self.changed_sponsors)
+        if options['write_exports']:
+            exports.write_exports()
 
     def handle(self, *args, **options):
+        # With --incremental-rankings, every stage of the import adds
+        # the slugs of sponsors whose trials it changes to this set
+        self.changed_sponsors = None
+        if options['incremental_rankings']:
+            self.changed_sponsors = set()
+        if options['input_zip']:
+            self.handle_zip(**options)
+            return
         f = open(options['input_csv'])
+        delta = None
+        if options['delta']:
+            with open(options['delta']) as delta_file:
+                delta = json.load(delta_file)
         logger.info("Creating new trials and sponsors from %s", options['input_csv'])
+        # We don't use auto_now on models for `today`, purely so
+        # we can mock this in tests.
+        today = date.today()
+        if options['copy']:
+            try:
+                with transaction.atomic():
+                    copy_to_staging(f)
+                    merge_staging(today, self.changed_sponsors)
+                    compute_staged_metadata(self.changed_sponsors)
+                    if delta is not None:
+                        refresh_untouched_trials(
+                            today, delta, self.changed_sponsors)
+                self.finish_import(today, options, staged=True)
+            finally:
+                drop_staging()
+            return
         with transaction.atomic():
-            # We don't use auto_now on models for `today`, purely so
-            # we can mock this in tests.
-            today = date.today()
-            for row in csv.DictReader(f):
-                # Create / update sponsor
-                d = {
-                    'name': row['sponsor'],
-                    'is_industry_sponsor': row['sponsor_type'] == 'Industry',
-                    'updated_date': today
-                }
-                sponsor, created = Sponsor.objects.get_or_create(
-                    pk=slugify(row['sponsor']), defaults=d)
-                if not created:
-                    sponsor.updated_date = today
-                    sponsor.is_industry_sponsor = d['is_industry_sponsor']
-                    sponsor.save()
-
-                # Create / update Trial
-                d = {
-                    'registry_id': row['nct_id'],
-                    'publication_url': row['url'],
-                    'title': row['title'],
-                    'has_exemption': truthy(row['has_certificate']),
-                    'has_results': truthy(row['has_results']),
-                    'results_due': truthy(row['results_due']),
-                    'is_pact': truthy(row['included_pact_flag']),
-                    'sponsor_id': sponsor.pk,
-                    'start_date': row['start_date'],
-                    'first_seen_date': today,
-                    'updated_date': today,
-                    'reported_date': row['results_submitted_date'] or None,
-                }
-                if row['available_completion_date']:
-                    d['completion_date'] = row['available_completion_date']
-                instance, created = Trial.objects.get_or_create(
-                    registry_id=row['nct_id'], defaults=d)
-                if not created:
-                    for attr, value in d.items():
-                        if attr != 'first_seen_date':
-                            setattr(instance, attr, value)
-                    instance.updated_date = today
-                    instance.save()
-
-
-        # Now scrape trials that might be in QA (these would be
-        # flagged as having no results, but if in QA we consider
-        # them submitted until QA finishes)
-        possible_results = Trial.objects.filter(results_due=True, has_results=False)
-        logger.info("Scraping %s trials for QA metadata", possible_results.count())
-        for trial in possible_results:
-            set_qa_metadata(trial)
-
-        # Update the status of trials that no longer appear in the dataset
-        zombies = Trial.objects.filter(
-            updated_date__lt=today).exclude(status=Trial.STATUS_NO_LONGER_ACT)
-        logger.info("Marking %s zombie trials", zombies.count())
-        zombies.update(
-            status=Trial.STATUS_NO_LONGER_ACT, updated_date=today)
+            self.import_trials(csv.DictReader(f), today, options)
+            if delta is not None:
+                refresh_untouched_trials(today, delta, self.changed_sponsors)
+        self.finish_import(today, options)
 
-        # This should only happen after Trial statuses have been set
-        logger.info("Setting current rankings")
-        set_current_rankings()
+    def handle_zip(self, **options):
+        manifest = None
+        if options['incremental']:
+            manifest = load_data.load_manifest()
+            if manifest is None:
+                logger.info("No manifest from a previous run; "
+                            "importing everything")
+        logger.info("Creating new trials and sponsors from %s", options['input_zip'])
+        today = date.today()
+        stream = load_data.StudyStream(
+            options['input_zip'], classify=load_data.local_classification(today),
+            workers=options['workers'], manifest=manifest)
+        with contextlib.ExitStack() as stack:
+            tee = None
+            if options['tee_csv']:
+                tee = stack.enter_context(open(options['tee_csv'], 'w'))
+            with transaction.atomic():
+                self.import_trials(stream_rows(stream, tee), today, options)
+                if stream.delta is not None:
+                    refresh_untouched_trials(
+                        today, stream.delta, self.changed_sponsors)
+        load_data.save_manifest(stream.digests)
+        self.finish_import(today, options)
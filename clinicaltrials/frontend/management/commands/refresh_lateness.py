@@ -0,0 +1,39 @@
+from datetime import date
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+
+from frontend import exports
+from frontend.data_cache import bump_data_version
+from frontend.trial_computer import refresh_lateness
+from frontend.management.commands.process_data import set_current_rankings
+from frontend.management.commands.process_data import set_daily_summaries
+from frontend.models import Sponsor
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = '''Bring days late and status up to date for trials whose
+    lateness depends on today's date, without running an import, and
+    re-rank sponsors and rewrite the exports to match.
+    '''
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            today = date.today()
+            refreshed = refresh_lateness(today)
+            # Rank the sponsors of the last import again as at today,
+            # leaving that day's rankings as they were
+            latest = Sponsor.objects.aggregate(
+                latest=Max('updated_date'))['latest']
+            Sponsor.objects.filter(updated_date=latest).update(
+                updated_date=today)
+            set_current_rankings()
+            set_daily_summaries(today)
+            bump_data_version()
+        logger.info("Refreshed lateness of %s trials", refreshed)
+        exports.write_exports()
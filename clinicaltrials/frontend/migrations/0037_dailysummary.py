@@ -0,0 +1,28 @@
+# Generated by Django 2.1.7 on 2019-03-04 10:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('frontend', '0036_merge_20181211_1423'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('due', models.IntegerField()),
+                ('reported', models.IntegerField()),
+                ('days_late', models.IntegerField(null=True)),
+                ('overdue_today', models.IntegerField()),
+                ('late_today', models.IntegerField()),
+                ('on_time_today', models.IntegerField()),
+                ('sponsor', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='daily_summaries', to='frontend.Sponsor')),
+            ],
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 2.1.7 on 2019-03-06 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('frontend', '0037_dailysummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportGeneration',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.1.7 on 2019-03-08 11:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('frontend', '0038_importgeneration'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ranking',
+            index=models.Index(fields=['date', 'due', 'id'], name='ranking_due_keyset'),
+        ),
+        migrations.AddIndex(
+            model_name='ranking',
+            index=models.Index(fields=['date', 'reported', 'id'], name='ranking_reported_keyset'),
+        ),
+        migrations.AddIndex(
+            model_name='ranking',
+            index=models.Index(fields=['date', 'percentage', 'id'], name='ranking_percentage_keyset'),
+        ),
+        migrations.AddIndex(
+            model_name='trial',
+            index=models.Index(fields=['completion_date', 'start_date', 'id'], name='trial_completion_keyset'),
+        ),
+        migrations.AddIndex(
+            model_name='trial',
+            index=models.Index(fields=['status', 'id'], name='trial_status_keyset'),
+        ),
+        migrations.AddIndex(
+            model_name='trial',
+            index=models.Index(fields=['days_late', 'id'], name='trial_days_late_keyset'),
+        ),
+    ]
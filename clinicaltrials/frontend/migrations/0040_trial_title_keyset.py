@@ -0,0 +1,17 @@
+# Generated by Django 2.1.7 on 2019-03-11 10:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('frontend', '0039_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='trial',
+            index=models.Index(fields=['title', 'id'], name='trial_title_keyset'),
+        ),
+    ]
@@ -1,6 +1,5 @@
 from datetime import date
 from datetime import timedelta
-from dateutil.relativedelta import relativedelta
 
 from django.db import connection
 from django.db import models
@@ -11,7 +10,9 @@ from django.db.models import Sum
 from django.utils.text import slugify
 from django.urls import reverse
 
+from frontend.data_cache import current_data_date
 from frontend.trial_computer import compute_metadata
+from frontend.trial_computer import due_date
 
 
 class Sponsor(models.Model):
@@ -105,7 +106,7 @@ class TrialQuerySet(models.QuerySet):
         # becomes no-longer-overdue, we stop updating it. Therefore,
         # this query has to search non-current trials and filter by
         # date, explicitly.
-        today = Ranking.objects.latest('date').date
+        today = current_data_date()
         return self.filter(previous_status__in=[
                        Trial.STATUS_OVERDUE, Trial.STATUS_OVERDUE_CANCELLED]) \
                    .filter(updated_date=today) \
@@ -167,6 +168,16 @@ class Trial(models.Model):
 
     class Meta:
         ordering = ('completion_date', 'start_date', 'id')
+        # For keyset pagination of the API in its default ordering, and
+        # by the `ordering_fields` of `TrialViewSet` on this table
+        indexes = [
+            models.Index(fields=['completion_date', 'start_date', 'id'],
+                         name='trial_completion_keyset'),
+            models.Index(fields=['status', 'id'], name='trial_status_keyset'),
+            models.Index(fields=['days_late', 'id'],
+                         name='trial_days_late_keyset'),
+            models.Index(fields=['title', 'id'], name='trial_title_keyset'),
+        ]
 
     def __str__(self):
         return "{}: {}".format(self.registry_id, self.title)
@@ -175,9 +186,7 @@ class Trial(models.Model):
         return reverse('views.trial', args=[self.registry_id])
 
     def calculated_due_date(self):
-        if self.has_exemption:
-            return self.completion_date + relativedelta(years=3)
-        return self.completion_date + relativedelta(days=365)
+        return due_date(self.completion_date, self.has_exemption)
 
     def calculated_reported_date(self):
         if self.reported_date:
@@ -259,11 +268,66 @@ class Ranking(models.Model):
     def __str__(self):
         return "{}: {} at {}% on {}".format(self.rank, self.sponsor, self.percentage, self.date)
 
+    @staticmethod
+    def compute_percentage(reported, due):
+        """The (truncated) percentage of due trials which have reported;
+        the same as the calculation in `set_current_rankings`
+        """
+        if not due:
+            return None
+        return reported * 100 // due
+
     def save(self, *args, **kwargs):
-        if self.due:
-            self.percentage = float(self.reported)/self.due * 100
+        self.percentage = self.compute_percentage(self.reported, self.due)
         super(Ranking, self).save(*args, **kwargs)
 
     class Meta:
         unique_together = ('sponsor', 'date',)
         ordering = ('date', 'rank', 'sponsor__name',)
+        # For keyset pagination of the current rankings by the
+        # `ordering_fields` of `RankingViewSet` on this table
+        indexes = [
+            models.Index(fields=['date', 'due', 'id'],
+                         name='ranking_due_keyset'),
+            models.Index(fields=['date', 'reported', 'id'],
+                         name='ranking_reported_keyset'),
+            models.Index(fields=['date', 'percentage', 'id'],
+                         name='ranking_percentage_keyset'),
+        ]
+
+
+class DailySummary(models.Model):
+    """The top-line performance metrics of all visible trials (when
+    `sponsor` is null) or of one sponsor's, as of the last import; see
+    `views.get_performance`.
+
+    """
+    METRICS = ('due', 'reported', 'days_late', 'overdue_today',
+               'late_today', 'on_time_today')
+
+    sponsor = models.ForeignKey(
+        Sponsor, null=True, related_name='daily_summaries',
+        on_delete=models.CASCADE)
+    date = models.DateField()
+    due = models.IntegerField()
+    reported = models.IntegerField()
+    # The sum of `finable_days_late`
+    days_late = models.IntegerField(null=True)
+    overdue_today = models.IntegerField()
+    late_today = models.IntegerField()
+    on_time_today = models.IntegerField()
+
+    def __str__(self):
+        return "{} on {}".format(self.sponsor or "All sponsors", self.date)
+
+
+class ImportGeneration(models.Model):
+    """A row is added each time an import (or a refresh of lateness)
+    has finished changing the data; the latest is part of the version
+    which cached pages are keyed on (see `data_cache`).
+
+    """
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "Import {} at {}".format(self.pk, self.created)
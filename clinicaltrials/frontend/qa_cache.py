@@ -0,0 +1,164 @@
+"""An on-disk cache of the QA metadata fetched from the
+clinicaltrials.gov API after each import, keyed by registry id.
+
+For each trial it keeps the last response for the study (its body,
+plus the ETag and Last-Modified validators, so the next request can be
+conditional), and a digest of the submission history last written to
+the database.  Most trials' QA histories don't change from one night
+to the next, so trials whose digest is unchanged can skip the
+`TrialQA` writes, and the recomputation of the trial they trigger.
+
+The cache is a SQLite database, shared by the fetcher's threads.  Once
+it holds more than `max_entries` trials, the least recently used are
+evicted.
+
+"""
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+def qa_digest(content):
+    """A digest of everything `set_qa_metadata` uses in the QA fields
+    (see `registry_api.qa_fields`) of a study
+    """
+    try:
+        dates = content['derivedSection']['miscInfoModule'][
+            'submissionTracking']['submissionInfos']
+    except KeyError:
+        dates = None
+    serialised = json.dumps(
+        [dates, content['hasResults']], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(serialised.encode('utf8')).hexdigest()
+
+
+class QACache(object):
+    """Cached API responses and QA digests, stored at `path`.
+
+    Counts of conditional requests answered with "not modified", and of
+    trials whose QA history was unchanged, are kept for `log_stats`.
+
+    """
+    def __init__(self, path, max_entries=None):
+        self.max_entries = max_entries or settings.QA_CACHE_MAX_ENTRIES
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "registry_id TEXT PRIMARY KEY, "
+            "etag TEXT, "
+            "last_modified TEXT, "
+            "body TEXT, "
+            "digest TEXT, "
+            "qa_count INTEGER, "
+            "accessed REAL)")
+        self.requests = self.not_modified = 0
+        self.checked = self.unchanged = 0
+
+    def _execute(self, sql, params=()):
+        with self.lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def _ensure(self, registry_id):
+        self._execute(
+            "INSERT OR IGNORE INTO responses (registry_id) VALUES (?)",
+            [registry_id])
+
+    def validators(self, registry_id):
+        """Headers making a request for the study conditional on it
+        having changed since it was cached
+        """
+        rows = self._execute(
+            "SELECT etag, last_modified FROM responses "
+            "WHERE registry_id = ? AND body IS NOT NULL", [registry_id])
+        headers = {}
+        if rows:
+            etag, last_modified = rows[0]
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def response(self, registry_id):
+        """The cached body of the study, after the API has said it is
+        not modified
+        """
+        with self.lock:
+            self.requests += 1
+            self.not_modified += 1
+        rows = self._execute(
+            "SELECT body FROM responses WHERE registry_id = ?", [registry_id])
+        return json.loads(rows[0][0])
+
+    def store_response(self, registry_id, content, etag, last_modified):
+        with self.lock:
+            self.requests += 1
+        if not (etag or last_modified):
+            return
+        self._ensure(registry_id)
+        self._execute(
+            "UPDATE responses SET etag = ?, last_modified = ?, body = ?, "
+            "accessed = ? WHERE registry_id = ?",
+            [etag, last_modified, json.dumps(content), time.time(),
+             registry_id])
+
+    def is_unchanged(self, registry_id, digest, qa_count):
+        """Whether `digest` matches the QA history last written for the
+        trial, which still has the `qa_count` `TrialQA` rows it was
+        left with
+        """
+        rows = self._execute(
+            "SELECT digest, qa_count FROM responses WHERE registry_id = ?",
+            [registry_id])
+        unchanged = bool(rows) and rows[0] == (digest, qa_count)
+        self.checked += 1
+        if unchanged:
+            self.unchanged += 1
+            self._execute(
+                "UPDATE responses SET accessed = ? WHERE registry_id = ?",
+                [time.time(), registry_id])
+        return unchanged
+
+    def record(self, registry_id, digest, qa_count):
+        """Note the QA history just written for a trial
+        """
+        self._ensure(registry_id)
+        self._execute(
+            "UPDATE responses SET digest = ?, qa_count = ?, accessed = ? "
+            "WHERE registry_id = ?",
+            [digest, qa_count, time.time(), registry_id])
+
+    def evict(self):
+        """Remove the least recently used trials beyond `max_entries`
+        """
+        self._execute(
+            "DELETE FROM responses WHERE registry_id IN ("
+            "SELECT registry_id FROM responses "
+            "ORDER BY accessed DESC LIMIT -1 OFFSET ?)", [self.max_entries])
+
+    def log_stats(self):
+        if self.requests:
+            logger.info(
+                "QA cache: %s of %s requests not modified (%.0f%%)",
+                self.not_modified, self.requests,
+                100.0 * self.not_modified / self.requests)
+        if self.checked:
+            logger.info(
+                "QA cache: %s of %s trials unchanged (%.0f%%)",
+                self.unchanged, self.checked,
+                100.0 * self.unchanged / self.checked)
+
+    def close(self):
+        self.evict()
+        self.log_stats()
+        self.connection.close()
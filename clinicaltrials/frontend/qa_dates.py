@@ -0,0 +1,80 @@
+"""Parsing of the dates in the submission history of a study, as
+returned by the clinicaltrials.gov API.
+
+These are nearly always ISO dates ("2017-11-13"), which are parsed
+directly.  Anything else falls back to `dateparser`, which copes with
+free text but is orders of magnitude slower (and slow to import, so it
+is only imported when needed).  The same dates recur across many
+trials, so results are memoised.
+
+Run this module to compare the cost per date of each approach:
+
+    python -m frontend.qa_dates
+
+"""
+import datetime
+import re
+from functools import lru_cache
+
+
+ISO_DATE = re.compile(r"^(\d{4})-(\d{2})-(\d{2})$")
+
+# Text meaning the registry doesn't know a date
+UNKNOWN = "unknown"
+
+
+def _parse_free_text(text):
+    import dateparser
+    parsed = dateparser.parse(text)
+    if parsed is None:
+        return None
+    return parsed.date()
+
+
+def _parse(text):
+    if not text:
+        return None
+    match = ISO_DATE.match(text)
+    if match:
+        try:
+            return datetime.date(*map(int, match.groups()))
+        except ValueError:
+            pass
+    if UNKNOWN in text.lower():
+        return None
+    return _parse_free_text(text)
+
+
+@lru_cache(maxsize=8192)
+def parse_qa_date(text):
+    """The date represented by `text`, or None if it is empty, unknown
+    or can't be parsed
+    """
+    return _parse(text)
+
+
+def benchmark(number=2000):
+    """Print the mean time taken to parse an ISO date with `dateparser`,
+    with the fast path, and from the memo cache
+    """
+    import timeit
+    import dateparser
+    dates = [
+        (datetime.date(2017, 1, 1) + datetime.timedelta(days=i)).isoformat()
+        for i in range(number)]
+    timings = [
+        ("dateparser", lambda: [dateparser.parse(d) for d in dates]),
+        ("fast path", lambda: [_parse(d) for d in dates]),
+        ("memoised", lambda: [parse_qa_date(d) for d in dates]),
+    ]
+    parse_qa_date.cache_clear()
+    for d in dates:
+        parse_qa_date(d)
+    for name, func in timings:
+        seconds = min(timeit.repeat(func, number=1, repeat=3))
+        print("{:>12}: {:8.2f} µs per date".format(
+            name, seconds * 1e6 / number))
+
+
+if __name__ == '__main__':
+    benchmark()
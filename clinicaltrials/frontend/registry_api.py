@@ -0,0 +1,221 @@
+"""A client for the clinicaltrials.gov v2 API, used after each import to
+fetch the QA (submission tracking) history of trials whose results are
+due but not yet published.
+
+Studies are fetched concurrently by a pool of threads sharing one
+connection pool, at a limited rate, with retries (and backoff) when
+the API is overloaded.  Only the parts of each study we use are kept,
+so results can be handed to a single thread for writing to the
+database as they arrive.
+
+"""
+import collections
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+# Statuses which mean "try again later"
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# The fields requested when fetching studies in batches: the registry
+# id, plus everything `qa_fields` uses
+BATCH_FIELDS = [
+    'protocolSection.identificationModule.nctId',
+    'hasResults',
+    'derivedSection.miscInfoModule.submissionTracking',
+]
+
+# The most studies the API returns per page
+MAX_PAGE_SIZE = 1000
+
+
+class APIError(Exception):
+    pass
+
+
+class RateLimiter(object):
+    """Thread-safe limit of `rate` calls to `wait` per second
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def qa_fields(study):
+    """The parts of a study record used by `set_qa_metadata`
+    """
+    tracking = study.get('derivedSection', {}).get(
+        'miscInfoModule', {}).get('submissionTracking')
+    fields = {'hasResults': study.get('hasResults', False)}
+    if tracking is not None:
+        fields['derivedSection'] = {
+            'miscInfoModule': {'submissionTracking': tracking}}
+    return fields
+
+
+class StudyFetcher(object):
+    """Fetches study records from the API.
+
+    Args:
+        workers: number of requests in flight at once (default
+            `QA_FETCH_WORKERS`)
+        rate: maximum requests per second (default `QA_API_RATE`)
+        retries: times to retry a request which fails with a
+            connection error or one of `RETRY_STATUSES`
+        timeout: seconds to wait for the API to respond
+        base_url: URL of the studies endpoint (default
+            `CLINICALTRIALS_API_URL`)
+        cache: a `qa_cache.QACache`, used to make requests for single
+            studies conditional
+
+    """
+    def __init__(self, workers=None, rate=None, retries=5, timeout=60,
+                 base_url=None, cache=None):
+        self.workers = workers or settings.QA_FETCH_WORKERS
+        self.limiter = RateLimiter(rate or settings.QA_API_RATE)
+        self.retries = retries
+        self.timeout = timeout
+        self.base_url = (base_url or settings.CLINICALTRIALS_API_URL).rstrip('/')
+        self.cache = cache
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url, **kwargs):
+        """GET `url` and return its decoded JSON, retrying as necessary
+        """
+        return self.request(url, **kwargs).json()
+
+    def request(self, url, **kwargs):
+        """GET `url`, retrying as necessary, and return the response
+        """
+        attempt = 0
+        while True:
+            self.limiter.wait()
+            try:
+                response = self.session.get(url, timeout=self.timeout, **kwargs)
+                if response.status_code not in RETRY_STATUSES:
+                    if response.status_code >= 400:
+                        raise APIError("{} returned HTTP {}".format(
+                            url, response.status_code))
+                    return response
+                error = "HTTP {}".format(response.status_code)
+                delay = _retry_after(response)
+            except requests.RequestException as e:
+                error = e
+                delay = None
+            attempt += 1
+            if attempt > self.retries:
+                raise APIError("Giving up on {} after {} attempts ({})".format(
+                    url, attempt, error))
+            if delay is None:
+                delay = min(2 ** attempt, 60)
+            logger.warn("Error fetching %s (%s); retrying in %ss (%s/%s)",
+                        url, error, delay, attempt, self.retries)
+            time.sleep(delay)
+
+    def fetch(self, registry_id):
+        """The QA fields (see `qa_fields`) of a single study
+        """
+        url = "{}/{}".format(self.base_url, registry_id)
+        if self.cache is None:
+            return qa_fields(self.get(url))
+        response = self.request(
+            url, headers=self.cache.validators(registry_id))
+        if response.status_code == 304:
+            return self.cache.response(registry_id)
+        content = qa_fields(response.json())
+        self.cache.store_response(
+            registry_id, content, response.headers.get('ETag'),
+            response.headers.get('Last-Modified'))
+        return content
+
+    def fetch_batch(self, registry_ids):
+        """The QA fields of several studies, fetched from the list
+        endpoint (following page tokens as necessary), as a dict keyed
+        by registry id.  Studies unknown to the API are left out.
+
+        """
+        params = {
+            'filter.ids': ','.join(registry_ids),
+            'fields': ','.join(BATCH_FIELDS),
+            'pageSize': min(len(registry_ids), MAX_PAGE_SIZE),
+        }
+        studies = {}
+        while True:
+            content = self.get(self.base_url, params=params)
+            for study in content.get('studies', []):
+                registry_id = study['protocolSection'][
+                    'identificationModule']['nctId']
+                studies[registry_id] = qa_fields(study)
+            if not content.get('nextPageToken'):
+                return studies
+            params['pageToken'] = content['nextPageToken']
+
+    def fetch_many(self, registry_ids, batch_size=None):
+        """Yield `(registry_id, qa_fields)` for each study, in order.
+
+        If `batch_size` is given, studies are fetched that many at a
+        time with `fetch_batch`, and any unknown to the API are
+        skipped; otherwise each is fetched separately.  Only a few
+        requests per worker are queued at a time, so results don't
+        pile up if the consumer is slower than the API.
+
+        """
+        if batch_size:
+            registry_ids = list(registry_ids)
+            batches = (registry_ids[i:i + batch_size]
+                       for i in range(0, len(registry_ids), batch_size))
+            for batch, studies in self._map(self.fetch_batch, batches):
+                for registry_id in batch:
+                    if registry_id in studies:
+                        yield registry_id, studies[registry_id]
+                    else:
+                        logger.warn("%s not found in the API", registry_id)
+        else:
+            yield from self._map(self.fetch, registry_ids)
+
+    def _map(self, func, items):
+        """Yield `(item, func(item))` for each item, in order, calling
+        `func` in `workers` threads
+
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = collections.deque()
+            for item in items:
+                if len(pending) >= 2 * self.workers:
+                    yield _result(pending.popleft())
+                pending.append((item, executor.submit(func, item)))
+            while pending:
+                yield _result(pending.popleft())
+
+
+def _result(pending):
+    item, future = pending
+    return item, future.result()
+
+
+def _retry_after(response):
+    try:
+        return min(int(response.headers.get('Retry-After')), 60)
+    except (TypeError, ValueError):
+        return None
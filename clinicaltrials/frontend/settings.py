@@ -271,3 +271,60 @@ STORAGE_PREFIX = 'clinicaltrials/'
 WORKING_VOLUME = '/mnt/volume-lon1-01/'   # should have at least 10GB space
 WORKING_DIR = os.path.join(WORKING_VOLUME, STORAGE_PREFIX)
 INTERMEDIATE_CSV_PATH = os.path.join(WORKING_VOLUME, STORAGE_PREFIX, 'clinical_trials.csv')
+
+# Number of processes, and the number of files handed to each at a
+# time, used to convert XML to JSON
+CONVERSION_WORKERS = os.cpu_count() or 1
+CONVERSION_SHARD_SIZE = 500
+
+# Number of parallel connections used to download the registry zip
+DOWNLOAD_CONNECTIONS = 4
+
+# Digests of every study seen by the last successful import, used by
+# `load_data --incremental` to find studies that have changed; and
+# the list of those changes, passed to `process_data --delta`. The
+# manifest must live outside WORKING_DIR, which is cleared each run.
+CONVERSION_MANIFEST_PATH = os.path.join(
+    WORKING_VOLUME, STORAGE_PREFIX.rstrip(os.sep) + '_manifest.json')
+INTERMEDIATE_DELTA_PATH = os.path.join(WORKING_VOLUME, STORAGE_PREFIX, 'delta.json')
+
+# CSV export of the `jan17_fda_regulation_snapshot` BigQuery table
+# (columns `nct_id` and `is_fda_regulated`), used by `load_data --local`
+FDA_REGULATION_SNAPSHOT_PATH = os.path.join(
+    WORKING_VOLUME, 'jan17_fda_regulation_snapshot.csv')
+
+# Number of CSV rows written at a time by `process_data --bulk`
+IMPORT_BATCH_SIZE = 1000
+
+# The clinicaltrials.gov API, queried for the QA history of trials
+# after each import; the number of requests made to it concurrently,
+# and the maximum number made per second
+CLINICALTRIALS_API_URL = 'https://clinicaltrials.gov/api/v2/studies'
+QA_FETCH_WORKERS = 8
+QA_API_RATE = 10
+# Number of trials asked for in each request to the API; 0 fetches
+# each trial separately
+QA_API_BATCH_SIZE = 100
+# Cache of QA metadata kept between imports (see `frontend.qa_cache`),
+# and the most trials it holds
+QA_CACHE_PATH = os.path.join(WORKING_VOLUME, 'qa_cache.sqlite3')
+QA_CACHE_MAX_ENTRIES = 100000
+
+# Pages, API responses and other data derived from the database are
+# cached until the next import (see `frontend.data_cache`), for at
+# most this many seconds
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+DATA_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Number of rows fetched from the database at a time when streaming a
+# CSV download from the API
+CSV_STREAM_CHUNK_SIZE = 2000
+
+# Where the nightly CSV exports of the API are written (see
+# `frontend.exports`), and the URL they are served from by nginx
+EXPORT_ROOT = os.path.join(PROJECT_ROOT, '../exports')
+EXPORT_URL = '/exports/'
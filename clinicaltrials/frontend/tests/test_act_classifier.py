@@ -0,0 +1,118 @@
+"""Parity tests for the local implementation of view.sql
+"""
+import csv
+import os
+import zipfile
+from datetime import date
+
+import xmltodict
+from django.conf import settings
+from django.test import SimpleTestCase
+
+from frontend import act_classifier
+from frontend.management.commands.load_data import postprocessor
+
+
+FIXTURES = os.path.join(settings.BASE_DIR, 'frontend/tests/fixtures')
+
+# The date `expected_trials_data.csv` was generated by BigQuery
+SQL_RUN_DATE = date(2018, 3, 13)
+
+
+def fixture_studies():
+    with zipfile.ZipFile(os.path.join(FIXTURES, 'data.zip')) as z:
+        return [
+            xmltodict.parse(
+                z.read(name), item_depth=0, postprocessor=postprocessor)
+            for name in z.namelist() if name.endswith('.xml')]
+
+
+def study(**fields):
+    defaults = {
+        'id_info': {'nct_id': 'NCT00000001'},
+        'study_type': 'Interventional',
+        'overall_status': 'Completed',
+        'phase': 'Phase 2',
+        'start_date': 'March 2016',
+        'primary_completion_date': {'type': 'Actual', 'text': 'January 2017'},
+        'intervention': {'intervention_type': 'Drug'},
+        'location_countries': {'country': 'United States'},
+    }
+    defaults.update(fields)
+    return {'clinical_study': defaults}
+
+
+class ActClassifierTestCase(SimpleTestCase):
+    def _classify(self, *studies, today=SQL_RUN_DATE, fda_regulated=None):
+        rows = act_classifier.classify_batch(
+            studies, today, fda_regulated or {})
+        return [dict(zip(act_classifier.COLUMNS, row)) for row in rows]
+
+    def test_parity_with_sql(self):
+        fda_regulated = act_classifier.load_fda_regulation_snapshot(
+            os.path.join(FIXTURES, 'fda_regulation_snapshot.csv'))
+        rows = act_classifier.classify_batch(
+            fixture_studies(), SQL_RUN_DATE, fda_regulated)
+        with open(os.path.join(FIXTURES, 'expected_trials_data.csv')) as f:
+            expected = list(csv.reader(f))
+        self.assertEqual(expected[0], act_classifier.COLUMNS)
+        self.assertEqual(sorted(rows), sorted(expected[1:]))
+
+    def test_month_only_dates_default_to_end_of_month(self):
+        self.assertEqual(
+            act_classifier.parse_date("February 2016"), date(2016, 2, 29))
+        self.assertEqual(
+            act_classifier.parse_date("December 2017"), date(2017, 12, 31))
+        self.assertEqual(
+            act_classifier.parse_date("December 5, 2017"), date(2017, 12, 5))
+        row, = self._classify(study())
+        self.assertEqual(row['available_completion_date'], '2017-01-31')
+        self.assertEqual(row['defaulted_pcd_flag'], '1')
+        self.assertEqual(row['defaulted_date'], '1')
+
+    def test_untyped_primary_completion_date_is_ignored(self):
+        # Only a typed primary completion date counts, as in the SQL
+        row, = self._classify(study(
+            primary_completion_date='January 2017',
+            completion_date='February 1, 2017'))
+        self.assertEqual(row['used_primary_completion_date'], '0')
+        self.assertEqual(row['available_completion_date'], '2017-02-01')
+        self.assertEqual(row['defaulted_date'], '0')
+
+    def test_pact_locations(self):
+        for country, included in [
+                ('Puerto Rico', True),
+                (['Canada', 'Guam'], True),
+                ('United States Minor Outlying Islands', True),
+                ('Virgin Islands (U.S.)', False),
+                ('Canada', False)]:
+            rows = self._classify(
+                study(location_countries={'country': country}))
+            self.assertEqual(bool(rows), included, country)
+
+    def test_pact_excluded_by_snapshot(self):
+        self.assertFalse(self._classify(
+            study(), fda_regulated={'NCT00000001': False}))
+        self.assertTrue(self._classify(
+            study(), fda_regulated={'NCT00000001': None}))
+
+    def test_act(self):
+        row, = self._classify(study(
+            start_date={'type': 'Actual', 'text': 'January 18, 2017'},
+            primary_completion_date={'type': 'Actual', 'text': 'June 1, 2017'},
+            oversight_info={'is_fda_regulated_drug': 'Yes'},
+            location_countries=None))
+        self.assertEqual(row['act_flag'], '1')
+        self.assertEqual(row['included_pact_flag'], '0')
+        self.assertEqual(row['results_due'], '0')
+        row, = self._classify(study(
+            start_date={'type': 'Actual', 'text': 'January 18, 2017'},
+            primary_completion_date={'type': 'Actual', 'text': 'June 1, 2017'},
+            oversight_info={'is_fda_regulated_drug': 'Yes'}),
+            today=date(2018, 7, 2))
+        self.assertEqual(row['results_due'], '1')
+
+    def test_withdrawn_and_feasibility_studies_excluded(self):
+        self.assertFalse(self._classify(study(overall_status='Withdrawn')))
+        self.assertFalse(self._classify(study(
+            study_design_info={'primary_purpose': 'Device Feasibility'})))
@@ -0,0 +1,124 @@
+from datetime import date
+from unittest.mock import patch
+from unittest.mock import Mock
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.test import RequestFactory
+from django.test import TestCase
+
+from rest_framework.test import APIClient
+
+from frontend.data_cache import bump_data_version
+from frontend.data_cache import cache_anonymous_response
+from frontend.data_cache import cached
+from frontend.data_cache import current_data_date
+from frontend.data_cache import data_version
+from frontend.management.commands.process_data import set_current_rankings
+from frontend.models import Sponsor
+from frontend.models import Trial
+from frontend.tests.common import makeTrial
+
+
+class DataCacheTestCase(TestCase):
+    @patch('frontend.trial_computer.date')
+    def setUp(self, datetime_mock):
+        cache.clear()
+        datetime_mock.today = Mock(return_value=date(2017, 1, 31))
+        self.sponsor = Sponsor.objects.create(
+            name="Sponsor 1", updated_date=date(2017, 1, 31))
+        self.trial = makeTrial(
+            self.sponsor, results_due=True, has_results=False)
+        set_current_rankings()
+
+    def test_data_version(self):
+        self.assertIsNone(data_version())
+        bump_data_version()
+        first = data_version()
+        self.assertTrue(first.startswith('2017-01-31.'))
+        bump_data_version()
+        self.assertNotEqual(data_version(), first)
+
+    def test_current_data_date(self):
+        self.assertEqual(current_data_date(), date(2017, 1, 31))
+        bump_data_version()
+        current_data_date()
+        # Only the generation is read
+        with self.assertNumQueries(1):
+            self.assertEqual(current_data_date(), date(2017, 1, 31))
+        self.sponsor.updated_date = date(2017, 2, 1)
+        self.sponsor.save()
+        set_current_rankings()
+        self.assertEqual(current_data_date(), date(2017, 1, 31))
+        bump_data_version()
+        self.assertEqual(current_data_date(), date(2017, 2, 1))
+
+    def test_cached_until_bumped(self):
+        compute = Mock(return_value=1)
+        cached(compute, 'key')
+        cached(compute, 'key')
+        self.assertEqual(compute.call_count, 2)
+        bump_data_version()
+        cached(compute, 'key')
+        cached(compute, 'key')
+        cached(compute, 'other key')
+        self.assertEqual(compute.call_count, 4)
+        bump_data_version()
+        cached(compute, 'key')
+        self.assertEqual(compute.call_count, 5)
+
+    def test_anonymous_responses_cached(self):
+        bump_data_version()
+        client = APIClient()
+        for url in ['/sponsor/{}/'.format(self.sponsor.slug),
+                    '/api/performance/', '/api/trials/']:
+            first = client.get(url)
+            # Only the data version is read
+            with self.assertNumQueries(1):
+                second = client.get(url)
+            self.assertEqual(first.content, second.content)
+        Trial.objects.update(title="Changed")
+        self.assertNotContains(client.get('/api/trials/'), "Changed")
+        bump_data_version()
+        self.assertContains(client.get('/api/trials/'), "Changed")
+
+    def test_cached_per_format(self):
+        bump_data_version()
+        client = APIClient()
+        client.get('/api/trials/', format='json')
+        response = client.get('/api/trials/', HTTP_ACCEPT='text/csv')
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+
+    def test_only_anonymous_responses_cached(self):
+        bump_data_version()
+        view = cache_anonymous_response(Mock(return_value=HttpResponse()))
+        factory = RequestFactory()
+
+        def request(user=AnonymousUser(), method='get', **headers):
+            request = getattr(factory, method)('/', **headers)
+            request.user = user
+            return request
+        for uncached in [request(user=Mock(is_authenticated=True)),
+                         request(HTTP_AUTHORIZATION='Basic dXNlcjpwYXNz'),
+                         request(method='post')]:
+            view(uncached)
+            view(uncached)
+        self.assertEqual(view.__wrapped__.call_count, 6)
+        view(request())
+        view(request())
+        self.assertEqual(view.__wrapped__.call_count, 7)
+
+    def test_responses_using_csrf_not_cached(self):
+        bump_data_version()
+
+        def csrf_view(request):
+            return HttpResponse(get_token(request))
+        view = cache_anonymous_response(csrf_view)
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        first = view(request).content
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        self.assertNotEqual(view(request).content, first)
@@ -0,0 +1,200 @@
+"""Tests for the resumable downloader, against a local HTTP server
+"""
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from unittest.mock import patch
+
+from django.test import SimpleTestCase
+
+from frontend import downloader
+
+
+CONTENT = bytes(range(256)) * 1000
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    """Serves `server.content`, honouring single byte ranges unless
+    `server.ranges` is False.  If `server.fail_after` is set, the first
+    response is cut off after that many bytes.
+
+    """
+    def log_message(self, *args):
+        pass
+
+    def _headers(self, status, length, start=None, end=None):
+        self.send_response(status)
+        self.send_header('Content-Length', str(length))
+        self.send_header('ETag', self.server.etag)
+        if self.server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if start is not None:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, end, len(self.server.content)))
+        self.end_headers()
+
+    def do_HEAD(self):
+        self._headers(
+            200, self.server.reported_size or len(self.server.content))
+
+    def do_GET(self):
+        content = self.server.content
+        self.server.requested_ranges.append(self.headers.get('Range'))
+        with self.server.lock:
+            fail_status = self.server.fail_status
+            self.server.fail_status = None
+        if fail_status is not None:
+            self.send_response(fail_status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        match = re.match(r"bytes=(\d+)-(\d+)", self.headers.get('Range') or '')
+        if match and self.server.ranges:
+            start, end = int(match.group(1)), int(match.group(2))
+            if self.server.max_range is not None:
+                end = min(end, start + self.server.max_range - 1)
+            body = content[start:end + 1]
+            self._headers(206, len(body), start, end)
+        else:
+            body = content
+            self._headers(200, len(body))
+        with self.server.lock:
+            fail_after = self.server.fail_after
+            self.server.fail_after = None
+        if fail_after is not None:
+            self.wfile.write(body[:fail_after])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+class DownloaderTestCase(SimpleTestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+        self.server.content = CONTENT
+        self.server.etag = '"v1"'
+        self.server.ranges = True
+        self.server.fail_after = None
+        self.server.max_range = None
+        self.server.fail_status = None
+        self.server.reported_size = None
+        self.server.requested_ranges = []
+        self.server.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{}/AllPublicXML.zip'.format(
+            self.server.server_address[1])
+        self.tmpdir = tempfile.mkdtemp()
+        self.target = os.path.join(self.tmpdir, 'data.zip')
+        sleep = patch('frontend.downloader.time.sleep')
+        sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def _read_target(self):
+        with open(self.target, 'rb') as f:
+            return f.read()
+
+    def test_parallel_ranges(self):
+        progress = downloader.download(self.url, self.target, connections=3)
+        self.assertEqual(self._read_target(), CONTENT)
+        self.assertEqual(len(self.server.requested_ranges), 3)
+        self.assertEqual(progress.done, len(CONTENT))
+        # The partial file and sidecar are tidied away
+        self.assertEqual(os.listdir(self.tmpdir), ['data.zip'])
+
+    def _write_partial(self, etag, ranges, done, content):
+        with open(self.target + '.parts.json', 'w') as f:
+            json.dump({'validators': {
+                'url': self.url, 'size': len(CONTENT),
+                'etag': etag, 'last_modified': None,
+                'ranges': [list(r) for r in ranges]}, 'done': done}, f)
+        with open(self.target + '.partial', 'wb') as f:
+            f.write(content.ljust(len(CONTENT), b'\0'))
+
+    def test_resumes_partial_download(self):
+        ranges = downloader._split(len(CONTENT), 2)
+        self._write_partial('"v1"', ranges, [1000, 0], CONTENT[:1000])
+        downloader.download(self.url, self.target, connections=2)
+        self.assertEqual(self._read_target(), CONTENT)
+        self.assertCountEqual(
+            self.server.requested_ranges,
+            ['bytes=1000-{}'.format(ranges[0][1]),
+             'bytes={}-{}'.format(*ranges[1])])
+
+    def test_discards_parts_from_changed_remote_file(self):
+        ranges = downloader._split(len(CONTENT), 2)
+        self._write_partial('"v0"', ranges, [1000, 0], b'x' * 1000)
+        downloader.download(self.url, self.target, connections=2)
+        self.assertEqual(self._read_target(), CONTENT)
+        self.assertEqual(len(self.server.requested_ranges), 2)
+
+    @patch('frontend.downloader.CHUNK_SIZE', 1000)
+    def test_retries_dropped_connection(self):
+        # Everything received before the connection drops is kept
+        self.server.fail_after = 5000
+        downloader.download(self.url, self.target, connections=1)
+        self.assertEqual(self._read_target(), CONTENT)
+        self.assertEqual(
+            self.server.requested_ranges,
+            ['bytes=0-{}'.format(len(CONTENT) - 1),
+             'bytes=5000-{}'.format(len(CONTENT) - 1)])
+
+    def test_retries_unavailable_server(self):
+        self.server.fail_status = 503
+        downloader.download(self.url, self.target, connections=1)
+        self.assertEqual(self._read_target(), CONTENT)
+        self.assertEqual(
+            self.server.requested_ranges,
+            ['bytes=0-{}'.format(len(CONTENT) - 1)] * 2)
+
+    def test_fails_on_unsatisfiable_range(self):
+        self.server.fail_status = 416
+        with self.assertRaises(downloader.DownloadError):
+            downloader.download(self.url, self.target, connections=1)
+        self.assertEqual(len(self.server.requested_ranges), 1)
+
+    def test_short_responses_resumed(self):
+        self.server.max_range = 100000
+        downloader.download(self.url, self.target, connections=1)
+        self.assertEqual(self._read_target(), CONTENT)
+        self.assertEqual(
+            self.server.requested_ranges,
+            ['bytes={}-{}'.format(start, len(CONTENT) - 1)
+             for start in [0, 100000, 200000]])
+
+    def test_short_responses_count_as_failures(self):
+        self.server.max_range = 1000
+        with self.assertRaises(downloader.DownloadError):
+            downloader.download(
+                self.url, self.target, connections=1, retries=3)
+        self.assertEqual(len(self.server.requested_ranges), 4)
+        # What was received is recorded, to resume from next time
+        with open(self.target + '.parts.json') as f:
+            self.assertEqual(json.load(f)['done'], [4000])
+        with open(self.target + '.partial', 'rb') as f:
+            self.assertEqual(f.read(4000), CONTENT[:4000])
+
+    def test_server_without_ranges(self):
+        self.server.ranges = False
+        downloader.download(self.url, self.target, connections=4)
+        self.assertEqual(self._read_target(), CONTENT)
+        self.assertEqual(self.server.requested_ranges, [None])
+
+    def test_size_validation(self):
+        # The file is shorter than the server said it would be
+        self.server.ranges = False
+        self.server.reported_size = len(CONTENT) + 1
+        with self.assertRaises(downloader.DownloadError):
+            downloader.download(self.url, self.target)
@@ -0,0 +1,84 @@
+from datetime import date
+from unittest.mock import patch
+from unittest.mock import Mock
+import gzip
+import os
+import shutil
+import tempfile
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.test import override_settings
+
+from rest_framework.test import APIClient
+
+from frontend.data_cache import bump_data_version
+from frontend.data_cache import data_version
+from frontend.exports import write_exports
+from frontend.management.commands.process_data import set_current_rankings
+from frontend.models import Sponsor
+from frontend.tests.common import makeTrial
+
+
+class ExportsTestCase(TestCase):
+    @patch('frontend.trial_computer.date')
+    def setUp(self, datetime_mock):
+        cache.clear()
+        datetime_mock.today = Mock(return_value=date(2017, 1, 31))
+        sponsor = Sponsor.objects.create(
+            name="Sponsor 1", updated_date=date(2017, 1, 31))
+        makeTrial(sponsor, results_due=True, has_results=False)
+        makeTrial(sponsor, results_due=True, has_results=True,
+                  reported_date=date(2016, 12, 1))
+        set_current_rankings()
+        self.export_root = tempfile.mkdtemp()
+        settings = override_settings(EXPORT_ROOT=self.export_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.addCleanup(shutil.rmtree, self.export_root)
+
+    def test_exports_match_api(self):
+        client = APIClient()
+        bump_data_version()
+        expected = {}
+        for name in ['trials', 'rankings', 'sponsors']:
+            response = client.get('/api/{}.csv'.format(name))
+            self.assertEqual(response.status_code, 200)
+            expected[name] = b''.join(response.streaming_content)
+        write_exports()
+        version = data_version()
+        for name in ['trials', 'rankings', 'sponsors']:
+            path = os.path.join(
+                self.export_root, '{}-{}.csv'.format(name, version))
+            with open(path, 'rb') as f:
+                exported = f.read()
+            self.assertEqual(exported, expected[name])
+            with gzip.open(path + '.gz') as f:
+                self.assertEqual(f.read(), exported)
+            response = client.get('/api/{}/'.format(name), {'format': 'csv'})
+            self.assertRedirects(
+                response, '/exports/{}-{}.csv'.format(name, version),
+                fetch_redirect_response=False)
+
+    def test_filtered_requests_not_redirected(self):
+        bump_data_version()
+        write_exports()
+        response = APIClient().get('/api/trials.csv', {'has_results': True})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            len(b''.join(response.streaming_content).splitlines()), 2)
+
+    def test_old_exports_removed(self):
+        bump_data_version()
+        write_exports()
+        old = set(os.listdir(self.export_root))
+        self.assertEqual(len(old), 6)
+        bump_data_version()
+        # Until exports are written for a new version, requests are
+        # served from the database
+        response = APIClient().get('/api/trials.csv')
+        self.assertEqual(response.status_code, 200)
+        write_exports()
+        new = set(os.listdir(self.export_root))
+        self.assertEqual(len(new), 6)
+        self.assertFalse(old & new)
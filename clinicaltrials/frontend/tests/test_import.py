@@ -1,39 +1,66 @@
 from datetime import date
 from datetime import timedelta
 from unittest import mock
+import csv
+import json
 import os
+import tempfile
 
 from django.conf import settings
 from django.core.management import call_command
 from django.test import TestCase
 
+from frontend.models import DailySummary
 from frontend.models import Ranking
+from frontend.models import Sponsor
 from frontend.models import Trial
+from frontend.models import TrialQA
 
 from frontend.trial_computer import qa_start_dates
+from frontend.views import compute_performance
 from frontend.management.commands.process_data import EARLIEST_CANCELLATION_DATE
+from frontend.management.commands import process_data
 
 
 class DummyResponse(object):
+    status_code = 200
+
     def __init__(self, content):
         self.content = content
         self.text = str(content)
 
+    def json(self):
+        return json.loads(self.text)
+
 
-def mock_ccgov_results(fixture_id):
+def study_fixture(fixture_id, registry_id):
+    """The study record in the fixture called `fixture_id` (one with no
+    QA history if there is none), as the record of `registry_id`
+    """
     fixture_path = os.path.join(
         settings.BASE_DIR,
-        'frontend/tests/fixtures/{}.html'.format(fixture_id))
+        'frontend/tests/fixtures/{}.json'.format(fixture_id))
+    study = {'hasResults': False}
     if os.path.exists(fixture_path):
-        with open(fixture_path, 'r') as dummy_response:
-            return DummyResponse(dummy_response.read())
-    return DummyResponse('<html></html>')
-
-
-
-def ccgov_results_by_url(url):
-    fixture_id = url.split('/')[-1]
-    return mock_ccgov_results(fixture_id)
+        with open(fixture_path, 'r') as f:
+            study = json.load(f)
+    study['protocolSection'] = {
+        'identificationModule': {'nctId': registry_id}}
+    return study
+
+
+def ccgov_results_by_url(url, params=None, fixture_id=None, **kwargs):
+    """Respond as the API would to a request for a single study (at
+    `url`) or, from the list endpoint, for the studies in `params`,
+    using the fixture named after each study, or `fixture_id`
+    """
+    if params and 'filter.ids' in params:
+        return DummyResponse(json.dumps({'studies': [
+            study_fixture(fixture_id or registry_id, registry_id)
+            for registry_id in params['filter.ids'].split(',')]}))
+    registry_id = url.split('/')[-1]
+    return DummyResponse(json.dumps(
+        study_fixture(fixture_id or registry_id, registry_id)))
 
 
 class CommandsTestCase(TestCase):
@@ -42,7 +69,7 @@ class CommandsTestCase(TestCase):
         self.yesterday = self.today - timedelta(days=1)
         self.last_year = self.today - timedelta(days=366)
 
-    @mock.patch('requests.get', mock.Mock(side_effect=ccgov_results_by_url))
+    @mock.patch('requests.Session.get', mock.Mock(side_effect=ccgov_results_by_url))
     @mock.patch('frontend.trial_computer.date')
     def test_import(self, datetime_mock):
         "Does a simple import create expected rankings and sponsors?"
@@ -106,7 +133,7 @@ class CommandsTestCase(TestCase):
 
 
 
-    @mock.patch('requests.get', mock.Mock(side_effect=ccgov_results_by_url))
+    @mock.patch('requests.Session.get', mock.Mock(side_effect=ccgov_results_by_url))
     @mock.patch('frontend.trial_computer.date')
     @mock.patch('frontend.management.commands.process_data.date')
     def test_second_import(self, mock_date_1, mock_date_2):
@@ -140,7 +167,7 @@ class CommandsTestCase(TestCase):
         self.assertEqual(overdue.updated_date, tomorrow)
         self.assertEqual(overdue.first_seen_date, self.today)
 
-    @mock.patch('requests.get', mock.Mock(side_effect=ccgov_results_by_url))
+    @mock.patch('requests.Session.get', mock.Mock(side_effect=ccgov_results_by_url))
     @mock.patch('frontend.models.date')
     def test_second_import_with_disappeared_trials(self, datetime_mock):
         """Is the disappearance of a trial from the CSV reflected in our
@@ -164,7 +191,7 @@ class CommandsTestCase(TestCase):
         self.assertEqual(Trial.objects.visible().count(), 0)
         self.assertNotEqual(Trial.objects.first().updated_date, self.last_year)
 
-    @mock.patch('requests.get', mock.Mock(side_effect=ccgov_results_by_url))
+    @mock.patch('requests.Session.get', mock.Mock(side_effect=ccgov_results_by_url))
     @mock.patch('frontend.models.date')
     def test_third_import_with_reappearing_trials(self, datetime_mock):
         """Is the disappearance of a trial from the CSV reflected in our
@@ -192,14 +219,14 @@ class CommandsTestCase(TestCase):
         self.assertEqual(overdue.status, 'overdue')
         self.assertEqual(overdue.previous_status, 'no-longer-act')
 
-    @mock.patch('requests.get', mock.Mock(side_effect=ccgov_results_by_url))
+    @mock.patch('requests.Session.get', mock.Mock(side_effect=ccgov_results_by_url))
     @mock.patch('frontend.trial_computer.date')
     def test_qa(self, datetime_mock):
         "Does a simple import create expected rankings and sponsors?"
         # The CSV imported at the start of this test contains a
         # variety of trials whose trial id corresponds with a fixture
-        # which is a copy of a CC.gov webpage containing various sorts
-        # of QA tables.
+        # which is a CC.gov API study record containing various sorts
+        # of QA history.
         datetime_mock.today = mock.Mock(return_value=self.today)
 
         args = []
@@ -267,7 +294,7 @@ class CommandsTestCase(TestCase):
         self.assertEqual(qa[2].submitted_to_regulator, date(2018, 5, 17))
 
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.get')
     @mock.patch('frontend.trial_computer.date')
     def test_import_twice(self, datetime_mock, requests_mock):
         "Is importing idempotent?"
@@ -276,13 +303,15 @@ class CommandsTestCase(TestCase):
         sample_csv = os.path.join(settings.BASE_DIR, 'frontend/tests/fixtures/two_months_qa.csv')
         opts = {'input_csv': sample_csv}
 
-        def month_1_results(arg):
-            return mock_ccgov_results('overdueinqa_month_1')
+        def month_1_results(url, **kwargs):
+            return ccgov_results_by_url(
+                url, fixture_id='overdueinqa_month_1', **kwargs)
         requests_mock.side_effect = month_1_results
         call_command('process_data', *args, **opts)
 
-        def month_2_results(arg):
-            return mock_ccgov_results('overdueinqa_month_2')
+        def month_2_results(url, **kwargs):
+            return ccgov_results_by_url(
+                url, fixture_id='overdueinqa_month_2', **kwargs)
         requests_mock.side_effect = month_2_results
         call_command('process_data', *args, **opts)
 
@@ -292,7 +321,7 @@ class CommandsTestCase(TestCase):
         self.assertEqual(qa[0].submitted_to_regulator, date(2017, 11, 13))
         self.assertEqual(qa[0].returned_to_sponsor, date(2017, 12, 11))
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.get')
     @mock.patch('frontend.trial_computer.date')
     @mock.patch('frontend.models.date')
     def test_import_and_qa(self, date_mock_1, date_mock_2, requests_mock):
@@ -305,9 +334,10 @@ class CommandsTestCase(TestCase):
         sample_csv = os.path.join(settings.BASE_DIR, 'frontend/tests/fixtures/two_months_qa.csv')
         opts = {'input_csv': sample_csv}
 
-        def month_1_results(arg):
+        def month_1_results(url, **kwargs):
             # However, the QA means it's not overdue after all - Nov 13 2017
-            return mock_ccgov_results('nolongeroverdueinqa')
+            return ccgov_results_by_url(
+                url, fixture_id='nolongeroverdueinqa', **kwargs)
         requests_mock.side_effect = month_1_results
         call_command('process_data', *args, **opts)
 
@@ -316,7 +346,7 @@ class CommandsTestCase(TestCase):
         self.assertEqual(trial.previous_status, 'ongoing')
 
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.get')
     @mock.patch('frontend.trial_computer.date')
     def test_import_with_disappearing_qa(self, datetime_mock, requests_mock):
         "If QA table disappears, trial should revert to overdue"
@@ -326,19 +356,21 @@ class CommandsTestCase(TestCase):
             settings.BASE_DIR, 'frontend/tests/fixtures/two_months_qa.csv')
         opts = {'input_csv': sample_csv}
 
-        def month_1_results(arg):
-            return mock_ccgov_results('overdueinqa_month_1')
+        def month_1_results(url, **kwargs):
+            return ccgov_results_by_url(
+                url, fixture_id='overdueinqa_month_1', **kwargs)
         requests_mock.side_effect = month_1_results
         call_command('process_data', *args, **opts)
 
-        # This trial starts off as overdue; the mocked CC.gov webpage
+        # This trial starts off as overdue; the mocked CC.gov record
         # makes that `reported-late`.
         trial = Trial.objects.get(registry_id='overdueinqa_two_months')
         self.assertEqual(trial.status, Trial.STATUS_REPORTED_LATE)
         self.assertEqual(trial.trialqa_set.count(), 1)
 
-        def month_2_results(arg):
-            return mock_ccgov_results('no_qa')
+        def month_2_results(url, **kwargs):
+            return ccgov_results_by_url(
+                url, fixture_id='no_qa', **kwargs)
         requests_mock.side_effect = month_2_results
         call_command('process_data', *args, **opts)
 
@@ -346,3 +378,207 @@ class CommandsTestCase(TestCase):
         qa_count = trial.trialqa_set.count()
         self.assertEqual(qa_count, 0)
         self.assertEqual(trial.status, Trial.STATUS_OVERDUE)
+
+
+    @mock.patch('requests.Session.get', mock.Mock(
+        return_value=DummyResponse('{"hasResults": false}')))
+    @mock.patch('frontend.trial_computer.date')
+    @mock.patch('frontend.management.commands.process_data.date')
+    def test_delta_import(self, mock_date_1, mock_date_2):
+        """Are untouched trials brought up to date when only changes are
+        imported?"""
+        mock_date_1.today = mock_date_2.today = mock.Mock(
+            return_value=self.today)
+        sample_csv = os.path.join(settings.BASE_DIR, 'frontend/tests/fixtures/sample_bq.csv')
+        call_command('process_data', input_csv=sample_csv)
+        Trial.objects.all().update(updated_date=self.today)
+        self.assertEqual(Trial.objects.get(registry_id='overdue').days_late, 61)
+
+        tomorrow = self.today + timedelta(days=1)
+        mock_date_1.today = mock_date_2.today = mock.Mock(
+            return_value=tomorrow)
+        empty_csv = os.path.join(settings.BASE_DIR, 'frontend/tests/fixtures/sample_bq_empty.csv')
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as delta:
+            json.dump({'changed': ['reported'], 'removed': ['ongoing']}, delta)
+            delta.flush()
+            call_command('process_data', input_csv=empty_csv, delta=delta.name)
+
+        # Changed or removed studies absent from the CSV are no longer ACTs
+        for registry_id in ['reported', 'ongoing']:
+            self.assertEqual(
+                Trial.objects.get(registry_id=registry_id).status,
+                Trial.STATUS_NO_LONGER_ACT)
+
+        # Untouched trials look as if they were imported again
+        overdue = Trial.objects.get(registry_id='overdue')
+        self.assertEqual(overdue.status, Trial.STATUS_OVERDUE)
+        self.assertEqual(overdue.previous_status, Trial.STATUS_OVERDUE)
+        self.assertEqual(overdue.days_late, 62)
+        self.assertEqual(overdue.updated_date, tomorrow)
+        self.assertEqual(overdue.sponsor.updated_date, tomorrow)
+        self.assertEqual(
+            Ranking.objects.filter(date=tomorrow, sponsor=overdue.sponsor).count(), 1)
+
+        # ...including becoming due with the passing of time
+        notact = Trial.objects.get(registry_id='notact')
+        self.assertTrue(notact.results_due)
+        self.assertEqual(notact.status, Trial.STATUS_OVERDUE)
+        self.assertEqual(notact.previous_status, Trial.STATUS_ONGOING)
+
+    @mock.patch('requests.Session.get', mock.Mock(
+        return_value=DummyResponse('{"hasResults": false}')))
+    @mock.patch('frontend.trial_computer.date')
+    @mock.patch('frontend.management.commands.process_data.date')
+    def test_stream_import(self, mock_date_1, mock_date_2):
+        "Can studies be imported straight from the registry zip?"
+        today = date(2018, 3, 13)
+        mock_date_1.today = mock_date_2.today = mock.Mock(return_value=today)
+        fixtures = os.path.join(settings.BASE_DIR, 'frontend/tests/fixtures')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            manifest = os.path.join(tmpdir, 'manifest.json')
+            tee = os.path.join(tmpdir, 'clinical_trials.csv')
+            with self.settings(
+                    CONVERSION_MANIFEST_PATH=manifest,
+                    CONVERSION_SHARD_SIZE=2,
+                    FDA_REGULATION_SNAPSHOT_PATH=os.path.join(
+                        fixtures, 'fda_regulation_snapshot.csv')):
+                call_command(
+                    'process_data', input_zip=os.path.join(fixtures, 'data.zip'),
+                    workers=2, tee_csv=tee)
+                with open(tee) as f, open(os.path.join(
+                        fixtures, 'expected_trials_data.csv')) as expected:
+                    self.assertEqual(
+                        sorted(csv.reader(f)), sorted(csv.reader(expected)))
+                self.assertEqual(Trial.objects.count(), 5)
+                trial = Trial.objects.get(registry_id='NCT01275365')
+                self.assertEqual(trial.status, Trial.STATUS_REPORTED)
+                self.assertEqual(
+                    trial.sponsor.name, "Brigham and Women's Hospital")
+
+                # Nothing has changed by the next day
+                os.replace(manifest + '.pending', manifest)
+                tomorrow = today + timedelta(days=1)
+                mock_date_1.today = mock_date_2.today = mock.Mock(
+                    return_value=tomorrow)
+                call_command(
+                    'process_data', input_zip=os.path.join(fixtures, 'data.zip'),
+                    workers=1, incremental=True)
+                self.assertEqual(
+                    Trial.objects.filter(updated_date=tomorrow).count(), 5)
+                self.assertEqual(
+                    Trial.objects.get(registry_id='NCT01275365').status,
+                    Trial.STATUS_REPORTED)
+
+    @mock.patch('requests.Session.get', mock.Mock(
+        return_value=DummyResponse('{"hasResults": true}')))
+    @mock.patch('frontend.trial_computer.date')
+    @mock.patch('frontend.management.commands.process_data.date')
+    def test_bulk_imports_match_orm(self, mock_date_1, mock_date_2):
+        """Do bulk and COPY imports (with rankings computed in SQL, or
+        incrementally) give the same results as saving each row?"""
+        fixtures = os.path.join(settings.BASE_DIR, 'frontend/tests/fixtures')
+
+        def import_twice(**options):
+            mock_date_1.today = mock_date_2.today = mock.Mock(
+                return_value=self.today)
+            call_command(
+                'process_data',
+                input_csv=os.path.join(fixtures, 'sample_bq.csv'), **options)
+            TrialQA.objects.create(
+                trial=Trial.objects.get(registry_id='overdue'),
+                submitted_to_regulator=self.today - timedelta(days=20))
+            tomorrow = self.today + timedelta(days=1)
+            mock_date_1.today = mock_date_2.today = mock.Mock(
+                return_value=tomorrow)
+            call_command(
+                'process_data',
+                input_csv=os.path.join(fixtures, 'sample_bq_qa.csv'), **options)
+            trials = list(Trial.objects.order_by('registry_id').values())
+            for trial in trials:
+                del trial['id']
+            sponsors = list(Sponsor.objects.order_by('slug').values())
+            rankings = list(Ranking.objects.order_by('sponsor', 'date').values(
+                *[field.attname for field in Ranking._meta.fields
+                  if field.name != 'id']))
+            self.assertEqual(
+                DailySummary.objects.filter(sponsor=None).values(
+                    *DailySummary.METRICS).get(),
+                compute_performance())
+            Sponsor.objects.all().delete()
+            return trials, sponsors, rankings
+
+        expected = import_twice()
+        self.assertEqual(import_twice(bulk=True, batch_size=3), expected)
+        self.assertEqual(import_twice(copy=True, sql_rankings=True), expected)
+        self.assertEqual(
+            import_twice(incremental_rankings=True), expected)
+        self.assertEqual(
+            import_twice(bulk=True, batch_size=3, incremental_rankings=True),
+            expected)
+        self.assertEqual(
+            import_twice(copy=True, sql_rankings=True,
+                         incremental_rankings=True), expected)
+
+    @mock.patch('requests.Session.get', mock.Mock(
+        return_value=DummyResponse('{"hasResults": true}')))
+    @mock.patch('frontend.trial_computer.date')
+    @mock.patch('frontend.management.commands.process_data.date')
+    def test_incremental_rankings_carry_forward(self, mock_date_1, mock_date_2):
+        """Are only sponsors whose trials changed re-ranked?"""
+        csv_path = os.path.join(
+            settings.BASE_DIR, 'frontend/tests/fixtures/sample_bq.csv')
+        mock_date_1.today = mock_date_2.today = mock.Mock(
+            return_value=self.today)
+        call_command('process_data', input_csv=csv_path)
+        changed = Trial.objects.get(registry_id='overdue').sponsor
+        changed.trial_set.update(status=Trial.STATUS_NO_LONGER_ACT)
+        tomorrow = self.today + timedelta(days=1)
+        mock_date_1.today = mock_date_2.today = mock.Mock(
+            return_value=tomorrow)
+        with mock.patch(
+                'frontend.management.commands.process_data._ranking_statistics',
+                wraps=process_data._ranking_statistics) as statistics:
+            call_command(
+                'process_data', input_csv=csv_path, incremental_rankings=True)
+        ranked = statistics.call_args[0][0]
+        self.assertIn(changed.pk, ranked)
+        self.assertLess(len(ranked), Sponsor.objects.count())
+        incremental = list(Ranking.objects.filter(date=tomorrow).order_by(
+            'sponsor').values())
+        process_data.set_current_rankings()
+        self.assertEqual(
+            list(Ranking.objects.filter(date=tomorrow).order_by(
+                'sponsor').values()),
+            incremental)
+
+    @mock.patch('frontend.exports.write_exports', mock.Mock())
+    @mock.patch('frontend.management.commands.refresh_lateness.date')
+    @mock.patch('frontend.trial_computer.date')
+    def test_incremental_rankings_after_refresh(self, mock_date_1, mock_date_2):
+        """Are statuses changed by `refresh_lateness` between imports
+        carried forward by the next incremental ranking?"""
+        day_1, day_2, day_3 = (
+            date(2017, 1, 30), date(2017, 2, 1), date(2017, 2, 2))
+        mock_date_1.today = mock.Mock(return_value=day_1)
+        sponsor = Sponsor.objects.create(name="Sponsor 1", updated_date=day_1)
+        trial = Trial.objects.create(
+            registry_id='id_1', sponsor=sponsor, start_date=date(2015, 1, 1),
+            completion_date=date(2016, 1, 1), results_due=False)
+        TrialQA.objects.create(
+            trial=trial, submitted_to_regulator=date(2016, 12, 1))
+        process_data.set_current_rankings()
+        self.assertEqual(Ranking.objects.get().due, 0)
+        # The trial becomes due, and counts as reported through QA
+        mock_date_1.today = mock_date_2.today = mock.Mock(return_value=day_2)
+        call_command('refresh_lateness')
+        # An import which changes none of the sponsor's trials
+        Sponsor.objects.update(updated_date=day_3)
+        process_data.set_current_rankings(changed_sponsors=set())
+        fields = (['sponsor', 'rank', 'percentage'] +
+                  process_data.RANKING_COLUMNS)
+        incremental = Ranking.objects.filter(date=day_3).values(*fields).get()
+        self.assertEqual((incremental['due'], incremental['reported']), (1, 1))
+        process_data.set_current_rankings()
+        self.assertEqual(
+            Ranking.objects.filter(date=day_3).values(*fields).get(),
+            incremental)
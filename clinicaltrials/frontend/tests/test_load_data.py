@@ -4,27 +4,35 @@ import csv
 import os
 import shutil
 import tempfile
+import zipfile
 from datetime import date
 from unittest import mock
 from django.conf import settings
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.test import TestCase
 from django.test.utils import override_settings
 from unittest.mock import patch
 import pathlib
 
 
+from frontend.management.commands.load_data import convert_to_csv
+from frontend.management.commands.load_data import convert_to_json
+from frontend.management.commands.load_data import raw_json_name
+from frontend.management.commands.load_data import study_digest
+
+
 CMD_ROOT = 'frontend.management.commands.load_data'
 
 
-def wget_copy_fixture(data_file, url):
+def download_copy_fixture(data_file, url):
     test_zip = os.path.join(
         settings.BASE_DIR, 'frontend/tests/fixtures/data.zip')
     shutil.copy(test_zip, data_file)
 
 
 class LoadTestCase(TestCase):
-    @patch(CMD_ROOT + '.wget_file', side_effect=wget_copy_fixture)
+    @patch(CMD_ROOT + '.download_file', side_effect=download_copy_fixture)
     @patch(CMD_ROOT + '.notify_slack')
     @patch(CMD_ROOT + '.process_data')
     @override_settings(
@@ -35,9 +43,10 @@ class LoadTestCase(TestCase):
         PROCESSING_STORAGE_TABLE_NAME='current_raw_json_test',
         WORKING_VOLUME=os.path.join(tempfile.gettempdir(), 'fdaaa_data'),
         WORKING_DIR=os.path.join(tempfile.gettempdir(), 'fdaaa_data', 'work'),
-        INTERMEDIATE_CSV_PATH=os.path.join(tempfile.gettempdir(), 'clinical_trials.csv')
+        INTERMEDIATE_CSV_PATH=os.path.join(tempfile.gettempdir(), 'clinical_trials.csv'),
+        CONVERSION_MANIFEST_PATH=os.path.join(tempfile.gettempdir(), 'fdaaa_data', 'manifest.json')
     )
-    def test_produces_csv(self, process_mock, slack_mock, wget_file_mock):
+    def test_produces_csv(self, process_mock, slack_mock, download_file_mock):
         fdaaa_web_data = os.path.join(tempfile.gettempdir(), 'fdaaa_data')
         pathlib.Path(fdaaa_web_data).mkdir(exist_ok=True)
 
@@ -51,3 +60,88 @@ class LoadTestCase(TestCase):
                 results = sorted(list(csv.reader(output_file)))
                 expected = sorted(list(csv.reader(expected_file)))
                 self.assertEqual(results, expected)
+
+    @patch(CMD_ROOT + '.download')
+    @patch(CMD_ROOT + '.process_data')
+    def test_stream_rejects_copy(self, process_mock, download_mock):
+        with self.assertRaises(CommandError):
+            call_command('load_data', stream=True, copy=True)
+        download_mock.assert_not_called()
+        process_mock.assert_not_called()
+
+
+class ConvertToJsonTestCase(TestCase):
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        self.zip_path = os.path.join(self.working_dir, 'data.zip')
+        shutil.copy(
+            os.path.join(settings.BASE_DIR, 'frontend/tests/fixtures/data.zip'),
+            self.zip_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir)
+
+    def _convert(self, workers):
+        with override_settings(
+                WORKING_DIR=self.working_dir, CONVERSION_SHARD_SIZE=2):
+            convert_to_json(self.zip_path, workers=workers)
+        with open(os.path.join(self.working_dir, raw_json_name())) as f:
+            return f.readlines()
+
+    def test_parallel_conversion_matches_serial(self):
+        serial = self._convert(workers=1)
+        parallel = self._convert(workers=3)
+        self.assertEqual(len(serial), 5)
+        self.assertEqual(serial, parallel)
+        self.assertIn('NCT01275365', serial[0])
+
+    def test_unparseable_files_skipped(self):
+        with zipfile.ZipFile(self.zip_path, 'a') as z:
+            z.writestr('NCTxxx/NCT0.xml', '<clinical_study>')
+            z.writestr('NCTxxx/notes.txt', 'not a study')
+        self.assertEqual(len(self._convert(workers=2)), 5)
+
+    def test_incremental_conversion(self):
+        with override_settings(WORKING_DIR=self.working_dir):
+            digests, delta = convert_to_json(self.zip_path, workers=1)
+            self.assertEqual(len(digests), 5)
+            self.assertIsNone(delta)
+
+            # Nothing has changed
+            _, delta = convert_to_json(self.zip_path, manifest=digests)
+            self.assertEqual(delta, {'changed': [], 'removed': []})
+            with open(os.path.join(self.working_dir, raw_json_name())) as f:
+                self.assertEqual(f.read(), '')
+
+            # One study changed, another disappeared
+            manifest = dict(digests, NCT02251236='old', NCT0='gone')
+            _, delta = convert_to_json(self.zip_path, workers=2, manifest=manifest)
+            self.assertEqual(delta, {'changed': ['NCT02251236'], 'removed': ['NCT0']})
+            with open(os.path.join(self.working_dir, raw_json_name())) as f:
+                lines = f.readlines()
+            self.assertEqual(len(lines), 1)
+            self.assertIn('NCT02251236', lines[0])
+
+    def test_digest_ignores_download_date(self):
+        self.assertEqual(
+            study_digest(b"<x><download_date>on March 12</download_date></x>"),
+            study_digest(b"<x><download_date>on March 13</download_date></x>"))
+
+    def test_local_classification_matches_sql(self):
+        output = os.path.join(self.working_dir, 'clinical_trials.csv')
+        with override_settings(
+                WORKING_DIR=self.working_dir,
+                CONVERSION_SHARD_SIZE=2,
+                INTERMEDIATE_CSV_PATH=output,
+                FDA_REGULATION_SNAPSHOT_PATH=os.path.join(
+                    settings.BASE_DIR,
+                    'frontend/tests/fixtures/fda_regulation_snapshot.csv')):
+            convert_to_csv(self.zip_path, workers=2, today=date(2018, 3, 13))
+        expected_csv = os.path.join(
+            settings.BASE_DIR, 'frontend/tests/fixtures/expected_trials_data.csv')
+        with open(output) as output_file:
+            with open(expected_csv) as expected_file:
+                results = list(csv.reader(output_file))
+                expected = list(csv.reader(expected_file))
+        self.assertEqual(results[0], expected[0])
+        self.assertEqual(sorted(results[1:]), sorted(expected[1:]))
@@ -1,6 +1,7 @@
 import datetime
 from collections import OrderedDict
 
+from django.db.models import Sum
 from django.test import TestCase
 from django.core.exceptions import ValidationError
 from datetime import date
@@ -13,6 +14,7 @@ from frontend.models import Ranking
 from frontend.tests.common import simulateImport
 from frontend.tests.common import makeTrial
 from frontend.management.commands.process_data import set_current_rankings
+from frontend.trial_computer import compute_metadata
 from unittest.mock import patch, Mock
 
 
@@ -82,6 +84,76 @@ class RankingTestCase(TestCase):
         self.assertEqual(ranks[1].rank, 1)
         self.assertEqual(ranks[1].sponsor, self.sponsor2)
 
+    def _make_trials(self, today):
+        Sponsor.objects.all().update(updated_date=today)
+        for sponsor, kwargs in [
+                (self.sponsor1, {'results_due': True, 'has_results': False,
+                                 'completion_date': date(2014, 1, 1)}),
+                (self.sponsor1, {'results_due': True, 'has_results': True,
+                                 'completion_date': date(2014, 1, 1),
+                                 'reported_date': date(2015, 6, 1)}),
+                (self.sponsor1, {'results_due': True, 'has_results': True,
+                                 'reported_date': date(2016, 1, 1)}),
+                (self.sponsor1, {'results_due': False}),
+                (self.sponsor1, {'status': Trial.STATUS_NO_LONGER_ACT,
+                                 'results_due': True, 'has_results': False}),
+                (self.sponsor2, {'results_due': False})]:
+            makeTrial(sponsor, **kwargs)
+
+    def test_statistics_match_trial_querysets(self):
+        today = date(2016, 4, 1)
+        self._make_trials(today)
+        # Sponsor 3 has no trials at all
+        with self.assertNumQueries(5):
+            set_current_rankings()
+        for sponsor in [self.sponsor1, self.sponsor2, self.sponsor3]:
+            trials = Trial.objects.filter(sponsor=sponsor)
+            visible = sponsor.trial_set.visible()
+            ranking = sponsor.rankings.get(date=today)
+            self.assertEqual(
+                (ranking.due, ranking.reported, ranking.reported_late,
+                 ranking.reported_on_time, ranking.overdue, ranking.total,
+                 ranking.days_late, ranking.finable_days_late),
+                (trials.due().count(), trials.reported().count(),
+                 trials.reported_late().count(),
+                 trials.reported_on_time().count(), trials.overdue().count(),
+                 visible.count(),
+                 visible.aggregate(total=Sum('days_late'))['total'],
+                 visible.aggregate(total=Sum('finable_days_late'))['total']),
+                sponsor)
+        ranking = self.sponsor1.rankings.get(date=today)
+        self.assertEqual((ranking.due, ranking.total, ranking.percentage),
+                         (3, 4, 66))
+        self.assertEqual(ranking.rank, 1)
+        self.assertEqual(self.sponsor3.rankings.get(date=today).percentage, None)
+
+
+    def test_sql_rankings_match(self):
+        today = date(2016, 4, 1)
+        self._make_trials(today)
+
+        def rankings():
+            return list(Ranking.objects.order_by('sponsor', 'date').values_list(
+                'sponsor', 'date', 'rank', 'due', 'days_late',
+                'finable_days_late', 'total', 'overdue', 'reported',
+                'reported_late', 'reported_on_time', 'percentage'))
+        set_current_rankings()
+        expected = rankings()
+        Ranking.objects.filter(date=today).delete()
+        with self.assertNumQueries(3):
+            set_current_rankings(in_sql=True)
+        self.assertEqual(rankings(), expected)
+
+        # Existing rankings are updated, including their percentage
+        Trial.objects.filter(
+            sponsor=self.sponsor1, status=Trial.STATUS_OVERDUE).update(
+                status=Trial.STATUS_REPORTED)
+        set_current_rankings(in_sql=True)
+        expected = rankings()
+        self.assertEqual(
+            self.sponsor1.rankings.get(date=today).percentage, 100)
+        set_current_rankings()
+        self.assertEqual(rankings(), expected)
 
 class SponsorTrialsTestCase(TestCase):
     def setUp(self):
@@ -492,3 +564,27 @@ class SponsorTrialsLatenessTestCase(TestCase):
             results_due=True,
             completion_date='2016-01-01')
         self.assertEqual(trial.days_late, 31)
+
+    def test_qa_events_fetched_once(self):
+        trial = makeTrial(
+            self.sponsor,
+            has_results=False,
+            results_due=True,
+            completion_date='2016-01-01')
+        for submitted, cancelled in [('2016-02-01', '2016-02-02'),
+                                     ('2017-03-01', None)]:
+            TrialQA.objects.create(
+                submitted_to_regulator=submitted,
+                cancelled_by_sponsor=cancelled,
+                trial=trial
+            )
+        trial = Trial.objects.get(pk=trial.pk)
+        with self.assertNumQueries(1):
+            compute_metadata(trial)
+        self.assertEqual(trial.days_late, 60)
+        trials = Trial.objects.prefetch_related('trialqa_set')
+        with self.assertNumQueries(2):
+            for trial in trials:
+                compute_metadata(trial)
+        self.assertEqual(trial.days_late, 60)
+        self.assertEqual(trial.status, Trial.STATUS_REPORTED_LATE)
@@ -0,0 +1,54 @@
+from datetime import date
+from unittest import mock
+
+from django.test import SimpleTestCase
+from django.test import TestCase
+
+from frontend.management.commands.process_data import EARLIEST_CANCELLATION_DATE
+from frontend.management.commands.process_data import set_qa_metadata
+from frontend.models import Sponsor
+from frontend.qa_dates import parse_qa_date
+from frontend.tests.common import makeTrial
+
+
+class ParseQADateTestCase(SimpleTestCase):
+    def setUp(self):
+        parse_qa_date.cache_clear()
+
+    @mock.patch('frontend.qa_dates._parse_free_text')
+    def test_iso_dates_parsed_directly(self, free_text):
+        self.assertEqual(parse_qa_date("2017-11-13"), date(2017, 11, 13))
+        self.assertEqual(parse_qa_date("2017-11-13"), date(2017, 11, 13))
+        self.assertEqual(parse_qa_date.cache_info().hits, 1)
+        free_text.assert_not_called()
+
+    def test_free_text(self):
+        self.assertEqual(parse_qa_date("November 13, 2017"), date(2017, 11, 13))
+        self.assertEqual(parse_qa_date("2017-02-30"), None)
+        self.assertEqual(parse_qa_date("nonsense"), None)
+
+    def test_missing_or_unknown(self):
+        self.assertEqual(parse_qa_date(None), None)
+        self.assertEqual(parse_qa_date(""), None)
+        self.assertEqual(parse_qa_date("Unknown"), None)
+
+
+class SetQAMetadataTestCase(TestCase):
+    def test_cancellations(self):
+        trial = makeTrial(Sponsor.objects.create(name="Sponsor 1"))
+        set_qa_metadata(trial, {
+            'hasResults': False,
+            'derivedSection': {'miscInfoModule': {'submissionTracking': {
+                'submissionInfos': [
+                    {'releaseDate': '2017-10-19', 'unreleaseDate': 'Unknown'},
+                    {'releaseDate': '2018-05-04', 'unreleaseDate': '2018-05-15'},
+                    {'releaseDate': '2018-05-15', 'resetDate': '2018-06-01'},
+                ]}}}})
+        qa = trial.trialqa_set.all()
+        self.assertEqual(len(qa), 3)
+        self.assertEqual(qa[0].submitted_to_regulator, date(2017, 10, 19))
+        self.assertEqual(qa[0].cancelled_by_sponsor, EARLIEST_CANCELLATION_DATE)
+        self.assertEqual(qa[0].cancellation_date_inferred, True)
+        self.assertEqual(qa[1].cancelled_by_sponsor, date(2018, 5, 15))
+        self.assertEqual(qa[1].cancellation_date_inferred, False)
+        self.assertEqual(qa[2].returned_to_sponsor, date(2018, 6, 1))
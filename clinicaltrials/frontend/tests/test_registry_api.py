@@ -0,0 +1,317 @@
+"""Tests for the clinicaltrials.gov API client, against a local stub API
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from datetime import date
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from unittest import mock
+from unittest.mock import patch
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.core.management import call_command
+from django.test import SimpleTestCase
+from django.test import TestCase
+
+from frontend import registry_api
+from frontend.management.commands import process_data
+from frontend.models import Trial
+from frontend.qa_cache import QACache
+
+
+def study(registry_id, submissions=None):
+    content = {
+        'protocolSection': {'identificationModule': {'nctId': registry_id}},
+        'hasResults': False,
+    }
+    if submissions:
+        content['derivedSection'] = {'miscInfoModule': {'submissionTracking': {
+            'submissionInfos': submissions}}}
+    return content
+
+
+def project(study, fields):
+    """Only the given dotted paths of a study, as returned by the API
+    when asked for specific `fields`
+
+    """
+    projected = {}
+    for field in fields:
+        value = study
+        for key in field.split('.'):
+            value = value.get(key) if isinstance(value, dict) else None
+        if value is None:
+            continue
+        target = projected
+        keys = field.split('.')
+        for key in keys[:-1]:
+            target = target.setdefault(key, {})
+        target[keys[-1]] = value
+    return projected
+
+
+def temporary_cache_path(test):
+    tmpdir = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, tmpdir)
+    return os.path.join(tmpdir, 'qa_cache.sqlite3')
+
+
+class StubAPIHandler(BaseHTTPRequestHandler):
+    """Serves `server.studies` at `/api/v2/studies/<registry_id>` (with
+    ETags, honouring `If-None-Match`), and as a paged list at
+    `/api/v2/studies?filter.ids=...`.  The first
+    responses are taken from `server.failures`, a list of HTTP
+    statuses, if there are any left.
+
+    """
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, content):
+        body = json.dumps(content).encode()
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _list(self, query):
+        ids = query['filter.ids'][0].split(',')
+        matches = [self.server.studies[i] for i in ids if i in self.server.studies]
+        if 'fields' in query:
+            fields = query['fields'][0].split(',')
+            matches = [project(study, fields) for study in matches]
+        start = int(query.get('pageToken', ['0'])[0])
+        end = start + int(query.get('pageSize', ['10'])[0])
+        content = {'studies': matches[start:end]}
+        if end < len(matches):
+            content['nextPageToken'] = str(end)
+        return content
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            failure = server.failures.pop(0) if server.failures else None
+        try:
+            time.sleep(server.delay)
+            url = urlparse(self.path)
+            match = re.match(r"^/api/v2/studies/(\w+)$", url.path)
+            if failure:
+                self.send_response(failure)
+                self.send_header('Retry-After', '0')
+                self.end_headers()
+            elif url.path == '/api/v2/studies':
+                self._send_json(self._list(parse_qs(url.query)))
+            elif match and match.group(1) in server.studies:
+                self._send_json(server.studies[match.group(1)])
+            else:
+                self.send_response(404)
+                self.end_headers()
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+
+class StubAPIMixin(object):
+    """Runs a `StubAPIHandler` server for each test
+    """
+    def start_stub_api(self, studies):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubAPIHandler)
+        self.server.studies = studies
+        self.server.failures = []
+        self.server.delay = 0
+        self.server.requests = []
+        self.server.in_flight = self.server.max_in_flight = 0
+        self.server.lock = threading.Lock()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.base_url = 'http://127.0.0.1:{}/api/v2/studies'.format(
+            self.server.server_address[1])
+
+
+class StudyFetcherTestCase(StubAPIMixin, SimpleTestCase):
+    def setUp(self):
+        studies = {
+            'NCT{:08}'.format(i): study('NCT{:08}'.format(i))
+            for i in range(20)}
+        studies['NCT00000003'] = study(
+            'NCT00000003', [{'releaseDate': '2017-11-13'}])
+        self.start_stub_api(studies)
+
+    def _fetcher(self, **kwargs):
+        kwargs.setdefault('rate', 1000)
+        return registry_api.StudyFetcher(base_url=self.base_url, **kwargs)
+
+    def test_fetch_many_concurrently(self):
+        self.server.delay = 0.05
+        ids = sorted(self.server.studies)
+        results = list(self._fetcher(workers=4).fetch_many(ids))
+        self.assertEqual([registry_id for registry_id, _ in results], ids)
+        self.assertEqual(self.server.max_in_flight, 4)
+        self.assertEqual(results[0][1], {'hasResults': False})
+        self.assertEqual(
+            results[3][1]['derivedSection']['miscInfoModule'][
+                'submissionTracking']['submissionInfos'],
+            [{'releaseDate': '2017-11-13'}])
+
+    def test_retries_overloaded_api(self):
+        self.server.failures = [429, 503]
+        content = self._fetcher(workers=1).fetch('NCT00000001')
+        self.assertEqual(content, {'hasResults': False})
+        self.assertEqual(len(self.server.requests), 3)
+
+    @patch('frontend.registry_api.time.sleep')
+    def test_gives_up_eventually(self, sleep):
+        self.server.failures = [503] * 3
+        with self.assertRaises(registry_api.APIError):
+            self._fetcher(workers=1, retries=2).fetch('NCT00000001')
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_missing_study(self):
+        with self.assertRaises(registry_api.APIError):
+            self._fetcher().fetch('NCT99999999')
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_rate_limit(self):
+        start = time.monotonic()
+        list(self._fetcher(workers=4, rate=50).fetch_many(
+            sorted(self.server.studies)[:6]))
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+
+    def test_fetch_batches(self):
+        ids = sorted(self.server.studies) + ['NCT99999999']
+        results = list(self._fetcher(workers=2).fetch_many(ids, batch_size=8))
+        self.assertEqual(
+            [registry_id for registry_id, _ in results], ids[:-1])
+        self.assertEqual(results[0][1], {'hasResults': False})
+        self.assertEqual(results[3][1]['derivedSection']['miscInfoModule'], {
+            'submissionTracking': {
+                'submissionInfos': [{'releaseDate': '2017-11-13'}]}})
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertIn('fields=protocolSection.identificationModule.nctId',
+                      self.server.requests[0])
+
+    def test_fetch_batch_follows_pages(self):
+        ids = sorted(self.server.studies)
+        with patch('frontend.registry_api.MAX_PAGE_SIZE', 7):
+            studies = self._fetcher().fetch_batch(ids)
+        self.assertEqual(sorted(studies), ids)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertIn('pageToken=14', self.server.requests[2])
+
+    def test_conditional_requests(self):
+        cache = QACache(temporary_cache_path(self))
+        fetcher = self._fetcher(cache=cache)
+        first = fetcher.fetch('NCT00000003')
+        second = fetcher.fetch('NCT00000003')
+        self.assertEqual(first, second)
+        self.assertEqual(
+            second['derivedSection']['miscInfoModule']['submissionTracking'],
+            {'submissionInfos': [{'releaseDate': '2017-11-13'}]})
+        self.assertEqual((cache.requests, cache.not_modified), (2, 1))
+        # A changed study is fetched again
+        self.server.studies['NCT00000003'] = study('NCT00000003')
+        self.assertEqual(fetcher.fetch('NCT00000003'), {'hasResults': False})
+        self.assertEqual((cache.requests, cache.not_modified), (3, 1))
+        cache.close()
+
+
+class QACacheTestCase(SimpleTestCase):
+    def test_evicts_least_recently_used(self):
+        path = temporary_cache_path(self)
+        cache = QACache(path, max_entries=2)
+        for registry_id in ['NCT1', 'NCT2', 'NCT3']:
+            cache.record(registry_id, 'digest', 0)
+        self.assertTrue(cache.is_unchanged('NCT1', 'digest', 0))
+        cache.close()
+        cache = QACache(path, max_entries=2)
+        self.assertTrue(cache.is_unchanged('NCT1', 'digest', 0))
+        self.assertFalse(cache.is_unchanged('NCT2', 'digest', 0))
+        self.assertTrue(cache.is_unchanged('NCT3', 'digest', 0))
+        # A trial which has lost its QA rows isn't unchanged
+        self.assertFalse(cache.is_unchanged('NCT3', 'digest', 1))
+        cache.close()
+
+
+class QAImportTestCase(StubAPIMixin, TestCase):
+    def setUp(self):
+        fixture = os.path.join(
+            settings.BASE_DIR, 'frontend/tests/fixtures/api_studies.json')
+        with open(fixture) as f:
+            studies = json.load(f)['studies']
+        self.start_stub_api({
+            study['protocolSection']['identificationModule']['nctId']: study
+            for study in studies})
+
+    def _import(self, **options):
+        with self.settings(CLINICALTRIALS_API_URL=self.base_url, QA_API_RATE=1000):
+            call_command(
+                'process_data', input_csv=os.path.join(
+                    settings.BASE_DIR, 'frontend/tests/fixtures/sample_bq.csv'),
+                **options)
+
+    @mock.patch('frontend.trial_computer.date')
+    @mock.patch('frontend.management.commands.process_data.date')
+    def test_import_with_batched_qa(self, mock_date_1, mock_date_2):
+        mock_date_1.today = mock_date_2.today = mock.Mock(
+            return_value=date(2018, 1, 1))
+        self._import(qa_batch_size=2)
+        # Five trials are due without results
+        self.assertEqual(len(self.server.requests), 3)
+
+        overdue = Trial.objects.get(registry_id='overdue')
+        self.assertEqual(overdue.status, Trial.STATUS_OVERDUE)
+        self.assertEqual(overdue.days_late, 61)
+
+        overdueinqa = Trial.objects.get(registry_id='overdueinqa')
+        self.assertEqual(overdueinqa.status, Trial.STATUS_REPORTED_LATE)
+        self.assertEqual(overdueinqa.days_late, 12)
+
+        returned = Trial.objects.get(registry_id='overdue_withexemption')
+        qa, = returned.trialqa_set.all()
+        self.assertEqual(qa.submitted_to_regulator, date(2017, 10, 2))
+        self.assertEqual(qa.returned_to_sponsor, date(2017, 11, 1))
+
+    @mock.patch('frontend.trial_computer.date')
+    @mock.patch('frontend.management.commands.process_data.date')
+    def test_unchanged_qa_is_skipped(self, mock_date_1, mock_date_2):
+        mock_date_1.today = mock_date_2.today = mock.Mock(
+            return_value=date(2018, 1, 1))
+        qa_cache = temporary_cache_path(self)
+        self._import(qa_batch_size=0, qa_cache=qa_cache)
+        set_qa_metadata = mock.Mock(wraps=process_data.set_qa_metadata)
+        self.server.studies['overdue']['derivedSection'] = {
+            'miscInfoModule': {'submissionTracking': {'submissionInfos': [
+                {'releaseDate': '2017-12-20'}]}}}
+        with mock.patch('frontend.management.commands.process_data.'
+                        'set_qa_metadata', set_qa_metadata):
+            self._import(qa_batch_size=0, qa_cache=qa_cache)
+        trial, content = set_qa_metadata.call_args[0]
+        self.assertEqual(set_qa_metadata.call_count, 1)
+        self.assertEqual(trial.registry_id, 'overdue')
+
+        overdue = Trial.objects.get(registry_id='overdue')
+        self.assertEqual(overdue.status, Trial.STATUS_REPORTED_LATE)
+        overdueinqa = Trial.objects.get(registry_id='overdueinqa')
+        self.assertEqual(overdueinqa.status, Trial.STATUS_REPORTED_LATE)
+        self.assertEqual(overdueinqa.trialqa_set.count(), 1)
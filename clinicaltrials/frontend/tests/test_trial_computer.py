@@ -0,0 +1,172 @@
+"""Parity tests for the batch and SQL versions of `compute_metadata`
+"""
+import itertools
+from datetime import date
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import SimpleTestCase
+from django.test import TestCase
+
+from frontend.management.commands.process_data import set_current_rankings
+from frontend.models import DailySummary
+from frontend.models import Ranking
+from frontend.models import Sponsor
+from frontend.models import Trial
+from frontend.models import TrialQA
+from frontend import trial_computer
+
+
+TODAY = date(2018, 3, 1)
+
+# Lists of (submitted_to_regulator, cancelled_by_sponsor) pairs
+QA_HISTORIES = [
+    [],
+    [(date(2016, 2, 1), None)],
+    [(date(2017, 2, 1), None)],
+    [(date(2016, 2, 1), date(2016, 2, 2))],
+    [(date(2017, 6, 1), date(2017, 9, 1))],
+    [(date(2016, 2, 1), date(2016, 2, 2)), (date(2017, 3, 1), None)],
+    [(date(2016, 2, 3), date(2016, 2, 4)), (date(2016, 3, 1), None),
+     (date(2017, 1, 5), date(2017, 1, 6))],
+]
+
+
+def cases():
+    for (completion, exemption, due, reported, reported_on, history) in \
+            itertools.product(
+                [date(2015, 1, 1), date(2016, 1, 1), date(2017, 1, 1),
+                 date(2017, 6, 1)],
+                [False, True],
+                [False, True],
+                [False, True],
+                [None, date(2016, 12, 1), date(2017, 6, 1)],
+                QA_HISTORIES):
+        if reported and not reported_on:
+            continue
+        trial = Trial(
+            completion_date=completion, has_exemption=exemption,
+            results_due=due, has_results=reported, reported_date=reported_on,
+            status=Trial.STATUS_ONGOING)
+        events = [
+            TrialQA(submitted_to_regulator=submitted,
+                    cancelled_by_sponsor=cancelled)
+            for submitted, cancelled in history]
+        yield trial, events
+
+
+class ComputeBatchTestCase(SimpleTestCase):
+    @mock.patch('frontend.trial_computer.date')
+    def test_matches_compute_metadata(self, date_mock):
+        date_mock.today = mock.Mock(return_value=TODAY)
+        trials = list(cases())
+        columns = zip(*[
+            (trial.completion_date, trial.has_exemption, trial.results_due,
+             trial.has_results, trial.reported_date) +
+            trial_computer.qa_start_dates(trial, events)
+            for trial, events in trials])
+        days_late, finable_days_late, statuses = trial_computer.compute_batch(
+            *columns, today=TODAY)
+        for trial, events in trials:
+            trial_computer.compute_metadata(trial, events)
+        self.assertEqual(
+            days_late, [trial.days_late for trial, _ in trials])
+        self.assertEqual(
+            finable_days_late, [trial.finable_days_late for trial, _ in trials])
+        self.assertEqual(statuses, [trial.status for trial, _ in trials])
+        # All the statuses are exercised
+        self.assertEqual(
+            set(statuses), {choice for choice, _ in Trial.STATUS_CHOICES} -
+            {Trial.STATUS_NO_LONGER_ACT})
+
+    def test_empty(self):
+        self.assertEqual(
+            trial_computer.compute_batch([], [], [], [], [], [], [], []),
+            ([], [], []))
+
+
+class RefreshLatenessTestCase(TestCase):
+    @mock.patch('frontend.trial_computer.date')
+    def test_matches_compute_metadata(self, date_mock):
+        date_mock.today = mock.Mock(return_value=TODAY)
+        sponsor = Sponsor.objects.create(name="Sponsor 1")
+        trials = list(cases())
+        for i, (trial, _) in enumerate(trials):
+            trial.registry_id = 'id_{}'.format(i)
+            trial.sponsor = sponsor
+            trial.start_date = date(2014, 1, 1)
+        Trial.objects.bulk_create([trial for trial, _ in trials])
+        saved = dict(Trial.objects.values_list('registry_id', 'pk'))
+        for trial, events in trials:
+            trial.pk = saved[trial.registry_id]
+            for event in events:
+                event.trial = trial
+        TrialQA.objects.bulk_create(
+            [event for _, events in trials for event in events])
+        # A trial which is no longer an ACT is left alone
+        Trial.objects.filter(registry_id='id_0').update(
+            status=Trial.STATUS_NO_LONGER_ACT)
+
+        with self.assertNumQueries(2):
+            trial_computer.refresh_lateness(TODAY)
+
+        # What refreshing each trial used to do
+        expected = {}
+        for trial, events in trials:
+            if trial.registry_id != 'id_0' and (
+                    not trial.results_due or not trial.has_results):
+                if trial.results_due or trial_computer.is_results_due(
+                        trial.completion_date, trial.has_exemption, TODAY):
+                    trial.results_due = True
+                    trial_computer.compute_metadata(trial, events)
+            expected[trial.registry_id] = (
+                trial.results_due, trial.days_late, trial.finable_days_late,
+                trial.status)
+        expected['id_0'] = expected['id_0'][:3] + (Trial.STATUS_NO_LONGER_ACT,)
+        actual = {
+            registry_id: tuple(values) for registry_id, *values in
+            Trial.objects.values_list(
+                'registry_id', 'results_due', 'days_late',
+                'finable_days_late', 'status')}
+        self.assertEqual(actual, expected)
+
+    def test_limited_to_trials(self):
+        sponsor = Sponsor.objects.create(name="Sponsor 1")
+        trial = Trial.objects.create(
+            registry_id='id_1', sponsor=sponsor, start_date=date(2014, 1, 1),
+            completion_date=date(2016, 1, 1), results_due=False)
+        changed = set()
+        self.assertEqual(trial_computer.refresh_lateness(TODAY, []), 0)
+        self.assertEqual(
+            trial_computer.refresh_lateness(TODAY, [trial.pk], changed), 1)
+        trial.refresh_from_db()
+        self.assertEqual(trial.results_due, True)
+        self.assertEqual(trial.status, Trial.STATUS_OVERDUE)
+        self.assertEqual(trial.days_late, 425)
+        self.assertEqual(changed, {sponsor.slug})
+        # Refreshing again on the same day changes nothing
+        changed = set()
+        self.assertEqual(
+            trial_computer.refresh_lateness(TODAY, [trial.pk], changed), 1)
+        self.assertEqual(changed, set())
+
+    @mock.patch('frontend.exports.write_exports')
+    @mock.patch('frontend.management.commands.refresh_lateness.date')
+    def test_command_reranks(self, date_mock, write_exports):
+        date_mock.today = mock.Mock(return_value=TODAY)
+        sponsor = Sponsor.objects.create(
+            name="Sponsor 1", updated_date=date(2018, 2, 1))
+        Trial.objects.create(
+            registry_id='id_1', sponsor=sponsor, start_date=date(2014, 1, 1),
+            completion_date=date(2016, 1, 1), results_due=False)
+        set_current_rankings()
+        self.assertEqual(Ranking.objects.get().due, 0)
+        call_command('refresh_lateness')
+        # The ranking of the last import is kept
+        ranking = Ranking.objects.get(date=date(2018, 2, 1))
+        self.assertEqual((ranking.due, ranking.overdue), (0, 0))
+        ranking = Ranking.objects.get(date=TODAY)
+        self.assertEqual((ranking.due, ranking.overdue), (1, 1))
+        self.assertEqual(
+            DailySummary.objects.get(sponsor=sponsor).date, TODAY)
+        write_exports.assert_called_once_with()
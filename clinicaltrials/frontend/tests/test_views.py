@@ -2,19 +2,33 @@ import csv
 import io
 import os
 from datetime import date
+from urllib.parse import urlencode
 from unittest.mock import patch
 from unittest.mock import Mock
 
 from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.test import Client
 
 from rest_framework.test import APIClient
-
+from rest_framework_csv.renderers import CSVRenderer
+
+from frontend.custom_rest_backends import keyset_ordering
+from frontend.custom_rest_backends import row_comparison
+from frontend.custom_rest_views import RankingViewSet
+from frontend.data_cache import bump_data_version
+from frontend.custom_rest_views import SponsorViewSet
+from frontend.custom_rest_views import TrialViewSet
 from frontend.tests.common import makeTrial
 from frontend.management.commands.process_data import set_current_rankings
+from frontend.management.commands.process_data import set_daily_summaries
 from frontend.models import Sponsor
 from frontend.models import Trial
+from frontend.views import compute_performance
+from frontend.views import get_performance
 
 
 class FrontendTestCase(TestCase):
@@ -151,9 +165,24 @@ class ApiResultsTestCase(TestCase):
     def test_trial_csv(self):
         client = APIClient()
         response = client.get('/api/trials.csv')
-        results = list(csv.DictReader(io.StringIO(response.content.decode('utf-8'))))
+        content = b''.join(response.streaming_content)
+        results = list(csv.DictReader(io.StringIO(content.decode('utf-8'))))
         self.assertEqual(results[0]['sponsor_slug'], 'sponsor-1')
 
+    def test_streamed_csv_matches_renderer(self):
+        client = APIClient()
+        for url, viewset in [('/api/trials.csv', TrialViewSet),
+                             ('/api/rankings.csv', RankingViewSet),
+                             ('/api/sponsors.csv', SponsorViewSet)]:
+            view = viewset(request=Mock(GET={}), format_kwarg=None)
+            serializer = view.get_serializer_class()(
+                view.get_queryset().order_by('pk'), many=True,
+                context={'request': None})
+            expected = CSVRenderer().render(serializer.data)
+            response = client.get(url, {'ordering': 'pk'})
+            self.assertEqual(
+                b''.join(response.streaming_content), expected, url)
+
     def test_trial_results(self):
         client = APIClient()
         response = client.get('/api/trials/', format='json').json()
@@ -179,6 +208,22 @@ class ApiResultsTestCase(TestCase):
                 "title": "Trial 1"
             })
 
+    def test_counts_cached(self):
+        cache.clear()
+        bump_data_version()
+        client = APIClient()
+
+        def counts(**params):
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get('/api/trials/', params, format='json')
+            return (response.json()['recordsFiltered'],
+                    sum('COUNT(' in query['sql'] for query in queries))
+        self.assertEqual(counts(start=0, length=1), (2, 1))
+        self.assertEqual(counts(start=1, length=1, draw=2), (2, 0))
+        self.assertEqual(counts(has_results=True), (1, 1))
+        self.assertEqual(counts(has_results=True, **{'order[0][dir]': 'desc'}),
+                         (1, 0))
+
     def test_trial_filter(self):
         client = APIClient()
         response = client.get('/api/trials/', {'has_results': True}, format='json').json()
@@ -272,6 +317,99 @@ class ApiResultsTestCase(TestCase):
         response = client.get('/api/rankings/', {'percentage__lte': 49}, format='json').json()
         self.assertEqual(response['recordsFiltered'], 0)
 
+class KeysetPaginationTestCase(TestCase):
+    @patch('frontend.trial_computer.date')
+    def setUp(self, datetime_mock):
+        datetime_mock.today = Mock(return_value=date(2017, 1, 31))
+        for num in range(3):
+            sponsor = Sponsor.objects.create(
+                name="Sponsor {}".format(num), updated_date=date(2017, 1, 31))
+            for completion_date in [date(2016, 1, 1), date(2016, 1, 1),
+                                    date(2016, 6, 1), None]:
+                makeTrial(sponsor, completion_date=completion_date,
+                          results_due=completion_date is not None,
+                          has_results=num == 1,
+                          reported_date=date(2016, 12, 1) if num == 1 else None)
+        set_current_rankings()
+
+    def _pages(self, url, **params):
+        client = APIClient()
+        params.update(length=5, cursor='')
+        pages = []
+        while True:
+            response = client.get(url, params, format='json').json()
+            pages.append(response['results'])
+            if not response['next']:
+                return pages
+            url = response['next']
+            params = {}
+
+    def _ordered(self, column, direction):
+        return {'columns[0][data]': column, 'order[0][column]': 0,
+                'order[0][dir]': direction}
+
+    def test_pages_match_offset_pagination(self):
+        client = APIClient()
+        for url, params in [
+                ('/api/trials/', {}),
+                ('/api/trials/', self._ordered('days_late', 'desc')),
+                ('/api/trials/', self._ordered('days_late', 'asc')),
+                ('/api/trials/', self._ordered('title', 'desc')),
+                ('/api/trials/', self._ordered('registry_id', 'asc')),
+                ('/api/trials/', self._ordered('completion_date', 'asc')),
+                ('/api/trials/', self._ordered('completion_date', 'desc')),
+                ('/api/trials/', self._ordered('sponsor__name', 'desc')),
+                ('/api/trials/', dict(self._ordered('status', 'asc'),
+                                      has_results=False)),
+                ('/api/rankings/', self._ordered('percentage', 'desc'))]:
+            expected = client.get(url, params, format='json').json()
+            pages = self._pages(url, **params)
+            rows = [row for page in pages for row in page]
+            # Every row appears once, in the same order (except within
+            # ties, which keyset pagination orders by primary key)
+            column = params.get('columns[0][data]', 'completion_date')
+            column = column.replace('sponsor__name', 'sponsor_name')
+            self.assertEqual(
+                [row[column] for row in rows],
+                [row[column] for row in expected['results']], params)
+            self.assertCountEqual(rows, expected['results'])
+            self.assertTrue(all(len(page) <= 5 for page in pages))
+        self.assertEqual(
+            [row for page in self._pages('/api/trials/') for row in page],
+            client.get('/api/trials/', format='json').json()['results'])
+
+    def test_row_comparison(self):
+        self.assertEqual(keyset_ordering(Trial.objects.order_by('-title')),
+                         ['-title', '-pk'])
+        sql, params = row_comparison(
+            Trial, ['completion_date', 'start_date', 'pk'],
+            ['2016-01-01', '2015-01-01', 3])
+        self.assertIn('IS NULL', sql)
+        self.assertEqual(params, [date(2016, 1, 1), date(2015, 1, 1), 3])
+        sql, _ = row_comparison(Trial, ['-days_late', '-pk'], [10, 3])
+        self.assertNotIn('IS NULL', sql)
+        # Cases which need the chain of conditions instead
+        for ordering, position in [
+                (['sponsor__name', 'pk'], ['Sponsor 1', 3]),
+                (['-status', 'pk'], ['overdue', 3]),
+                (['status', 'days_late', 'pk'], ['overdue', 10, 3]),
+                (['days_late', 'pk'], [None, 3])]:
+            self.assertIsNone(row_comparison(Trial, ordering, position))
+
+    def test_cursor_tied_to_ordering(self):
+        client = APIClient()
+        response = client.get(
+            '/api/trials/', {'length': 5, 'cursor': ''}, format='json').json()
+        self.assertIsNone(response['previous'])
+        self.assertEqual(response['recordsFiltered'], 12)
+        url = response['next'] + '&' + urlencode(
+            self._ordered('days_late', 'asc'))
+        self.assertEqual(client.get(url).status_code, 404)
+        self.assertEqual(
+            client.get('/api/trials/', {'cursor': 'xyz'},
+                       format='json').status_code, 404)
+
+
 def _make_sponsor_with_date(num, updated_date):
     sponsor, _ = Sponsor.objects.get_or_create(name="Sponsor {}".format(num))
     sponsor.updated_date = updated_date
@@ -384,3 +522,20 @@ class ApiPerformanceResultsTestCase(TestCase):
         response = client.get('/api/performance/', format='json').json()
         self.assertEqual(response['due'], 2)
         self.assertEqual(response['overdue_today'], 0)
+
+    def test_performance_from_daily_summary(self):
+        Sponsor.objects.create(name="xyz", slug="xyz")
+        expected = {
+            slug: get_performance(slug)
+            for slug in [None, self.sponsor1.slug, self.sponsor2.slug, 'xyz']}
+        set_daily_summaries(self.mock_today)
+        for slug, performance in expected.items():
+            # The data version, then the summary
+            with self.assertNumQueries(2):
+                self.assertEqual(get_performance(slug), performance)
+        # Until the next import, summaries don't change with the trials
+        self.reported_trial.delete()
+        self.assertEqual(get_performance(), expected[None])
+        self.assertEqual(compute_performance()['reported'], 0)
+        # Sponsors new since the import are computed from their trials
+        self.assertEqual(get_performance('new sponsor')['due'], 0)
@@ -5,6 +5,7 @@ Called during the import process.
 
 """
 from datetime import date
+from datetime import timedelta
 from dateutil.relativedelta import relativedelta
 
 from django.apps import apps
@@ -29,36 +30,66 @@ def _datify(trial):
             setattr(trial, field, val)
 
 
-def compute_metadata(trial):
+def is_results_due(completion_date, has_exemption, today):
+    """Are results due for an ACT or pACT, as at `today`?
+
+    Results are due a year and 30 days after completion, or three
+    years and 30 days after completion for trials with a certificate
+    of exemption. This mirrors `results_due` in `view.sql`.
+
+    """
+    if not completion_date:
+        return False
+    if completion_date + relativedelta(years=1) + timedelta(days=30) >= today:
+        return False
+    if has_exemption:
+        return completion_date + relativedelta(years=3) + timedelta(days=30) < today
+    return True
+
+
+def compute_metadata(trial, events=None):
     """Compute days late and status for a trial.
+
+    `events` are the trial's QA events (see `qa_events`); they are
+    fetched, once, if needed and not supplied.
+
     """
+    if events is None and trial.results_due and not trial.has_results:
+        events = qa_events(trial)
     # Logic in trial status calculations depends on how many days late
     # a trial is, so this must be called before `get_status`
-    min_days_late, max_days_late = get_days_late(trial)
+    min_days_late, max_days_late = get_days_late(trial, events)
     trial.days_late = max_days_late
-    if trial.days_late:
-        trial.finable_days_late = max([
-            (min_days_late or 0) - type(trial).FINES_GRACE_PERIOD,
-            0])
-        if trial.finable_days_late == 0:
-            trial.finable_days_late = None
-    else:
-        trial.finable_days_late = None
+    trial.finable_days_late = finable_days_late(
+        min_days_late, max_days_late, type(trial).FINES_GRACE_PERIOD)
     trial.previous_status = trial.status
-    trial.status = get_status(trial)
+    trial.status = get_status(trial, events)
+
 
+def qa_events(trial):
+    """A list of the QA events of a trial, in order of submission.
 
-def qa_start_dates(trial):
+    If the trial was loaded with `prefetch_related('trialqa_set')`,
+    this doesn't touch the database.
+
+    """
+    return list(trial.trialqa_set.all())
+
+
+def qa_start_dates(trial, events=None):
     """The dates a trial started the QA procedure, or None if
     unavailable.
 
     Args:
         trial: the trial we're interested in
+        events: the trial's QA events, if already fetched
 
     Returns:
         (original_start_date, cancelled, restart_date) triple
 
     """
+    if events is None:
+        events = qa_events(trial)
     # We assume that the first QA submission date will, when QA is
     # complete, be treated as the date the results were first
     # submitted
@@ -70,12 +101,12 @@ def qa_start_dates(trial):
     restart_date = None
     original_start_date = None
     cancelled = False
-    first_event = trial.trialqa_set.first()
 
-    if first_event:
-        original_start_date = first_event.submitted_to_regulator
+    if events:
+        original_start_date = events[0].submitted_to_regulator
 
-    for event in trial.trialqa_set.order_by('-submitted_to_regulator').all():
+    for event in sorted(events, key=lambda e: e.submitted_to_regulator,
+                        reverse=True):
         if event.cancelled_by_sponsor:
             cancelled = True
             break
@@ -96,65 +127,73 @@ def _days_delta(effective_reporting_date, completion_date, with_grace_period=Fal
     return days_late
 
 
-def get_days_late(trial):
-    """Return the (min, max) number of days a trial is late.
+def due_date(completion_date, has_exemption):
+    """The date results are due, for the purposes of lateness
+    """
+    if has_exemption:
+        return completion_date + relativedelta(years=3)
+    return completion_date + relativedelta(days=365)
 
-    `min` takes into account the earliest submission of results for
-    QA, i.e. is is the most generous possible interpretation of lateness
 
-    `max` disallows early submissions if they are followed by
-    cancellation, i.e. it is the least generous interpretation which
-    still takes into account submission to the QA process.
+def days_late_range(results_due, has_results, due, reported_date,
+                    original_start_date, cancelled, restart_date, today):
+    """The (min, max) number of days late of a trial, given its due
+    date, the date its results were reported, and its QA start dates
+    (see `qa_start_dates`).  See `get_days_late`.
 
     """
     # Logic behind this implementation is discussed in #38 (and #146)
     min_days_late = max_days_late = None
-    if trial.results_due:
-        _datify(trial)
-        due_date = trial.calculated_due_date()
-        if trial.has_results:
-            assert trial.reported_date, \
-                "{} has_results but no reported date".format(trial)
-            min_days_late = max_days_late = _days_delta(
-                trial.reported_date, due_date)
+    if results_due:
+        if has_results:
+            min_days_late = max_days_late = _days_delta(reported_date, due)
         else:
-            original_start_date, cancelled, restart_date = qa_start_dates(trial)
             if original_start_date:
                 min_days_late = max_days_late = _days_delta(
-                    original_start_date, due_date)
+                    original_start_date, due)
             if restart_date:
-                max_days_late = _days_delta(restart_date, due_date)
+                max_days_late = _days_delta(restart_date, due)
             else:
                 if cancelled:
                     max_days_late = _days_delta(
-                        date.today(),
-                        due_date,
+                        today,
+                        due,
                         with_grace_period=True)
             no_qa = not original_start_date
             if no_qa:
                 min_days_late = max_days_late = _days_delta(
-                    date.today(),
-                    due_date,
+                    today,
+                    due,
                     with_grace_period=True)
     return min_days_late, max_days_late
 
 
-def get_status(trial):
-    overdue = trial.days_late and trial.days_late > 0
-    trial_class = type(trial)
-    if trial.results_due:
-        if trial.has_results:
+def finable_days_late(min_days_late, days_late, grace_period):
+    if not days_late:
+        return None
+    return max([(min_days_late or 0) - grace_period, 0]) or None
+
+
+def status_for(trial_class, results_due, has_results, days_late,
+               original_start_date, cancelled, restart_date):
+    """The status of a trial (one of the `STATUS_*` constants of
+    `trial_class`), given how many days late it is and its QA start
+    dates.  See `get_status`.
+
+    """
+    overdue = days_late and days_late > 0
+    if results_due:
+        if has_results:
             if overdue:
                 status = trial_class.STATUS_REPORTED_LATE
             else:
                 status = trial_class.STATUS_REPORTED
         else:
             # results are due, but none have been published
-            original_start_date, cancelled, restart_date = qa_start_dates(trial)
             if original_start_date:
                 # although no results have been published, they have
                 # been submitted
-                if trial.days_late:
+                if days_late:
                     if cancelled and not restart_date:
                         # The submission has been cancelled, so it's still overdue
                         status = trial_class.STATUS_OVERDUE_CANCELLED
@@ -165,16 +204,226 @@ def get_status(trial):
                     status = trial_class.STATUS_REPORTED
             else:
                 # Results have been neither published nor submitted
-                if trial.days_late:
+                if days_late:
                     status = trial_class.STATUS_OVERDUE
                 else:
                     # We're in the grace period, so temporarily let them off
                     status = trial_class.STATUS_ONGOING
     else:
-        if trial.has_results:
+        if has_results:
             # Reported early! Might want to track with its own state
             # in the future.
             status = trial_class.STATUS_REPORTED
         else:
             status = trial_class.STATUS_ONGOING
     return status
+
+
+def get_days_late(trial, events=None):
+    """Return the (min, max) number of days a trial is late.
+
+    `min` takes into account the earliest submission of results for
+    QA, i.e. is is the most generous possible interpretation of lateness
+
+    `max` disallows early submissions if they are followed by
+    cancellation, i.e. it is the least generous interpretation which
+    still takes into account submission to the QA process.
+
+    `events` are the trial's QA events, if already fetched.
+
+    """
+    if not trial.results_due:
+        return None, None
+    _datify(trial)
+    if trial.has_results:
+        assert trial.reported_date, \
+            "{} has_results but no reported date".format(trial)
+        qa_dates = (None, False, None)
+    else:
+        qa_dates = qa_start_dates(trial, events)
+    return days_late_range(
+        trial.results_due, trial.has_results, trial.calculated_due_date(),
+        trial.reported_date, *qa_dates, date.today())
+
+
+def get_status(trial, events=None):
+    qa_dates = (None, False, None)
+    if trial.results_due and not trial.has_results:
+        qa_dates = qa_start_dates(trial, events)
+    return status_for(
+        type(trial), trial.results_due, trial.has_results, trial.days_late,
+        *qa_dates)
+
+
+def compute_batch(completion_date, has_exemption, results_due, has_results,
+                  reported_date, original_start_date, cancelled,
+                  restart_date, today=None):
+    """Compute days late, finable days late and status for many trials
+    at once, without touching the database.
+
+    Each argument is a sequence with one value per trial, as for the
+    fields of the same names on `Trial`; the QA columns are as returned
+    by `qa_start_dates`.  The results are the same as calling
+    `compute_metadata` on each trial in turn.
+
+    Returns:
+        (days_late, finable_days_late, status) lists
+
+    """
+    trial_class = apps.get_model('frontend', 'Trial')
+    if today is None:
+        today = date.today()
+    days_late, finable, statuses = [], [], []
+    for row in zip(completion_date, has_exemption, results_due, has_results,
+                   reported_date, original_start_date, cancelled,
+                   restart_date):
+        (completion, exemption, due, reported, reported_on,
+         started, was_cancelled, restarted) = row
+        assert reported_on or not (due and reported), \
+            "trial {} has_results but no reported date".format(len(statuses))
+        min_late = max_late = None
+        if due:
+            min_late, max_late = days_late_range(
+                due, reported, due_date(completion, exemption), reported_on,
+                started, was_cancelled, restarted, today)
+        days_late.append(max_late)
+        finable.append(finable_days_late(
+            min_late, max_late, trial_class.FINES_GRACE_PERIOD))
+        statuses.append(status_for(
+            trial_class, due, reported, max_late, started, was_cancelled,
+            restarted))
+    return days_late, finable, statuses
+
+
+def _late_sql(effective_date, with_grace_period=False):
+    """The SQL equivalent of `_days_delta(effective_date, due_date)`
+    """
+    late = "({} - due_date)".format(effective_date)
+    if with_grace_period:
+        return "CASE WHEN {0} > {1} THEN {0} END".format(late, GRACE_PERIOD)
+    return "NULLIF(GREATEST({}, 0), 0)".format(late)
+
+
+def refresh_lateness(today, trial_ids=None, changed_sponsors=None):
+    """Bring the time-dependent metadata of trials up to date as at
+    `today`, with a couple of set-based `UPDATE`s rather than saving
+    each trial.
+
+    Trials which have become due are marked as such, then days late,
+    finable days late and status are recomputed for those trials, and
+    for every due trial without results (whose lateness grows by the
+    day), exactly as `compute_metadata` would.  Only trials in
+    `trial_ids`, if given, are considered; otherwise all current
+    trials are.  The slugs of sponsors of trials whose days late,
+    finable days late or status change are added to the set
+    `changed_sponsors`, if given.
+
+    Returns the number of trials recomputed.
+
+    """
+    from django.db import connection
+    trial_class = apps.get_model('frontend', 'Trial')
+    params = {
+        'today': today,
+        'ids': list(trial_ids) if trial_ids is not None else None,
+        'no_longer_act': trial_class.STATUS_NO_LONGER_ACT,
+        'grace_period': GRACE_PERIOD,
+        'fines_grace_period': trial_class.FINES_GRACE_PERIOD,
+        'reported': trial_class.STATUS_REPORTED,
+        'reported_late': trial_class.STATUS_REPORTED_LATE,
+        'overdue': trial_class.STATUS_OVERDUE,
+        'overdue_cancelled': trial_class.STATUS_OVERDUE_CANCELLED,
+        'ongoing': trial_class.STATUS_ONGOING,
+    }
+    scope = ("status <> %(no_longer_act)s "
+             "AND (%(ids)s::integer[] IS NULL OR id = ANY(%(ids)s::integer[]))")
+    with connection.cursor() as c:
+        # See `is_results_due`
+        c.execute(
+            "UPDATE frontend_trial SET results_due = TRUE "
+            "WHERE NOT results_due AND completion_date IS NOT NULL "
+            "AND completion_date + INTERVAL '1 year' + INTERVAL '30 days' "
+            "  < %(today)s "
+            "AND (NOT has_exemption OR completion_date + INTERVAL '3 years' "
+            "  + INTERVAL '30 days' < %(today)s) "
+            "AND " + scope + " RETURNING id", params)
+        params['newly_due'] = [row[0] for row in c.fetchall()]
+        # The QA start dates of each trial (see `qa_start_dates`): the
+        # restart date is the earliest submission after the last
+        # cancellation, visiting events from the latest
+        c.execute(
+            "WITH ordered AS ("
+            "  SELECT trial_id, submitted_to_regulator AS submitted, "
+            "  cancelled_by_sponsor IS NOT NULL AS cancelled, "
+            "  ROW_NUMBER() OVER (PARTITION BY trial_id "
+            "    ORDER BY submitted_to_regulator DESC, id) AS position "
+            "  FROM frontend_trialqa"
+            "), marked AS ("
+            "  SELECT *, MIN(position) FILTER (WHERE cancelled) "
+            "    OVER (PARTITION BY trial_id) AS first_cancelled "
+            "  FROM ordered"
+            "), qa AS ("
+            "  SELECT trial_id, "
+            "  MIN(submitted) AS original_start_date, "
+            "  BOOL_OR(cancelled) AS cancelled, "
+            "  MIN(submitted) FILTER (WHERE first_cancelled IS NULL "
+            "    OR position < first_cancelled) AS restart_date "
+            "  FROM marked GROUP BY trial_id"
+            "), due AS ("
+            "  SELECT trial.id, has_results, reported_date, "
+            "  original_start_date, restart_date, "
+            "  (status, days_late, finable_days_late) AS old_values, "
+            "  COALESCE(qa.cancelled, FALSE) AS cancelled, "
+            "  CASE WHEN has_exemption "
+            "    THEN (completion_date + INTERVAL '3 years')::date "
+            "    ELSE completion_date + 365 END AS due_date "
+            "  FROM frontend_trial trial "
+            "  LEFT JOIN qa ON qa.trial_id = trial.id "
+            "  WHERE results_due "
+            "  AND (NOT has_results OR id = ANY(%(newly_due)s::integer[])) "
+            "  AND " + scope +
+            "), lateness AS ("
+            "  SELECT id, has_results, original_start_date, restart_date, "
+            "  cancelled, old_values, "
+            "  CASE WHEN has_results THEN {reported} "
+            "    WHEN original_start_date IS NULL THEN {today} "
+            "    ELSE {original} END AS min_days_late, "
+            "  CASE WHEN has_results THEN {reported} "
+            "    WHEN original_start_date IS NULL THEN {today} "
+            "    WHEN restart_date IS NOT NULL THEN {restart} "
+            "    WHEN cancelled THEN {today} "
+            "    ELSE {original} END AS max_days_late "
+            "  FROM due"
+            ") "
+            "UPDATE frontend_trial SET "
+            "days_late = max_days_late, "
+            "finable_days_late = CASE WHEN max_days_late IS NOT NULL THEN "
+            "  NULLIF(GREATEST("
+            "    COALESCE(min_days_late, 0) - %(fines_grace_period)s, 0), 0) "
+            "  END, "
+            "previous_status = status, "
+            "status = CASE "
+            "  WHEN lateness.has_results THEN CASE WHEN max_days_late > 0 "
+            "    THEN %(reported_late)s ELSE %(reported)s END "
+            "  WHEN original_start_date IS NOT NULL THEN CASE "
+            "    WHEN max_days_late IS NULL THEN %(reported)s "
+            "    WHEN lateness.cancelled AND restart_date IS NULL "
+            "      THEN %(overdue_cancelled)s "
+            "    ELSE %(reported_late)s END "
+            "  WHEN max_days_late IS NOT NULL THEN %(overdue)s "
+            "  ELSE %(ongoing)s END "
+            "FROM lateness WHERE frontend_trial.id = lateness.id "
+            "RETURNING frontend_trial.sponsor_id, "
+            "(frontend_trial.status, frontend_trial.days_late, "
+            "frontend_trial.finable_days_late) IS DISTINCT FROM "
+            "lateness.old_values".format(
+                reported=_late_sql('reported_date'),
+                original=_late_sql('original_start_date'),
+                restart=_late_sql('restart_date'),
+                today=_late_sql('%(today)s::date', with_grace_period=True)),
+            params)
+        refreshed = c.fetchall()
+    if changed_sponsors is not None:
+        changed_sponsors.update(
+            sponsor for sponsor, changed in refreshed if changed)
+    return len(refreshed)
@@ -20,6 +20,9 @@ from rest_framework.decorators import permission_classes
 from rest_framework import permissions
 from rest_framework.response import Response
 
+from frontend.data_cache import cache_anonymous_response
+from frontend.data_cache import cached
+from frontend.models import DailySummary
 from frontend.models import Ranking
 from frontend.models import Sponsor
 from frontend.models import Trial
@@ -29,30 +32,51 @@ def current_count(field_name, date):
     return Ranking.objects.filter(date=date).aggregate(Sum(field_name))[field_name + '__sum']
 
 
-def get_performance(sponsor_slug=None, date=None):
-    """Get a dictionary of top-line performance metrics.
+def compute_performance(sponsor_slug=None):
+    """Compute the metrics stored in a `DailySummary` from the trials
+    themselves.
     """
     if sponsor_slug is None:
         queryset = Trial.objects.visible()
     else:
         queryset = Trial.objects.visible().filter(sponsor__slug=sponsor_slug)
-    due = queryset.due().count()
-    reported = queryset.reported().count()
-    days_late = queryset.aggregate(Sum('finable_days_late'))['finable_days_late__sum']
-    fines_str = '$0'
-    if days_late:
-        fines_str = "${:,}".format(days_late * settings.FINE_PER_DAY)
     return {
-        'due': due,
-        'reported': reported,
-        'days_late': days_late,
-        'fines_str': fines_str,
+        'due': queryset.due().count(),
+        'reported': queryset.reported().count(),
+        'days_late': queryset.aggregate(
+            Sum('finable_days_late'))['finable_days_late__sum'],
         'overdue_today': queryset.overdue_today().count(),
         'late_today': queryset.late_today().count(),
         'on_time_today': queryset.on_time_today().count()
     }
 
 
+def get_performance(sponsor_slug=None, date=None):
+    """Get a dictionary of top-line performance metrics, cached until
+    the next import.
+    """
+    return cached(
+        lambda: _get_performance(sponsor_slug), 'performance', sponsor_slug)
+
+
+def _get_performance(sponsor_slug):
+    """Read the metrics from the `DailySummary` saved by the last
+    import, or compute them if there isn't one (e.g. for a sponsor
+    that has appeared since).
+    """
+    performance = DailySummary.objects.filter(
+        sponsor_id=sponsor_slug).values(*DailySummary.METRICS).first()
+    if performance is None:
+        performance = compute_performance(sponsor_slug)
+    days_late = performance['days_late']
+    fines_str = '$0'
+    if days_late:
+        fines_str = "${:,}".format(days_late * settings.FINE_PER_DAY)
+    performance['fines_str'] = fines_str
+    return performance
+
+
+@cache_anonymous_response
 @api_view()
 @permission_classes((permissions.AllowAny,))
 def performance(request):
@@ -60,6 +84,7 @@ def performance(request):
     return Response(d)
 
 
+@cache_anonymous_response
 def latest_overdue(request):
     context = {
         'title': 'Who’s sharing their clinical trial results?',
@@ -70,6 +95,7 @@ def latest_overdue(request):
 #############################################################################
 # Rankings page
 
+@cache_anonymous_response
 def rankings(request):
     context = {
         'title': "Who’s sharing their clinical trial results?"
@@ -80,6 +106,7 @@ def rankings(request):
 #############################################################################
 # Sponsor page
 
+@cache_anonymous_response
 def sponsor(request, slug):
     sponsor = get_object_or_404(Sponsor, slug=slug)
     days_late = sponsor.trial_set.aggregate(
@@ -99,6 +126,7 @@ def sponsor(request, slug):
     return render(request, 'sponsor.html', context=context)
 
 
+@cache_anonymous_response
 def trials(request):
     trials = Trial.objects.visible()
     #f = TrialStatusFilter(request.GET, queryset=sponsor.trials())
@@ -108,6 +136,7 @@ def trials(request):
     return render(request, 'trials.html', context=context)
 
 
+@cache_anonymous_response
 def trial(request, registry_id=None):
     trial = get_object_or_404(Trial, registry_id=registry_id)
     if trial.status in [Trial.STATUS_OVERDUE, Trial.STATUS_OVERDUE_CANCELLED]:
@@ -4,4 +4,5 @@
 
 set -e
 
-su -c '/usr/bin/pg_dump --clean -t frontend_trial -t frontend_sponsor -t frontend_ranking -t frontend_trialqa clinicaltrials_staging | psql clinicaltrials' postgres
+su -c '/usr/bin/pg_dump --clean -t frontend_trial -t frontend_sponsor -t frontend_ranking -t frontend_trialqa -t frontend_dailysummary -t frontend_importgeneration clinicaltrials_staging | psql clinicaltrials' postgres
+rsync -a --delete /var/www/fdaaa_staging/clinicaltrials-act-tracker/clinicaltrials/exports/ /var/www/fdaaa/clinicaltrials-act-tracker/clinicaltrials/exports/